@@ -0,0 +1,210 @@
+"""
+Generate synthetic WSPR archives for benchmarking.
+
+Rows follow the 15-column layout of the wsprnet.org CSV archives (wspr_csv.header). Callsigns are drawn from a
+Zipf-like distribution, so a few busy stations account for most spots as in the real archives, and each station
+keeps its grid, reported with 4 or 6 characters. spot_ids increase through the file with a share of repeated
+rows, and a share of rows are malformed in the ways real archives are: truncated lines, non-numeric fields and
+missing required values.
+"""
+
+import argparse
+import gzip
+import os
+import string
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import maidenhead  # noqa: E402
+import wspr_csv  # noqa: E402
+
+# WSPR band codes as they appear in the archives, their dial frequencies in MHz and rough share of spots
+bands = {-1: (0.136, 0.01), 0: (0.4742, 0.01), 1: (1.8366, 0.04), 3: (3.5686, 0.10), 5: (5.2872, 0.03),
+         7: (7.0386, 0.20), 10: (10.1387, 0.12), 14: (14.0956, 0.25), 18: (18.1046, 0.04),
+         21: (21.0946, 0.04), 24: (24.9246, 0.02), 28: (28.1246, 0.04)}
+
+powers = np.array([0, 10, 20, 23, 27, 30, 33, 37, 40])
+versions = np.array(['1.10', '2.0.0', '2.1.2', ''])
+
+earth_radius_km = 6371.0
+
+
+def make_callsigns(rng, n_callsigns):
+    """
+    Makes callsign-like strings, e.g. K1ABC.
+    :param rng: numpy Generator.
+    :param n_callsigns: Number of callsigns.
+    :return: Array of unique callsigns.
+    """
+
+    letters = np.array(list(string.ascii_uppercase))
+    calls = set()
+    while len(calls) < n_callsigns:
+        prefix = ''.join(rng.choice(letters, rng.integers(1, 3)))
+        suffix = ''.join(rng.choice(letters, rng.integers(1, 4)))
+        calls.add(f"{prefix}{rng.integers(0, 10)}{suffix}")
+
+    return np.array(sorted(calls))
+
+
+def make_grids(rng, n_grids):
+    """
+    Makes random 6-character locators.
+    :param rng: numpy Generator.
+    :param n_grids: Number of locators.
+    :return: Array of locators, e.g. FN42ab.
+    """
+
+    field = np.array(list('ABCDEFGHIJKLMNOPQR'))
+    subsquare = np.array(list('abcdefghijklmnopqrstuvwx'))
+
+    return np.char.add(np.char.add(np.char.add(rng.choice(field, n_grids), rng.choice(field, n_grids)),
+                                   np.char.add(rng.integers(0, 10, n_grids).astype(str),
+                                               rng.integers(0, 10, n_grids).astype(str))),
+                       np.char.add(rng.choice(subsquare, n_grids), rng.choice(subsquare, n_grids)))
+
+
+def great_circle(lon1, lat1, lon2, lat2):
+    """
+    Gets the great-circle distance and initial bearing between points.
+    :return: Tuple of distance in km and azimuth in degrees.
+    """
+
+    lon1, lat1, lon2, lat2 = (np.radians(value) for value in (lon1, lat1, lon2, lat2))
+    d_lon = lon2 - lon1
+
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(d_lon / 2) ** 2
+    distance = 2 * earth_radius_km * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+    azimuth = np.degrees(np.arctan2(np.sin(d_lon) * np.cos(lat2),
+                                    np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(d_lon)))
+
+    return distance, (azimuth + 360) % 360
+
+
+def generate_frame(n_rows, seed=0, n_callsigns=5000, zipf_exponent=1.1, duplicate_rate=0.01,
+                   malformed_rate=0.001, month=(2020, 1)):
+    """
+    Generates synthetic spots.
+    :param n_rows: Number of rows, including repeats and malformed rows.
+    :param seed: Random seed. The same arguments always give the same rows.
+    :param n_callsigns: Number of distinct stations.
+    :param zipf_exponent: Skew of the callsign distribution. Higher is more skewed.
+    :param duplicate_rate: Share of rows that repeat an earlier row.
+    :param malformed_rate: Share of rows that are malformed.
+    :param month: (year, month) the timestamps fall in.
+    :return: DataFrame of strings with the WSPR header columns.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    calls = make_callsigns(rng, n_callsigns)
+    home_grids = make_grids(rng, n_callsigns)
+    reports_subgrid = rng.random(n_callsigns) < 0.5  # Some stations report 6-char grids, the rest 4-char
+
+    weights = 1.0 / np.arange(1, n_callsigns + 1) ** zipf_exponent
+    weights /= weights.sum()
+    rx = rng.choice(n_callsigns, n_rows, p=weights)
+    tx = rng.choice(n_callsigns, n_rows, p=weights)
+
+    station_grids = np.where(reports_subgrid, home_grids, home_grids.astype('U4'))
+    rx_grids = station_grids[rx]
+    tx_grids = station_grids[tx]
+
+    rx_lon, rx_lat, _ = maidenhead.decode(rx_grids)
+    tx_lon, tx_lat, _ = maidenhead.decode(tx_grids)
+    distance, azimuth = great_circle(tx_lon, tx_lat, rx_lon, rx_lat)
+
+    band_codes = np.array(list(bands))
+    band_weights = np.array([share for _, share in bands.values()])
+    band = rng.choice(band_codes, n_rows, p=band_weights / band_weights.sum())
+    dial = np.array([bands[code][0] for code in band_codes])[np.searchsorted(band_codes, band)]
+
+    start = int(pd.Timestamp(year=month[0], month=month[1], day=1, tz='UTC').timestamp())
+    timestamp = start + np.sort(rng.integers(0, 28 * 24 * 30, n_rows)) * 120
+
+    frame = pd.DataFrame({
+        'spot_id': np.arange(n_rows, dtype=np.int64) + 10 ** 9,
+        'timestamp': timestamp,
+        'reporter': calls[rx],
+        'reporters_grid': rx_grids,
+        'snr': rng.integers(-30, 11, n_rows),
+        'frequency': np.round(dial + 0.0014 + rng.random(n_rows) * 0.0002, 6),
+        'call_sign': calls[tx],
+        'grid': tx_grids,
+        'power': rng.choice(powers, n_rows),
+        'drift': rng.integers(-1, 2, n_rows),
+        'distance': distance.round().astype(int),
+        'azimuth': azimuth.round().astype(int) % 360,
+        'band': band,
+        'version': rng.choice(versions, n_rows),
+        'code': 0,
+    }, columns=list(wspr_csv.header)).astype(str)
+
+    # Repeated rows, as when archives overlap or a spot is uploaded twice
+    n_duplicates = int(n_rows * duplicate_rate)
+    if n_duplicates:
+        targets = rng.choice(np.arange(1, n_rows), n_duplicates, replace=False)
+        sources = np.maximum(targets - rng.integers(1, 1000, n_duplicates), 0)
+        frame.iloc[targets] = frame.iloc[sources].to_numpy()
+
+    # Malformed rows: non-numeric values, missing required fields, and truncated lines
+    n_malformed = int(n_rows * malformed_rate)
+    if n_malformed:
+        rows = rng.choice(n_rows, n_malformed, replace=False)
+        kinds = rng.integers(0, 3, n_malformed)
+        frame.iloc[rows[kinds == 0], frame.columns.get_loc('snr')] = 'x'
+        frame.iloc[rows[kinds == 1], frame.columns.get_loc('power')] = ''
+        frame.iloc[rows[kinds == 2], frame.columns.get_loc('distance'):] = None
+
+    return frame
+
+
+def write_archive(path, n_rows, **options):
+    """
+    Writes a synthetic archive. Paths ending in .gz are gzip-compressed.
+    :param path: Output path.
+    :param n_rows: Number of rows.
+    :param options: Keyword arguments for generate_frame().
+    :return: Output path.
+    """
+
+    frame = generate_frame(n_rows, **options)
+
+    csv_text = frame.to_csv(header=False, index=False, lineterminator='\n')
+    # Truncated lines end after the drift column rather than carrying empty trailing fields
+    csv_text = csv_text.replace(',,,,,\n', '\n')
+
+    frame_bytes = csv_text.encode()
+    if path.endswith('.gz'):
+        frame_bytes = gzip.compress(frame_bytes, compresslevel=6)
+
+    with open(path, 'wb') as archive:
+        archive.write(frame_bytes)
+
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic WSPR CSV archive.")
+    parser.add_argument('output', help="Output path. Use a .csv.gz name for a compressed archive.")
+    parser.add_argument('--rows', type=int, default=1000000, help="Number of rows.")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed.")
+    parser.add_argument('--callsigns', type=int, default=5000, help="Number of distinct stations.")
+    parser.add_argument('--zipf', type=float, default=1.1, help="Skew of the callsign distribution.")
+    parser.add_argument('--duplicates', type=float, default=0.01, help="Share of repeated rows.")
+    parser.add_argument('--malformed', type=float, default=0.001, help="Share of malformed rows.")
+    parser.add_argument('--month', default='2020-01', help="Month of the spots, as YYYY-MM.")
+    args = parser.parse_args()
+
+    year, month_number = (int(part) for part in args.month.split('-'))
+    write_archive(args.output, args.rows, seed=args.seed, n_callsigns=args.callsigns, zipf_exponent=args.zipf,
+                  duplicate_rate=args.duplicates, malformed_rate=args.malformed, month=(year, month_number))
+    print(f"Wrote {args.rows} rows to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
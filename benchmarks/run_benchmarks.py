@@ -0,0 +1,330 @@
+"""
+Time the ingest and export paths on synthetic archives and record the results.
+
+Each benchmark runs a number of times on the same generated data and the fastest run is kept. Results are
+written as JSON along with the commit, Python version and data parameters, and can be compared with an earlier
+results file to catch regressions between versions.
+
+The database benchmarks (operators, load, dedup) run csv_to_pg and TRUNCATE the wspr tables, so they only run with
+--throwaway-db SECTION, against the scratch PostgreSQL/PostGIS database in that section of the config file. They
+refuse to run if it is the database the loaders use, from the [DB] section.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+import maidenhead  # noqa: E402
+import metrics  # noqa: E402
+import wspr_csv  # noqa: E402
+from generate_wspr import write_archive  # noqa: E402
+
+file_suites = ('parse_c', 'parse_pyarrow', 'parse_gzip', 'grid_decode', 'export')
+db_suites = ('operators', 'load', 'dedup')
+
+default_rows = 1000000
+default_repeat = 3
+default_threshold = 0.10
+
+
+def git_commit():
+    """
+    Gets the commit being benchmarked.
+    :return: Commit hash, with -dirty if there are uncommitted changes, or None outside a git checkout.
+    """
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repo_root, text=True).strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=repo_root) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return f"{commit}-dirty" if dirty else commit
+
+
+def read_chunks(csv_path, chunksize, engine='c'):
+    """
+    Parses a whole archive.
+    :return: List of DataFrames.
+    """
+
+    if wspr_csv.is_gzip(csv_path):
+        return [chunk for chunk, _ in wspr_csv.read_gzip(csv_path, 0, chunksize, engine)]
+
+    return [chunk for chunk, _ in wspr_csv.read_range(csv_path, 0, os.path.getsize(csv_path), chunksize, engine)]
+
+
+def time_runs(run, repeat, setup=None):
+    """
+    Times a benchmark.
+    :param run: Callable doing the work. Returns the number of rows it handled.
+    :param repeat: Number of runs.
+    :param setup: Optional callable run untimed before each run.
+    :return: Dict with the fastest time, rows, rows per second, and the metrics counted during the fastest run.
+    """
+
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+
+        before = metrics.snapshot()
+        started = time.perf_counter()
+        rows = run()
+        seconds = time.perf_counter() - started
+        counted = metrics.since(before)
+
+        if best is None or seconds < best['seconds']:
+            best = {'seconds': round(seconds, 6), 'rows': rows, 'rows_per_second': round(rows / seconds),
+                    'metrics': counted}
+
+    return best
+
+
+def file_benchmarks(suites, csv_path, gzip_path, chunksize, repeat, work_directory):
+    """
+    Runs the benchmarks that need no database.
+    :return: Dict of benchmark name to result.
+    """
+
+    results = {}
+
+    for engine in ('c', 'pyarrow'):
+        if f"parse_{engine}" in suites:
+            results[f"parse_{engine}"] = time_runs(
+                lambda: sum(len(chunk) for chunk in read_chunks(csv_path, chunksize, engine)), repeat)
+
+    if 'parse_gzip' in suites:
+        results['parse_gzip'] = time_runs(lambda: sum(len(chunk) for chunk in read_chunks(gzip_path, chunksize)),
+                                          repeat)
+
+    if 'grid_decode' in suites:
+        chunks = read_chunks(csv_path, chunksize)
+
+        def decode():
+            for chunk in chunks:
+                maidenhead.decode(chunk['reporters_grid'].to_numpy())
+                maidenhead.decode(chunk['grid'].to_numpy())
+            return 2 * sum(len(chunk) for chunk in chunks)
+
+        results['grid_decode'] = time_runs(decode, repeat)
+
+    if 'export' in suites:
+        import to_geopackage
+
+        output_path = os.path.join(work_directory, 'wspr_contacts.gpkg')
+
+        def remove_output():
+            if os.path.exists(output_path):
+                os.remove(output_path)
+
+        def export():
+            return to_geopackage.create_geopackage(to_geopackage.csv_chunks([csv_path], chunksize), work_directory)
+
+        results['export'] = time_runs(export, repeat, setup=remove_output)
+
+    return results
+
+
+def scratch_database(section):
+    """
+    Points the database engine at a scratch database, making sure it is not the one the loaders use.
+    :param section: Config file section of the scratch database.
+    """
+
+    import conf_reader
+    from wspr_pg_database import database
+
+    try:
+        scratch = conf_reader.read_config(section)
+    except KeyError:
+        sys.exit(f"The config file has no [{section}] section with db_user, db_pass, db_host and db_name.")
+
+    try:
+        loader = conf_reader.read_config()
+    except KeyError:
+        loader = None
+    if section == 'DB' or (loader is not None and (scratch[2], scratch[3]) == (loader[2], loader[3])):
+        sys.exit(f"[{section}] is the database the loaders use. The database benchmarks TRUNCATE its wspr tables, "
+                 f"so point them at a scratch database.")
+
+    database.use_config_section(section)
+
+
+def db_benchmarks(suites, csv_path, chunksize, repeat):
+    """
+    Runs the database benchmarks against the scratch database, emptying its wspr tables first.
+    :return: Dict of benchmark name to result.
+    """
+
+    import csv_to_pg
+    import partitions
+    from wspr_pg_database import database
+
+    chunks = read_chunks(csv_path, chunksize)
+    n_rows = sum(len(chunk) for chunk in chunks)
+    results = {}
+
+    def truncate():
+        connection = database.get_engine().raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(f"TRUNCATE wspr.{partitions.spots_table}, wspr.operators, wspr.ingest_journal, "
+                               "wspr.grid_band_hour, wspr.path_pair_day")
+            connection.commit()
+        finally:
+            connection.close()
+
+        csv_to_pg.operator_registry.clear()
+        csv_to_pg.operator_ids.clear()
+
+    def load_all():
+        connection = database.get_engine().raw_connection()
+        try:
+            for chunk in chunks:
+                csv_to_pg.copy_chunk(connection, chunk)
+        finally:
+            connection.close()
+        return n_rows
+
+    csv_to_pg.ensure_indexes()
+
+    if 'operators' in suites:
+        def resolve_operators():
+            connection = database.get_engine().raw_connection()
+            try:
+                for chunk in chunks:
+                    with connection.cursor() as cursor:
+                        csv_to_pg.register_ops(csv_to_pg.add_ops(cursor, chunk))
+                    connection.commit()
+            finally:
+                connection.close()
+            return n_rows
+
+        results['operators'] = time_runs(resolve_operators, repeat, setup=truncate)
+
+    if 'load' in suites:
+        results['load'] = time_runs(load_all, repeat, setup=truncate)
+
+    if 'dedup' in suites:
+        # Every spot is already loaded, so each chunk is merged and entirely skipped
+        truncate()
+        load_all()
+        results['dedup'] = time_runs(load_all, repeat)
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints each benchmark's change against a baseline results file.
+    :param results: Results dict from this run.
+    :param baseline: Results dict from an earlier run.
+    :param threshold: Slowdown, as a fraction, counted as a regression.
+    :return: List of names of benchmarks that regressed.
+    """
+
+    regressions = []
+    print(f"\n{'benchmark':<14}{'baseline s':>12}{'current s':>12}{'change':>10}")
+    for name, result in sorted(results['results'].items()):
+        old = baseline['results'].get(name)
+        if old is None:
+            print(f"{name:<14}{'-':>12}{result['seconds']:>12.3f}{'new':>10}")
+            continue
+
+        # Compare throughput, so runs on different row counts can still be compared
+        change = old['rows_per_second'] / result['rows_per_second'] - 1
+        flag = ' REGRESSION' if change > threshold else ''
+        print(f"{name:<14}{old['seconds']:>12.3f}{result['seconds']:>12.3f}{change:>+10.1%}{flag}")
+        if flag:
+            regressions.append(name)
+
+    return regressions
+
+
+def parse_args():
+    """
+    Parse command line arguments.
+    :return: argparse Namespace.
+    """
+
+    parser = argparse.ArgumentParser(description="Benchmark the WSPR ingest and export paths.")
+    parser.add_argument('--rows', type=int, default=default_rows, help="Rows in the synthetic archive.")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed for the synthetic archive.")
+    parser.add_argument('--chunksize', type=int, default=100000, help="Rows per chunk.")
+    parser.add_argument('--repeat', type=int, default=default_repeat, help="Runs per benchmark. The fastest counts.")
+    parser.add_argument('--suite', dest='suites', action='append', choices=file_suites + db_suites,
+                        help="Benchmark to run. May be repeated. Defaults to all that can run.")
+    parser.add_argument('--throwaway-db', metavar='SECTION',
+                        help="Run the database benchmarks against the scratch database in this section of the "
+                             "config file, e.g. BENCHMARK_DB. They TRUNCATE its wspr tables. It must not be the "
+                             "[DB] database.")
+    parser.add_argument('--data-dir', help="Directory to keep generated archives in, reused between runs with the "
+                                           "same rows and seed. Defaults to a temporary directory.")
+    parser.add_argument('--output', default='benchmark_results.json', help="Results file to write.")
+    parser.add_argument('--compare', help="Earlier results file to compare with.")
+    parser.add_argument('--threshold', type=float, default=default_threshold,
+                        help="Slowdown, as a fraction, reported as a regression when comparing.")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    suites = args.suites or (file_suites + (db_suites if args.throwaway_db else ()))
+    if set(suites) & set(db_suites) and not args.throwaway_db:
+        sys.exit("Database benchmarks TRUNCATE the wspr tables. Pass --throwaway-db SECTION to run them.")
+    if args.throwaway_db:
+        scratch_database(args.throwaway_db)
+
+    with tempfile.TemporaryDirectory() as work_directory:
+        data_directory = args.data_dir or work_directory
+        os.makedirs(data_directory, exist_ok=True)
+
+        csv_path = os.path.join(data_directory, f"synthetic-{args.rows}-{args.seed}.csv")
+        gzip_path = f"{csv_path}.gz"
+        for path in (csv_path, gzip_path):
+            if not os.path.exists(path):
+                print(f"Generating {path}")
+                write_archive(path, args.rows, seed=args.seed, malformed_rate=0.001)
+
+        results = {'meta': {'commit': git_commit(),
+                            'python': platform.python_version(),
+                            'platform': platform.platform(),
+                            'rows': args.rows,
+                            'seed': args.seed,
+                            'chunksize': args.chunksize,
+                            'repeat': args.repeat,
+                            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())},
+                   'results': {}}
+
+        results['results'].update(file_benchmarks(suites, csv_path, gzip_path, args.chunksize, args.repeat,
+                                                  work_directory))
+        if set(suites) & set(db_suites):
+            results['results'].update(db_benchmarks(suites, csv_path, args.chunksize, args.repeat))
+
+    for name, result in results['results'].items():
+        print(f"{name}: {result['seconds']:.3f}s, {result['rows_per_second']} rows/s")
+
+    with open(args.output, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        if regressions:
+            sys.exit(f"{len(regressions)} benchmark(s) regressed: {', '.join(regressions)}")
+
+
+if __name__ == '__main__':
+    main()
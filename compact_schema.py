@@ -0,0 +1,276 @@
+"""
+Convert the database to the compact, dictionary-encoded spot layout.
+
+In the compact layout spots are stored in wspr.spots. Each spot references its RX and TX operators by their id in
+wspr.operators instead of repeating callsigns and grids, and its version and code by small ids into the
+wspr.versions and wspr.codes lookup tables. SNR, drift, azimuth and band are smallint, power is real, and the time
+is a timestamptz. Like wspr_data, spots is range partitioned by month, see partitions.py.
+
+Converting renames the old table to wspr_data_legacy and replaces it with a wspr.wspr_data view with the old
+columns, less the surrogate id, so existing queries keep working. The view reports each operator's most precise
+known grid, with callsigns and grids in their usual capitalisation. Its timestamp is computed, so queries that
+filter on time should use wspr.spots to have partitions pruned.
+
+The loaders encode each chunk in memory, with process-local dictionaries of the ids already known, so only
+operators and lookup values not seen before cost a round trip.
+"""
+
+import argparse
+
+import pandas as pd
+
+import partitions
+from wspr_pg_database import compact_metadata, database
+
+# Whether the database uses the compact layout. Set by detect().
+enabled = False
+
+# Lookup tables for the coded columns
+lookup_tables = {'version': 'wspr.versions',
+                 'code': 'wspr.codes'}
+
+# Process-local lookup registry: column -> {value: id}
+lookup_ids = {name: {} for name in lookup_tables}
+
+# Staging columns in COPY order. The time is staged as epoch seconds and converted when merged into spots.
+staging_columns = ('spot_id', 'timestamp', 'rx_id', 'tx_id', 'snr', 'frequency', 'power', 'drift', 'distance',
+                   'azimuth', 'band', 'version_id', 'code_id')
+spot_columns = tuple('time' if column == 'timestamp' else column for column in staging_columns)
+merge_columns = tuple('to_timestamp(timestamp)' if column == 'timestamp' else column for column in staging_columns)
+
+staging_table = 'wspr_compact_staging'
+
+# wspr_data with its old columns, over the compact tables
+view_sql = """
+    CREATE VIEW wspr.wspr_data AS
+    SELECT s.spot_id,
+           extract(epoch FROM s.time)::integer AS timestamp,
+           upper(rx.callsign)::varchar(15) AS rx_call,
+           upper(tx.callsign)::varchar(15) AS tx_call,
+           (upper(left(rx.grid, 4)) || substr(rx.grid, 5))::varchar(6) AS rx_grid,
+           (upper(left(tx.grid, 4)) || substr(tx.grid, 5))::varchar(6) AS tx_grid,
+           s.snr::integer AS snr,
+           s.frequency,
+           s.power::double precision AS power,
+           s.drift::integer AS drift,
+           s.distance,
+           s.azimuth::integer AS azimuth,
+           s.band::integer AS band,
+           v.version,
+           c.code
+    FROM wspr.spots s
+    JOIN wspr.operators rx ON rx.id = s.rx_id
+    JOIN wspr.operators tx ON tx.id = s.tx_id
+    LEFT JOIN wspr.versions v ON v.id = s.version_id
+    LEFT JOIN wspr.codes c ON c.id = s.code_id
+"""
+
+# Operators of a month of legacy spots that the loaders did not record, i.e. those with grids too short to locate
+convert_operators_sql = """
+    INSERT INTO wspr.operators (callsign, grid)
+    SELECT DISTINCT ON (callsign, left(grid, 4)) callsign, grid
+    FROM (SELECT lower(trim(rx_call)) AS callsign, lower(trim(rx_grid)) AS grid FROM wspr.wspr_data
+          WHERE timestamp >= %(start)s AND timestamp < %(end)s
+          UNION ALL
+          SELECT lower(trim(tx_call)), lower(trim(tx_grid)) FROM wspr.wspr_data
+          WHERE timestamp >= %(start)s AND timestamp < %(end)s) AS ops
+    ORDER BY callsign, left(grid, 4), length(grid) DESC
+    ON CONFLICT (callsign, left(grid, 4)) DO NOTHING
+"""
+
+# {path} and {path_value} copy the great-circle paths, if wspr_data has them
+convert_spots_sql = """
+    INSERT INTO wspr.spots (spot_id, time, rx_id, tx_id, snr, frequency, power, drift, distance, azimuth, band,
+                            version_id, code_id{path})
+    SELECT d.spot_id, to_timestamp(d.timestamp), rx.id, tx.id, d.snr, d.frequency, d.power, d.drift, d.distance,
+           d.azimuth, d.band, v.id, c.id{path_value}
+    FROM wspr.wspr_data d
+    JOIN wspr.operators rx
+      ON rx.callsign = lower(trim(d.rx_call)) AND left(rx.grid, 4) = left(lower(trim(d.rx_grid)), 4)
+    JOIN wspr.operators tx
+      ON tx.callsign = lower(trim(d.tx_call)) AND left(tx.grid, 4) = left(lower(trim(d.tx_grid)), 4)
+    LEFT JOIN wspr.versions v ON v.version = d.version
+    LEFT JOIN wspr.codes c ON c.code = d.code
+    WHERE d.timestamp >= %(start)s AND d.timestamp < %(end)s
+    ON CONFLICT (spot_id, time) DO NOTHING
+"""
+
+
+def is_compact(cursor):
+    """
+    Checks whether the database has been converted to the compact layout.
+    :param cursor: psycopg2 cursor.
+    :return: True if wspr.spots exists.
+    """
+
+    cursor.execute("SELECT to_regclass('wspr.spots') IS NOT NULL")
+
+    return cursor.fetchone()[0]
+
+
+def detect(cursor):
+    """
+    Switches this process to the compact layout if the database has been converted to it.
+    :param cursor: psycopg2 cursor.
+    :return: True if the compact layout is used.
+    """
+
+    global enabled
+
+    enabled = is_compact(cursor)
+    if enabled:
+        partitions.use_table('spots', 'time')
+
+    return enabled
+
+
+def warm_lookups(cursor):
+    """
+    Loads every known lookup value into the process-local registry.
+    :param cursor: psycopg2 cursor.
+    """
+
+    for name, table in lookup_tables.items():
+        cursor.execute(f"SELECT {name}, id FROM {table}")
+        lookup_ids[name] = dict(cursor.fetchall())
+
+
+def encode_lookup(cursor, name, values):
+    """
+    Encodes a column as lookup ids. Values not in the registry are added to the lookup table with one statement
+    and read back with another. The registry is not updated until the caller commits, see register_lookups().
+    :param cursor: psycopg2 cursor.
+    :param name: Lookup name, version or code.
+    :param values: Series of values.
+    :return: Tuple of an Int16 array of ids, missing for missing values, and a dict of the values added.
+    """
+
+    table = lookup_tables[name]
+    known = lookup_ids[name]
+
+    codes, uniques = pd.factorize(values)
+    uniques = [str(value) for value in uniques]
+
+    added = {}
+    missing = [value for value in uniques if value not in known]
+    if missing:
+        cursor.execute(f"INSERT INTO {table} ({name}) SELECT unnest(%s::text[]) ON CONFLICT ({name}) DO NOTHING",
+                       (missing,))
+        cursor.execute(f"SELECT {name}, id FROM {table} WHERE {name} = ANY(%s)", (missing,))
+        added = dict(cursor.fetchall())
+
+    ids = pd.array([known.get(value, added.get(value)) for value in uniques], dtype='Int16')
+
+    return ids.take(codes, allow_fill=True), added
+
+
+def register_lookups(added):
+    """
+    Records committed lookup values in the registry.
+    :param added: Dict of lookup name to the {value: id} dict from encode_lookup().
+    """
+
+    for name, values in added.items():
+        lookup_ids[name].update(values)
+
+
+def create_staging_table(cursor, columns=staging_columns):
+    """
+    Creates the session-local staging table encoded chunks are copied into before being merged into spots.
+    :param cursor: psycopg2 cursor.
+    :param columns: Staging columns, staging_columns and optionally path.
+    """
+
+    columns = ', '.join('0 AS timestamp' if column == 'timestamp' else column for column in columns)
+    cursor.execute(f"CREATE TEMPORARY TABLE IF NOT EXISTS {staging_table} ON COMMIT DELETE ROWS AS "
+                   f"SELECT {columns} FROM wspr.spots WITH NO DATA")
+
+
+def legacy_months(cursor):
+    """
+    Gets the months spanned by the spots in the legacy wspr_data table.
+    :param cursor: psycopg2 cursor.
+    :return: List of (year, month) tuples from the first month to the last.
+    """
+
+    cursor.execute("SELECT min(timestamp), max(timestamp) FROM wspr.wspr_data")
+    first, last = cursor.fetchone()
+    if first is None:
+        return []
+
+    months = pd.period_range(pd.Timestamp(first, unit='s'), pd.Timestamp(last, unit='s'), freq='M')
+
+    return [(month.year, month.month) for month in months]
+
+
+def convert(engine):
+    """
+    Converts the database to the compact layout. Spots are copied from wspr_data one month at a time, committing
+    after each, so an interrupted conversion can be run again. wspr_data is then renamed to wspr_data_legacy, to
+    be dropped once the conversion has been checked, and replaced with a view. Stop any loaders first.
+    :param engine: SQLAlchemy engine.
+    """
+
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('wspr.wspr_data')")
+            if cursor.fetchone() == ('v',):
+                print("wspr.wspr_data is already a view over the compact tables")
+                return
+
+        compact_metadata.create_all(engine)
+        with connection.cursor() as cursor:
+            convert_spots(connection, cursor)
+    finally:
+        connection.close()
+
+    print("wspr.wspr_data is now a view. Drop wspr.wspr_data_legacy once the conversion has been checked.")
+
+
+def convert_spots(connection, cursor):
+    """
+    Copies the legacy spots into the compact tables and replaces wspr_data with the view, see convert().
+    :param connection: psycopg2 connection.
+    :param cursor: psycopg2 cursor of the connection.
+    """
+
+    detect(cursor)
+    cursor.execute("SELECT 1 FROM information_schema.columns "
+                   "WHERE table_schema = 'wspr' AND table_name = 'wspr_data' AND column_name = 'path'")
+    has_paths = cursor.fetchone() is not None
+    spots_sql = convert_spots_sql.format(path=', path' if has_paths else '',
+                                         path_value=', d.path' if has_paths else '')
+
+    for month in legacy_months(cursor):
+        start, end = partitions.month_bounds(month)
+        for name, table in lookup_tables.items():
+            cursor.execute(f"INSERT INTO {table} ({name}) SELECT DISTINCT {name} FROM wspr.wspr_data "
+                           f"WHERE timestamp >= %(start)s AND timestamp < %(end)s AND {name} IS NOT NULL "
+                           f"ON CONFLICT ({name}) DO NOTHING", {'start': start, 'end': end})
+        cursor.execute(convert_operators_sql, {'start': start, 'end': end})
+        checked_months = partitions.ensure_partitions(cursor, [month])
+        cursor.execute(spots_sql, {'start': start, 'end': end})
+        print(f"Converted {cursor.rowcount} spots from {month[0]:04d}-{month[1]:02d}")
+        connection.commit()
+        partitions.register_partitions(checked_months)
+
+    cursor.execute("ALTER TABLE wspr.wspr_data RENAME TO wspr_data_legacy")
+    cursor.execute(view_sql)
+    connection.commit()
+
+
+def main():
+    """
+    Convert the database to the compact layout from the command line.
+    """
+
+    parser = argparse.ArgumentParser(description="Convert wspr_data to the compact, dictionary-encoded layout.")
+    parser.add_argument('action', choices=('convert',))
+    parser.parse_args()
+
+    convert(database.get_engine())
+
+
+if __name__ == '__main__':
+    main()
@@ -4,20 +4,25 @@ Read configuration data from config file.
 
 import configparser
 
+# Connection pool defaults, used when the config file has no [POOL] section
+default_pool_size = 5
+default_max_overflow = 10
 
-def read_config():
+
+def read_config(section='DB'):
     """
     Read the config file & pass settings on.
+    :param section: Section of the config file with the database settings.
     :return: A tuple of settings.
     """
 
     config = configparser.ConfigParser()
     config.read("config")
 
-    db_user = config['DB']['db_user']
-    db_pass = config['DB']['db_pass']
-    db_host = config['DB']['db_host']
-    db_name = config['DB']['db_name']
+    db_user = config[section]['db_user']
+    db_pass = config[section]['db_pass']
+    db_host = config[section]['db_host']
+    db_name = config[section]['db_name']
 
     print("DB Configuration:")
     print(f"DB User: {db_user}")
@@ -27,3 +32,22 @@ def read_config():
     print("-----------------------")
 
     return (db_user, db_pass, db_host, db_name)
+
+
+def read_pool_config():
+    """
+    Read the optional connection pool settings from the [POOL] section of the config file.
+    :return: A tuple of the pool size, the connections allowed beyond it, whether to ping connections before use,
+    and the statement timeout in milliseconds (0 for none).
+    """
+
+    config = configparser.ConfigParser()
+    config.read("config")
+    pool = config['POOL'] if config.has_section('POOL') else {}
+
+    pool_size = int(pool.get('pool_size', default_pool_size))
+    max_overflow = int(pool.get('max_overflow', default_max_overflow))
+    pre_ping = str(pool.get('pre_ping', 'yes')).lower() in ('1', 'yes', 'true', 'on')
+    statement_timeout = int(pool.get('statement_timeout', 0))
+
+    return (pool_size, max_overflow, pre_ping, statement_timeout)
@@ -0,0 +1,17 @@
+"""
+Creates the database schema and tables.
+"""
+
+from wspr_pg_database import create_schema, database
+
+
+def main():
+    """
+    Run the script.
+    """
+    create_schema(database.get_engine())
+    print("Created the wspr schema and tables")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,90 +1,202 @@
+import argparse
+import json
 import os
-from time import sleep
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-
-import conf_reader
-from wspr_pg_database import wsprContact, Base, operator, maidenhead_grid, \
-    maidenhead_subgrid
+import psycopg2.extras
+import requests
+from sqlalchemy import func
+from sqlalchemy.orm import scoped_session
+
+import compact_schema
+import ewkb
+import great_circle
+import maidenhead
+import metrics
+import partitions
+import parquet_cache
+import pg_copy
+import rollups
+import spot_filters
+import wspr_csv
+from wspr_csv import header
+from wspr_pg_database import wsprContact, operator, ingest_journal, spot, database
 
 """
 Upload CSV files in directory to PG database
 """
 
-db_user, db_pass, db_host, db_name = conf_reader.read_config()
-
-engine = create_engine(f'postgresql://{db_user}:{db_pass}@{db_host}/{db_name}')
-Base.metadata.bind = engine
-
-DBSession = sessionmaker(bind=engine)
-session = DBSession()
+# One session per thread, taking a connection from the shared pool when first used
+session = scoped_session(database.new_session)
 
 # Get list of CSV files
 # Iterate through CSV files and upload PG db. Notify user every 1000 rows.
 
-header = ('spot_id', 'timestamp', 'reporter', 'reporters_grid',
-          'snr', 'frequency', 'call_sign', 'grid', 'power', 'drift',
-          'distance', 'azimuth', 'band', 'version', 'code')
+# wspr_data columns in the same order as the CSV header, used by the COPY loader
+copy_columns = ('spot_id', 'timestamp', 'rx_call', 'rx_grid', 'snr', 'frequency',
+                'tx_call', 'tx_grid', 'power', 'drift', 'distance', 'azimuth',
+                'band', 'version', 'code')
 
+default_chunksize = 100000
 
-def add_ops(ops):
-    for i in range(0, 1):
-        if i == 0:
-            op = str(ops["rx_op"]).lower()
-            grid = str(ops["rx_grid"]).lower()
-            geom = ops["rx_geog"]
-        else:
-            op = str(ops["tx_op"]).lower()
-            grid = str(ops["tx_grid"]).lower()
-            geom = ops["tx_geog"]
+staging_table = 'wspr_staging'
 
-        base_grid = grid[:4]
+# Process-local operator registry: (callsign, 4-char grid) -> most precise grid seen
+operator_registry = {}
 
-        # Check if operator already exists in DB
-        pg_op = session.query(operator). \
-            filter(operator.callsign == op,
-                   operator.grid.like(f"{base_grid}%")).first()
+# Process-local operator ids, used to encode spots in the compact layout: (callsign, 4-char grid) -> operators.id
+operator_ids = {}
 
-        if not pg_op:
-            new_operator = operator(callsign=op, grid=grid,
-                                    geog=get_operator_coords(grid))
-            session.add(new_operator)
+# Vertices per great-circle path stored with each spot, see great_circle.py. None stores no paths. Set by
+# use_paths(), and passed on to worker processes by init_worker().
+path_vertices = None
 
-        else:  # Replace grid with subgrid if possible, as it's more precise
-            if len(pg_op.grid) < len(grid):
-                print(f"Updating grid for {op} with a more precise subgrid")
-                pg_op.grid = grid
-                pg_op.geom = get_operator_coords(grid)
+# Insert new operators, replacing the grid of known ones when a more precise subgrid turns up
+upsert_operators_sql = """
+    INSERT INTO wspr.operators (callsign, grid, geom)
+    SELECT v.callsign, v.grid, ST_SetSRID(ST_MakePoint(v.lon, v.lat), 4326)
+    FROM (VALUES %s) AS v (callsign, grid, lon, lat)
+    ON CONFLICT (callsign, left(grid, 4)) DO UPDATE
+    SET grid = EXCLUDED.grid, geom = EXCLUDED.geom
+    WHERE length(operators.grid) < length(EXCLUDED.grid)
+"""
 
-    session.commit()
 
+def warm_operator_registry():
+    """
+    Loads every known operator into the process-local registry, and in the compact layout the lookup values.
+    """
 
-def get_operator_coords(grid):
-    grid = grid.lower()
+    ops = session.query(operator.id, operator.callsign, operator.grid).all()
 
-    if len(grid) == 6:
-        try:
-            geog = session.query(maidenhead_subgrid.geom).filter(
-                maidenhead_subgrid.subgrid == grid).first().geom.ST_Centroid()
-        except AttributeError:
-            geog = None
+    operator_registry.clear()
+    register_ops((callsign, grid) for _, callsign, grid in ops)
+    operator_ids.clear()
+    operator_ids.update(((callsign, grid[:4]), op_id) for op_id, callsign, grid in ops)
 
-    elif len(grid) == 4:
-        try:
-            geog = session.query(maidenhead_grid.geom).filter(maidenhead_grid.grid == grid).first().geom.ST_Centroid()
-        except AttributeError:
-            geog = None
+    if compact_schema.enabled:
+        compact_schema.warm_lookups(session.connection().connection.cursor())
 
-    else:
-        geog = None
 
-    return geog
+def register_ops(ops):
+    """
+    Records operators in the registry, keeping the most precise grid seen for each callsign and 4-char grid.
+    :param ops: Iterable of (callsign, grid) tuples.
+    """
+
+    for callsign, grid in ops:
+        key = (callsign, grid[:4])
+        known_grid = operator_registry.get(key)
+        if known_grid is None or len(known_grid) < len(grid):
+            operator_registry[key] = grid
+
+
+def chunk_operators(csv_chunk):
+    """
+    Gets the RX and TX operators in a chunk, reduced to the most precise grid per callsign and 4-char grid,
+    with the grid centroid decoded for each.
+    :param csv_chunk: DataFrame with the WSPR CSV columns.
+    :return: DataFrame with callsign, grid, lon and lat columns. lon/lat are None for invalid grids.
+    """
+
+    rx_ops = csv_chunk[['reporter', 'reporters_grid']].set_axis(['callsign', 'grid'], axis=1)
+    tx_ops = csv_chunk[['call_sign', 'grid']].set_axis(['callsign', 'grid'], axis=1)
+    ops = pd.concat([rx_ops, tx_ops]).dropna()
+
+    ops['callsign'] = ops['callsign'].astype(str).str.strip().str.lower()
+    ops['grid'] = ops['grid'].astype(str).str.strip().str.lower()
+    if not compact_schema.enabled:  # Compact spots reference an operator whatever their grid
+        ops = ops[ops['grid'].str.len() >= 4]
+
+    ops = ops.assign(base_grid=ops['grid'].str[:4], precision=ops['grid'].str.len())
+    ops = ops.sort_values('precision').drop_duplicates(subset=['callsign', 'base_grid'], keep='last')
+
+    lon, lat, is_valid = maidenhead.decode(ops['grid'].to_numpy())
+    ops = ops[['callsign', 'grid']].assign(lon=np.where(is_valid, lon, None), lat=np.where(is_valid, lat, None))
+
+    return ops
+
+
+def add_ops(cursor, csv_chunk):
+    """
+    Upserts the operators in a chunk that are new, or whose grid can be replaced with a more precise subgrid,
+    in one batched statement. The registry is not updated until the caller commits, see register_ops().
+    :param cursor: psycopg2 cursor.
+    :param csv_chunk: DataFrame with the WSPR CSV columns.
+    :return: List of (callsign, grid) tuples that were written.
+    """
+
+    changed_ops = []
+    for callsign, grid, lon, lat in chunk_operators(csv_chunk).itertuples(index=False):
+        known_grid = operator_registry.get((callsign, grid[:4]))
+        if known_grid is None or len(known_grid) < len(grid):
+            changed_ops.append((callsign, grid, lon, lat))
+
+    if changed_ops:
+        changed_ops.sort(key=lambda op: (op[0], op[1][:4]))  # Consistent lock order across parallel loaders
+        psycopg2.extras.execute_values(cursor, upsert_operators_sql, changed_ops,
+                                       template="(%s, %s, %s::float8, %s::float8)", page_size=len(changed_ops))
+
+    return [(callsign, grid) for callsign, grid, _, _ in changed_ops]
+
 
+def encode_operators(cursor, csv_chunk):
+    """
+    Gets the operators.id of each spot's RX and TX operator. Each distinct operator in the chunk is looked up in
+    the registry, and those not in it, which add_ops() has just written, are read back in one query.
+    :param cursor: psycopg2 cursor in the loading transaction.
+    :param csv_chunk: DataFrame with the WSPR CSV columns.
+    :return: Tuple of the RX ids, the TX ids, and a dict of the ids read back, to add to operator_ids once
+    committed.
+    """
 
-def process(csv_chunk):
+    calls = pd.concat([csv_chunk['reporter'], csv_chunk['call_sign']]).astype(str).str.strip().str.lower()
+    grids = pd.concat([csv_chunk['reporters_grid'], csv_chunk['grid']]).astype(str).str.strip().str.lower()
+    codes, keys = pd.MultiIndex.from_arrays([calls.to_numpy(), grids.str[:4].to_numpy()]).factorize()
+
+    added = {}
+    missing = [key for key in keys if key not in operator_ids]
+    if missing:
+        cursor.execute("SELECT callsign, left(grid, 4), id FROM wspr.operators "
+                       "WHERE (callsign, left(grid, 4)) IN (SELECT * FROM unnest(%s::text[], %s::text[]))",
+                       ([callsign for callsign, _ in missing], [base_grid for _, base_grid in missing]))
+        added = {(callsign, base_grid): op_id for callsign, base_grid, op_id in cursor.fetchall()}
+
+    ids = pd.array([operator_ids.get(key, added.get(key)) for key in keys], dtype='Int32').take(codes)
+
+    return ids[:len(csv_chunk)], ids[len(csv_chunk):], added
+
+
+def encode_spots(cursor, csv_chunk):
+    """
+    Encodes a chunk for the compact layout, see compact_schema.py.
+    :param cursor: psycopg2 cursor in the loading transaction. Operators must already be written by add_ops().
+    :param csv_chunk: DataFrame with the WSPR CSV columns.
+    :return: Tuple of a DataFrame with compact_schema.staging_columns, and the operator ids and lookup values
+    first seen in the chunk, to register once committed.
+    """
+
+    rx_ids, tx_ids, added_ids = encode_operators(cursor, csv_chunk)
+    version_ids, added_versions = compact_schema.encode_lookup(cursor, 'version', csv_chunk['version'])
+    code_ids, added_codes = compact_schema.encode_lookup(cursor, 'code', csv_chunk['code'])
+
+    frame = csv_chunk[['spot_id', 'timestamp', 'snr', 'frequency', 'power', 'drift', 'distance', 'azimuth', 'band']]
+    frame = frame.assign(rx_id=rx_ids, tx_id=tx_ids, version_id=version_ids, code_id=code_ids)
+
+    return frame[list(compact_schema.staging_columns)], added_ids, {'version': added_versions, 'code': added_codes}
+
+
+def process(csv_chunk, progress=None):
+    cursor = session.connection().connection.cursor()
+    with metrics.timer('operators'):
+        changed_ops = add_ops(cursor, csv_chunk)  # upload the operators
+    metrics.count('operators_upserted', len(changed_ops))
+    checked_months = partitions.ensure_partitions(cursor, partitions.chunk_months(csv_chunk['timestamp']))
     qsos = csv_chunk.values.tolist()
+    n_inserted = 0
+    new_qsos = []
 
     for qso in qsos:
         spot_id = qso[0]
@@ -102,20 +214,10 @@ def process(csv_chunk):
         band = qso[12]
         version = qso[13]
         code = qso[14]
-        rx_geog = None
-        tx_geog = None
-
-        operators = {'rx_op': reporter,
-                     'rx_grid': reporters_grid,
-                     'tx_op': call_sign,
-                     'tx_grid': grid,
-                     'rx_geog': rx_geog,
-                     'tx_geog': tx_geog}
-
-        add_ops(operators)  # upload the operators
 
         # Check if contact already exists in DB
-        qso_exists = session.query(wsprContact.spot_id).filter_by(spot_id=spot_id).first() is not None
+        with metrics.timer('dedup'):
+            qso_exists = session.query(wsprContact.spot_id).filter_by(spot_id=spot_id).first() is not None
 
         if not qso_exists:
             new_qso = wsprContact(spot_id=spot_id,
@@ -135,43 +237,689 @@ def process(csv_chunk):
                                   code=code)
 
             session.add(new_qso)
+            new_qsos.append(new_qso)
+            n_inserted += 1
+
+    # Add the inserted spots to the rollups in the same transaction, see rollups.py
+    with metrics.timer('rollups'):
+        session.flush()
+        if new_qsos:
+            cursor.execute(rollups.add_spots_sql('wspr.wspr_data', "WHERE s.id = ANY(%s)"),
+                           ([new_qso.id for new_qso in new_qsos],))
+
+    if progress is not None:
+        record_progress(cursor, *progress)
+    with metrics.timer('commit'):
+        session.commit()
+    register_ops(changed_ops)
+    partitions.register_partitions(checked_months)
+
+    metrics.count('rows_inserted', n_inserted)
+    metrics.count('rows_deduped', len(qsos) - n_inserted)
+
+
+def create_staging_table(cursor, columns=copy_columns):
+    """
+    Creates the session-local staging table chunks are copied into before being merged into wspr_data.
+    Temporary tables are never WAL-logged and are private to the connection, so concurrent loaders do not
+    share a staging table.
+    :param cursor: psycopg2 cursor.
+    :param columns: wspr_data columns to stage.
+    """
+
+    cursor.execute(f"CREATE TEMPORARY TABLE IF NOT EXISTS {staging_table} ON COMMIT DELETE ROWS AS "
+                   f"SELECT {', '.join(columns)} FROM wspr.wspr_data WITH NO DATA")
+
+
+def copy_chunk(connection, csv_chunk, progress=None, fresh=False):
+    """
+    Bulk loads a chunk of spots. The chunk is copied into the staging table with COPY FROM STDIN and merged
+    into wspr_data with a single INSERT ... ON CONFLICT, so spots that are already loaded or repeated within
+    the chunk are skipped without a query per row. The same statement adds the inserted spots to the rollups,
+    see rollups.py. Missing month partitions are created first. In the compact layout the chunk is encoded
+    first and merged into spots instead.
+    :param connection: psycopg2 connection used for the COPY.
+    :param csv_chunk: DataFrame with the WSPR CSV columns.
+    :param progress: Optional (journal id, offset, completed) tuple recorded in the same transaction.
+    :param fresh: Load months that have no partition yet into standalone unindexed tables, to be attached
+    with partitions.attach_partition() once loaded.
+    :return: Tuple of the number of rows inserted and the months loaded into standalone tables.
+    """
+
+    if compact_schema.enabled:
+        table, staging, staged = 'wspr.spots', compact_schema.staging_table, compact_schema.staging_columns
+        columns, merge_columns = compact_schema.spot_columns, compact_schema.merge_columns
+    else:
+        table, staging, staged = 'wspr.wspr_data', staging_table, copy_columns
+        columns = merge_columns = copy_columns
+    if path_vertices is not None:
+        staged, columns, merge_columns = (names + ('path',) for names in (staged, columns, merge_columns))
+    columns, merge_columns = ', '.join(columns), ', '.join(merge_columns)
+    months = partitions.chunk_months(csv_chunk['timestamp'])
+
+    with connection.cursor() as cursor:
+        with metrics.timer('operators'):
+            changed_ops = add_ops(cursor, csv_chunk)
+        metrics.count('operators_upserted', len(changed_ops))
+
+        with metrics.timer('partitions'):
+            fresh_tables = partitions.fresh_partitions(cursor, months) if fresh else {}
+            checked_months = partitions.ensure_partitions(cursor, [month for month in months
+                                                                   if month not in fresh_tables])
+
+        if compact_schema.enabled:
+            with metrics.timer('encode'):
+                frame, added_ids, added_lookups = encode_spots(cursor, csv_chunk)
+        else:
+            frame = csv_chunk[list(header)]
+        if path_vertices is not None:
+            with metrics.timer('paths'):
+                frame = frame.assign(path=great_circle.grid_paths(csv_chunk['grid'].to_numpy(),
+                                                                  csv_chunk['reporters_grid'].to_numpy(),
+                                                                  path_vertices))
+        with metrics.timer('copy'):
+            if compact_schema.enabled:
+                compact_schema.create_staging_table(cursor, staged)
+            else:
+                create_staging_table(cursor, staged)
+            pg_copy.copy_frame(cursor, staging, staged, frame)
+
+        n_inserted = 0
+        fresh_ranges = []
+        with metrics.timer('merge'):
+            for month, fresh_table in fresh_tables.items():
+                start, end = partitions.month_bounds(month)
+                fresh_ranges.append(f"(timestamp >= {start} AND timestamp < {end})")
+                cursor.execute(f"INSERT INTO {fresh_table} ({columns}) "
+                               f"SELECT DISTINCT ON (spot_id) {merge_columns} FROM {staging} "
+                               f"WHERE {fresh_ranges[-1]}")
+                n_inserted += cursor.rowcount
+
+            if len(fresh_tables) < len(months):
+                where = f"WHERE NOT ({' OR '.join(fresh_ranges)})" if fresh_ranges else ""
+                cursor.execute(rollups.merge_sql(f"INSERT INTO {table} ({columns}) "
+                                                 f"SELECT DISTINCT ON (spot_id) {merge_columns} FROM {staging} "
+                                                 f"{where} "
+                                                 f"ON CONFLICT (spot_id, {partitions.time_column}) DO NOTHING"))
+                n_inserted += cursor.fetchone()[0]
+
+        if progress is not None:
+            record_progress(cursor, *progress)
+    with metrics.timer('commit'):
+        connection.commit()
+    register_ops(changed_ops)
+    partitions.register_partitions(checked_months, fresh_tables)
+    if compact_schema.enabled:
+        operator_ids.update(added_ids)
+        compact_schema.register_lookups(added_lookups)
+
+    metrics.count('rows_inserted', n_inserted)
+    metrics.count('rows_deduped', len(csv_chunk) - n_inserted)
+
+    return n_inserted, set(fresh_tables)
+
+
+def record_progress(cursor, journal_id, offset, completed):
+    """
+    Records how far a range has been loaded. Called inside the transaction that loads the chunk ending at
+    offset, so the journal never runs ahead of the data.
+    :param cursor: psycopg2 cursor in the loading transaction.
+    :param journal_id: ingest_journal row id for the range.
+    :param offset: Byte offset up to which the range is committed.
+    :param completed: Whether the range is now fully loaded.
+    """
+
+    cursor.execute("UPDATE wspr.ingest_journal SET committed_offset = %s, completed = %s, updated = now() "
+                   "WHERE id = %s", (offset, completed, journal_id))
+
+
+def plan_ranges(csv_path, workers, filters=None, ranges=None):
+    """
+    Gets the ranges of a file that still need loading. The first time a file is seen it is split into ranges
+    that are recorded in the ingest journal; afterwards the journalled ranges are reused, so a restart resumes
+    each range from its last committed offset no matter how many workers it runs with. A file that has
+    changed size or modification time is treated as a new file, and so is a load with different filters.
+    :param csv_path: Path to the CSV file.
+    :param workers: Number of worker processes, used to split a new file.
+    :param filters: Optional filter dict from spot_filters.build_filters().
+    :param ranges: Ranges to record for a new file instead of splitting it, e.g. [(0, number of rows)] for a
+    Parquet cache file, whose offsets are row numbers. A .csv.gz file is journalled as a single range ending at
+    its compressed size, and its committed offset is a decompressed offset.
+    :return: List of (csv_path, journal id, resume offset, end offset) tasks.
+    """
+
+    csv_path = os.path.abspath(csv_path)
+    stat = os.stat(csv_path)
+    identity = {'path': csv_path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                'filters': json.dumps(filters, sort_keys=True) if filters else ''}
+
+    entries = session.query(ingest_journal).filter_by(**identity).order_by(ingest_journal.range_start).all()
+
+    if not entries and wspr_csv.is_gzip(csv_path):  # Compressed files are streamed whole
+        ranges = [(0, stat.st_size)]
+
+    if not entries:
+        entries = [ingest_journal(range_start=start, range_end=end, committed_offset=start, completed=False,
+                                  **identity)
+                   for start, end in ranges or wspr_csv.split_ranges(csv_path, workers)]
+        session.add_all(entries)
+        session.commit()
+
+    elif all(entry.completed for entry in entries):
+        print(f"{csv_path} has already been loaded. Skipping.")
+
+    return [(csv_path, entry.id, entry.committed_offset, entry.range_end)
+            for entry in entries if not entry.completed]
+
+
+def complete_range(journal_id):
+    """
+    Marks a range as fully loaded. Used for compressed files, whose end is only known once the stream runs out.
+    :param journal_id: ingest_journal row id for the range.
+    """
+
+    session.query(ingest_journal).filter_by(id=journal_id).update({'completed': True})
     session.commit()
 
 
-def csv_chunk(csv_path, n_rows, processed_rows, processed_files):
-    chunksize = 1000
-    current_file_rows = 0
-    for chunk in pd.read_csv(csv_path, chunksize=chunksize, header=None):
-        process(chunk)
-        processed_rows += chunksize
-        current_file_rows += chunksize
-        print(f"Processed {current_file_rows} rows out of {n_rows} from {csv_path}. {processed_rows} total rows from \
-        {processed_files} files")
+def high_water_mark(month):
+    """
+    Gets the highest spot_id loaded for a month. spot_ids grow over time, so later spots in the same month
+    have higher ones.
+    :param month: (year, month) tuple.
+    :return: Highest spot_id, or None if nothing is loaded for the month.
+    """
+
+    start, end = partitions.month_bounds(month)
+    if compact_schema.enabled:
+        return session.query(func.max(spot.spot_id)).filter(spot.time >= func.to_timestamp(start),
+                                                            spot.time < func.to_timestamp(end)).scalar()
+
+    return session.query(func.max(wsprContact.spot_id)).filter(wsprContact.timestamp >= start,
+                                                               wsprContact.timestamp < end).scalar()
+
+
+def task_bytes(task):
+    """
+    Gets how many bytes of its file a task reads. A .csv.gz file is always read from the start, even to
+    resume it.
+    :param task: (path, journal id, resume offset, end offset) task.
+    :return: Bytes read.
+    """
+
+    path, _, start, end = task
+
+    return end if wspr_csv.is_gzip(path) else end - start
+
+
+def detect_layout():
+    """
+    Switches the loaders to the compact layout if the database has been converted to it, see compact_schema.py.
+    """
+
+    connection = database.get_engine().raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            compact_schema.detect(cursor)
+    finally:
+        connection.close()
+
+
+def ensure_indexes():
+    """
+    Detects the layout of the database and creates the unique indexes the bulk loader relies on for databases
+    that were set up before they were added to the model. In the compact layout the primary key of spots serves.
+    """
+
+    detect_layout()
+    for table in (operator.__table__,) if compact_schema.enabled else (wsprContact.__table__, operator.__table__):
+        for index in table.indexes:
+            index.create(database.get_engine(), checkfirst=True)
+
+    if path_vertices is not None:
+        ensure_path_column()
+
+
+def use_paths(vertices):
+    """
+    Stores a great-circle path with each spot loaded by this process, see great_circle.py. Worker processes are
+    given the setting by init_worker().
+    :param vertices: Vertices per path, at least 2, or None to store no paths.
+    """
+
+    global path_vertices
+
+    if vertices is not None and vertices < 2:
+        raise ValueError("Paths need at least 2 vertices")
+    path_vertices = vertices
+
+
+def ensure_path_column():
+    """
+    Adds the path column and its GiST index to the spots table of databases that were set up before the column
+    was added to the model. Each is checked for first, so that loaders do not queue for the table lock once
+    they exist. Building the index reads every partition, so the first load with paths takes a while to start.
+    """
+
+    table = partitions.spots_table
+    connection = database.get_engine().raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM information_schema.columns "
+                           "WHERE table_schema = 'wspr' AND table_name = %s AND column_name = 'path'", (table,))
+            if cursor.fetchone() is None:
+                print(f"Adding the path column to wspr.{table}")
+                cursor.execute(f"ALTER TABLE wspr.{table} "
+                               f"ADD COLUMN IF NOT EXISTS path geometry(MultiLineString, {ewkb.srid})")
+
+            cursor.execute("SELECT to_regclass(%s)", (f"wspr.idx_{table}_path",))
+            if cursor.fetchone()[0] is None:
+                print(f"Creating the path index on wspr.{table}")
+                cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_path ON wspr.{table} USING gist (path)")
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def csv_chunk(csv_path, journal_id, start, end, mode='copy', chunksize=default_chunksize, fresh=False,
+              csv_engine='c', max_memory=None, filters=None):
+    """
+    Loads a byte range of a CSV file, recording each committed chunk in the ingest journal. A .csv.gz file is
+    streamed and decompressed as it is parsed, without being extracted.
+    :param csv_path: Path to the CSV or .csv.gz file.
+    :param journal_id: ingest_journal row id for the range.
+    :param start: Offset to start loading from, at the start of a line.
+    :param end: End offset of the range, at the start of a line or the end of the file.
+    :param mode: copy to bulk load through the staging table, orm to insert row by row.
+    :param chunksize: Approximate rows per batch.
+    :param fresh: Load new months into standalone unindexed tables, see copy_chunk(). Copy mode only.
+    :param csv_engine: pandas CSV engine, 'c' or 'pyarrow'.
+    :param max_memory: Optional memory budget in bytes for one chunk. Overrides chunksize.
+    :param filters: Optional filter dict from spot_filters.build_filters(). Spots that do not match are
+    dropped before any DB work.
+    :return: Tuple of the number of rows processed and the months loaded into standalone tables.
+    """
+
+    current_range_rows = 0
+    malformed_rows = 0
+    filtered_rows = 0
+    fresh_months = set()
+    compressed = wspr_csv.is_gzip(csv_path)
+    range_mb = (end - start) / 1e6
+
+    if max_memory is not None:
+        chunksize = wspr_csv.chunksize_for_memory(csv_path, max_memory, csv_engine)
+        print(f"Loading {csv_path} [{start}:{end}] in chunks of about {chunksize} rows")
+
+    if compressed:
+        chunks = wspr_csv.read_gzip(csv_path, start, chunksize, csv_engine)
+    else:
+        chunks = wspr_csv.read_range(csv_path, start, end, chunksize, csv_engine)
+
+    connection = database.get_engine().raw_connection() if mode == 'copy' else None
+
+    try:
+        before = metrics.snapshot()
+        for chunk, offset in chunks:
+            current_range_rows += len(chunk)
+            malformed_rows += chunk.attrs['malformed']
+            metrics.count('rows_read', len(chunk))
+            metrics.count('rows_malformed', chunk.attrs['malformed'])
+            with metrics.timer('filter'):
+                chunk, n_filtered = spot_filters.apply_filters(chunk, filters)
+            filtered_rows += n_filtered
+            metrics.count('rows_filtered', n_filtered)
+
+            progress = (journal_id, offset, not compressed and offset >= end)
+            if mode == 'copy':
+                fresh_months |= copy_chunk(connection, chunk, progress, fresh)[1]
+            else:
+                process(chunk, progress)
+
+            metrics.emit('chunk', path=csv_path, offset=offset, **metrics.since(before))
+            before = metrics.snapshot()
+
+            if compressed:
+                position = f"{offset / 1e6:.1f} MB decompressed"
+            else:
+                position = f"{(offset - start) / 1e6:.1f} of {range_mb:.1f} MB"
+            print(f"Processed {current_range_rows} rows, {position} from {csv_path} [{start}:{end}]. "
+                  f"{filtered_rows} rows filtered out, {malformed_rows} malformed rows skipped")
+    finally:
+        if connection is not None:
+            connection.close()
+
+    if compressed:
+        complete_range(journal_id)
+
+    return current_range_rows, fresh_months
+
+
+def url_chunk(url, mode='copy', chunksize=default_chunksize, fresh=False, csv_engine='c', filters=None):
+    """
+    Loads a .csv.gz archive straight from its HTTP response while it downloads, without writing it to disk.
+    Nothing is journalled, but spots that are already loaded are skipped, so an interrupted load can simply be
+    run again.
+    :param url: URL of a .csv.gz or .csv archive.
+    :param mode: Load mode, see csv_chunk().
+    :param chunksize: Approximate rows per batch.
+    :param fresh: Load new months into standalone unindexed tables, see copy_chunk(). Copy mode only.
+    :param csv_engine: pandas CSV engine, 'c' or 'pyarrow'.
+    :param filters: Optional filter dict from spot_filters.build_filters().
+    :return: Tuple of the number of rows processed and the months loaded into standalone tables.
+    """
+
+    current_range_rows = 0
+    fresh_months = set()
+
+    connection = database.get_engine().raw_connection() if mode == 'copy' else None
+
+    try:
+        with requests.get(url, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            chunks = wspr_csv.read_stream(response.raw, chunksize, csv_engine, compressed=wspr_csv.is_gzip(url))
+
+            before = metrics.snapshot()
+            for chunk, offset in chunks:
+                current_range_rows += len(chunk)
+                metrics.count('rows_read', len(chunk))
+                metrics.count('rows_malformed', chunk.attrs['malformed'])
+                chunk, n_filtered = spot_filters.apply_filters(chunk, filters)
+                metrics.count('rows_filtered', n_filtered)
+
+                if mode == 'copy':
+                    fresh_months |= copy_chunk(connection, chunk, fresh=fresh)[1]
+                else:
+                    process(chunk)
+
+                metrics.emit('chunk', path=url, offset=offset, **metrics.since(before))
+                before = metrics.snapshot()
+                print(f"Processed {current_range_rows} rows, {offset / 1e6:.1f} MB decompressed from {url}")
+    finally:
+        if connection is not None:
+            connection.close()
+
+    return current_range_rows, fresh_months
+
+
+def cache_chunk(parquet_path, journal_id, start, end, mode='copy', chunksize=default_chunksize, fresh=False,
+                filters=None, cache_root=None):
+    """
+    Loads a file of the Parquet cache from a row offset, recording each committed chunk in the ingest journal.
+    :param parquet_path: Path to a Parquet file in the cache.
+    :param journal_id: ingest_journal row id for the file.
+    :param start: Row to start loading from.
+    :param end: Number of rows in the file.
+    :param mode: Load mode, see csv_chunk().
+    :param chunksize: Maximum rows per batch.
+    :param fresh: Load new months into standalone unindexed tables, see copy_chunk(). Copy mode only.
+    :param filters: Optional filter dict from spot_filters.build_filters().
+    :param cache_root: Cache root directory the file is in.
+    :return: Tuple of the number of rows processed and the months loaded into standalone tables.
+    """
+
+    current_range_rows = 0
+    filtered_rows = 0
+    fresh_months = set()
+
+    connection = database.get_engine().raw_connection() if mode == 'copy' else None
+
+    try:
+        before = metrics.snapshot()
+        for chunk, offset in parquet_cache.read_file(cache_root, parquet_path, start, chunksize):
+            current_range_rows += len(chunk)
+            metrics.count('rows_read', len(chunk))
+            chunk, n_filtered = spot_filters.apply_filters(chunk, filters)
+            filtered_rows += n_filtered
+            metrics.count('rows_filtered', n_filtered)
+
+            progress = (journal_id, offset, offset >= end)
+            if mode == 'copy':
+                fresh_months |= copy_chunk(connection, chunk, progress, fresh)[1]
+            else:
+                process(chunk, progress)
+
+            metrics.emit('chunk', path=parquet_path, offset=offset, **metrics.since(before))
+            before = metrics.snapshot()
+            print(f"Processed {offset} of {end} rows from {parquet_path}. {filtered_rows} rows filtered out")
+    finally:
+        if connection is not None:
+            connection.close()
+
+    return current_range_rows, fresh_months
+
+
+def csv_paths(root_path):
+    """
+    Finds CSV and compressed .csv.gz files under the root path.
+    :param root_path: Directory to search, or a single file.
+    :return: Sorted list of CSV paths.
+    """
+
+    if os.path.isfile(root_path):
+        return [root_path]
+
+    paths = []
+    for root, _, filenames in os.walk(root_path):
+        for file in filenames:
+            if file.endswith(('.csv', '.csv.gz')):
+                paths.append(os.path.join(root, file))
+
+    return sorted(paths)
+
+
+def init_worker(metrics_jsonl=None, vertices=None):
+    """
+    Gives a worker process its own operator registry. The pool drops the connections a worker inherits when it
+    forks, so each worker opens its own. The layout is detected again rather than inherited, so that workers
+    started with spawn or forkserver, which do not copy the parent's globals, load the same tables.
+    :param metrics_jsonl: JSON lines file the worker appends its chunk metrics to, if any.
+    :param vertices: Vertices per great-circle path, see use_paths().
+    """
+
+    metrics.configure(jsonl=metrics_jsonl)
+    use_paths(vertices)
+    metrics.take()  # Totals inherited from the parent are the parent's to report
+    detect_layout()
+    warm_operator_registry()
+
+
+def run_task(load, task, load_options):
+    """
+    Runs a load task in a worker process and hands its metrics back with the result, so that the parent can
+    report totals for the whole run.
+    :param load: csv_chunk or cache_chunk.
+    :param task: (path, journal id, resume offset, end offset) task.
+    :param load_options: Keyword arguments for load.
+    :return: Tuple of the load result and the worker's metrics from metrics.take().
+    """
+
+    return load(*task, **load_options), metrics.take()
+
+
+def csv_processor(root_path, mode='copy', chunksize=default_chunksize, workers=1, fresh=False, csv_engine='c',
+                  max_memory=None, filters=None, paths=None):
+    """
+    Loads every CSV file under the root path. With more than one worker, each file is cut into up to one
+    newline-aligned byte range per worker and every range is loaded by a separate process. A range that fails
+    to load is reported and the remaining ranges carry on. If the root path is a Parquet cache, see
+    parquet_cache.py, its files are loaded instead, one per task, skipping partitions the filters rule out.
+    .csv.gz files are streamed whole by one task each, and an http(s) URL of an archive is streamed as it
+    downloads.
+    :param root_path: Directory to search for CSV files, a single file, a Parquet cache directory, or an archive
+    URL.
+    :param mode: Load mode, see csv_chunk().
+    :param chunksize: Approximate rows per batch.
+    :param workers: Number of worker processes.
+    :param fresh: Load new months into standalone unindexed tables and attach them as partitions at the end.
+    :param csv_engine: pandas CSV engine, 'c' or 'pyarrow'.
+    :param max_memory: Optional memory budget in bytes for the whole load, shared between the workers.
+    Overrides chunksize.
+    :param filters: Optional filter dict from spot_filters.build_filters().
+    :param paths: Vertices per great-circle path to store with each spot, see great_circle.py. None stores no
+    paths. Copy mode only.
+    :return: Number of rows processed.
+    """
+
+    load_options = {'mode': mode,
+                    'chunksize': chunksize,
+                    'fresh': fresh,
+                    'filters': filters}
 
-    return processed_rows
+    processed_rows = 0
+    failed_ranges = []
+    fresh_months = set()
+
+    use_paths(paths)
+    ensure_indexes()
+    if mode == 'orm' and compact_schema.enabled:
+        raise ValueError("orm mode only loads the legacy wspr_data table. Use copy mode with the compact layout.")
+    if root_path.startswith(('http://', 'https://')):
+        warm_operator_registry()
+        processed_rows, fresh_months = url_chunk(root_path, mode, chunksize, fresh, csv_engine, filters)
+        tasks = []
+        unit, scale = 'MB', 1e6
+    elif parquet_cache.is_cache(root_path):
+        load = cache_chunk
+        load_options['cache_root'] = root_path
+        tasks = [task for parquet_path, n_rows in parquet_cache.cached_files(root_path, filters)
+                 for task in plan_ranges(parquet_path, workers, filters, [(0, n_rows)])]
+        unit, scale = 'rows', 1
+    else:
+        load = csv_chunk
+        load_options['csv_engine'] = csv_engine
+        load_options['max_memory'] = max_memory // workers if max_memory is not None else None
+        tasks = [task for csv_path in csv_paths(root_path) for task in plan_ranges(csv_path, workers, filters)]
+        unit, scale = 'MB', 1e6
+
+    total = sum(task_bytes(task) for task in tasks) / scale
+    processed = 0
+
+    def finish(task, result):
+        nonlocal processed_rows, processed
+        csv_path, _, start, end = task
+        n_rows, months = result
+        processed_rows += n_rows
+        fresh_months.update(months)
+        processed += task_bytes(task) / scale
+        print(f"Finished {csv_path} [{start}:{end}]. {processed_rows} total rows, "
+              f"{processed:.1f} of {total:.1f} {unit}")
+        metrics.write_prometheus()
+
+    if workers > 1:
+        session.remove()  # Workers fork from this thread and must not inherit its session
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(metrics.jsonl_path, path_vertices)) as executor:
+            futures = {executor.submit(run_task, load, task, load_options): task for task in tasks}
+
+            for future in as_completed(futures):
+                task = futures[future]
+                try:
+                    result, worker_metrics = future.result()
+                    metrics.merge(worker_metrics)
+                except Exception as e:
+                    print(f"Failed to load {task[0]} [{task[2]}:{task[3]}]: {e!r}")
+                    failed_ranges.append(task)
+                    continue
+
+                finish(task, result)
 
+    else:
+        warm_operator_registry()
 
-def csv_processor(root_path):
-    processed_rows = 0
-    processed_files = 1
-    for root, _, filenames in os.walk(root_path):
-        for file in filenames:
-            if os.path.splitext(file)[1] == '.csv':
-                csv_path = os.path.join(root, file)
-                print(f"Processing {csv_path}")
-                sleep(3)
+        for task in tasks:
+            try:
+                result = load(*task, **load_options)
+            except Exception as e:
+                print(f"Failed to load {task[0]} [{task[2]}:{task[3]}]: {e!r}")
+                session.rollback()
+                failed_ranges.append(task)
+                continue
+
+            finish(task, result)
+
+    if fresh_months:
+        connection = database.get_engine().raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                for month in sorted(fresh_months):
+                    partitions.attach_partition(cursor, month)
+                    rollups.backfill(cursor, month)
+                    connection.commit()
+        finally:
+            connection.close()
+
+    if failed_ranges:
+        print(f"{len(failed_ranges)} range(s) failed to load:")
+        for csv_path, _, start, end in failed_ranges:
+            print(f"\t{csv_path} [{start}:{end}]")
+
+    return processed_rows
 
-                print("Counting all rows...")
-                n_rows = sum(1 for row in open(csv_path))
 
-                print("Now processing...")
-                processed_rows += csv_chunk(csv_path, n_rows, processed_rows, processed_files)
-                processed_files += 1
+def parse_args():
+    """
+    Parse command line arguments.
+    :return: argparse Namespace.
+    """
+
+    parser = argparse.ArgumentParser(description="Upload WSPR CSV files to the PostGIS database.")
+    parser.add_argument('root_path', nargs='?',
+                        help="WSPR CSV root path, or a Parquet cache made by parquet_cache.py. Prompted for if "
+                             "omitted.")
+    parser.add_argument('--mode', choices=('copy', 'orm'), default='copy',
+                        help="copy streams each chunk into a staging table and merges it with ON CONFLICT; "
+                             "orm inserts row by row.")
+    parser.add_argument('--chunksize', type=int, default=default_chunksize,
+                        help="Approximate rows read and loaded per batch.")
+    parser.add_argument('--max-memory', type=wspr_csv.parse_memory,
+                        help="Memory budget for the chunks being loaded, e.g. 512MB, shared between workers. "
+                             "Picks the chunk size and overrides --chunksize.")
+    parser.add_argument('--engine', choices=('c', 'pyarrow'), default='c',
+                        help="CSV parser. pyarrow needs the pyarrow package.")
+    parser.add_argument('--fresh-partitions', action='store_true',
+                        help="Load months that have no partition yet into unindexed tables and attach them, "
+                             "building their indexes, once the load finishes. Copy mode only.")
+    parser.add_argument('--paths', action='store_true',
+                        help="Store each spot's great-circle path from TX to RX in the path column, for path maps. "
+                             "Copy mode only.")
+    parser.add_argument('--path-vertices', type=int, default=great_circle.default_vertices,
+                        help="Vertices per path, before splitting at the antimeridian.")
+    parser.add_argument('--band', dest='bands', type=int, action='append',
+                        help="Only load this band, e.g. 14. May be repeated.")
+    parser.add_argument('--start', type=spot_filters.parse_time,
+                        help="Only load spots from this time on. Epoch seconds or a UTC date/time.")
+    parser.add_argument('--end', type=spot_filters.parse_time,
+                        help="Only load spots before this time. Epoch seconds or a UTC date/time.")
+    parser.add_argument('--rx-call', dest='rx_calls', action='append',
+                        help="Only load spots heard by this callsign. Wildcards allowed, e.g. 'K1*'. May be repeated.")
+    parser.add_argument('--tx-call', dest='tx_calls', action='append',
+                        help="Only load spots sent by this callsign. Wildcards allowed. May be repeated.")
+    parser.add_argument('--bbox', type=spot_filters.parse_bbox,
+                        help="Only load spots with either end inside west,south,east,north (degrees).")
+    parser.add_argument('--grid-prefix', dest='grid_prefixes', action='append',
+                        help="Only load spots with either end's grid starting with this, e.g. JO. May be repeated.")
+    parser.add_argument('--after-spot-id', type=int,
+                        help="Only load spots with a higher spot_id, e.g. the last one already loaded.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of processes loading in parallel, each with its own DB connection. Large "
+                             "files are split into one byte range per worker.")
+    metrics.add_arguments(parser)
+
+    return parser.parse_args()
 
 
 def main():
-    root_path = input("WSPR CSV root path: ")
-    csv_processor(root_path)
+    args = parse_args()
+    root_path = args.root_path or input("WSPR CSV root path: ")
+    filters = spot_filters.build_filters(args.bands, args.start, args.end, args.rx_calls, args.tx_calls, args.bbox,
+                                         args.grid_prefixes, args.after_spot_id)
+    metrics.configure(args.metrics_jsonl, args.metrics_prom)
+    with metrics.profile(args.profile):
+        csv_processor(root_path, args.mode, args.chunksize, args.workers, args.fresh_partitions, args.engine,
+                      args.max_memory, filters, args.path_vertices if args.paths else None)
+    metrics.write_prometheus()
 
 
 if __name__ == '__main__':
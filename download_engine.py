@@ -0,0 +1,319 @@
+"""
+Download archives concurrently, resuming partial files.
+
+Files are fetched by a bounded pool of threads, with at most a few transfers open to any one host. Each file is
+written to a .part file next to its destination and only renamed once its size matches the Content-Length the
+server sent, so an interrupted download is never mistaken for a complete one. A .part file left by an earlier run
+is resumed with an HTTP Range request, made conditional with If-Range on the ETag or Last-Modified the file was
+first sent with, so a file that has changed since is downloaded again rather than appended to. Failed transfers,
+and servers answering 429 or 5xx, are retried with exponential backoff.
+"""
+
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+
+import requests
+import urllib3
+
+import metrics
+
+default_workers = 4
+default_per_host = 2
+default_retries = 5
+
+# Seconds before the first retry, doubled on each further attempt up to max_backoff
+base_backoff = 1.0
+max_backoff = 60.0
+
+block_bytes = 1024 * 1024
+timeout = 60
+
+retry_statuses = {429, 500, 502, 503, 504}
+
+host_limits = {}
+host_limits_lock = threading.Lock()
+
+
+class DownloadError(Exception):
+    """
+    A file could not be downloaded completely.
+    """
+
+
+def host_semaphore(url, per_host):
+    """
+    Gets the semaphore that limits concurrent transfers to a URL's host.
+    :param url: URL being downloaded.
+    :param per_host: Maximum concurrent transfers per host.
+    :return: threading.Semaphore shared by all transfers to the host.
+    """
+
+    host = urlsplit(url).netloc
+    with host_limits_lock:
+        if host not in host_limits:
+            host_limits[host] = threading.Semaphore(per_host)
+
+        return host_limits[host]
+
+
+def part_path(path):
+    """
+    Gets the path a download is written to until it is complete.
+    :param path: Destination path.
+    :return: Path of the .part file.
+    """
+
+    return f"{path}.part"
+
+
+def validator_path(path):
+    """
+    Gets the path the ETag or Last-Modified of a .part file's download is kept in.
+    :param path: Destination path.
+    :return: Path of the validator file.
+    """
+
+    return f"{part_path(path)}.validator"
+
+
+def response_validator(response):
+    """
+    Gets the value to send as If-Range when resuming a download.
+    :param response: requests Response the download started with.
+    :return: Strong ETag, or Last-Modified, or None if the server sent neither.
+    """
+
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):  # Weak ETags cannot be used with If-Range
+        return etag
+
+    return response.headers.get('Last-Modified')
+
+
+def read_validator(path):
+    """
+    Reads the validator stored for a .part file.
+    :param path: Destination path.
+    :return: String, or None if there is none.
+    """
+
+    try:
+        with open(validator_path(path)) as validator_file:
+            return validator_file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def discard_part(path):
+    """
+    Deletes a .part file and its validator, so the download starts from scratch.
+    :param path: Destination path.
+    """
+
+    for stale in (part_path(path), validator_path(path)):
+        if os.path.exists(stale):
+            os.remove(stale)
+
+
+def range_total(response):
+    """
+    Gets the full size of a file from the Content-Range header of a 206 or 416 response.
+    :param response: requests Response.
+    :return: File size in bytes, or None if the header has none.
+    """
+
+    content_range = response.headers.get('Content-Range')
+    if content_range and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        if total.isdigit():
+            return int(total)
+
+    return None
+
+
+def range_start(response):
+    """
+    Gets the first byte of the content of a 206 response.
+    :param response: requests Response.
+    :return: Byte offset, or None if the Content-Range header has none.
+    """
+
+    content_range = response.headers.get('Content-Range', '')
+    start = content_range.removeprefix('bytes ').split('-', 1)[0].strip()
+
+    return int(start) if start.isdigit() else None
+
+
+def expected_size(response, offset):
+    """
+    Works out the full size of a file from a response.
+    :param response: requests Response.
+    :param offset: Bytes already downloaded, if the response is partial content.
+    :return: File size in bytes, or None if the server did not say.
+    """
+
+    if response.status_code == 206 and range_total(response) is not None:
+        return range_total(response)
+
+    content_length = response.headers.get('Content-Length')
+    if content_length is None or not content_length.isdigit():
+        return None
+
+    return int(content_length) + (offset if response.status_code == 206 else 0)
+
+
+def backoff_delay(attempt, response=None):
+    """
+    Gets how long to wait before retrying, honouring Retry-After if the server sent it.
+    :param attempt: Number of attempts made so far.
+    :param response: Response that failed, if there was one.
+    :return: Delay in seconds.
+    """
+
+    retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+    if retry_after.isdigit():
+        return min(float(retry_after), max_backoff)
+
+    delay = min(base_backoff * 2 ** (attempt - 1), max_backoff)
+
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def fetch(url, path, progress=None):
+    """
+    Makes one attempt at downloading a file, resuming its .part file if there is one. A .part file is only resumed
+    if the server can tell whether the file has changed since, and is discarded if it does not match the file.
+    :param url: URL to download.
+    :param path: Destination path.
+    :param progress: Optional callable taking the URL and the bytes downloaded so far.
+    :return: Tuple of the response, and True if the file is complete.
+    """
+
+    part = part_path(path)
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    validator = read_validator(path) if offset else None
+    if offset and validator is None:  # Left by a run that could not tell if the file changes
+        discard_part(path)
+        offset = 0
+    headers = {'Range': f"bytes={offset}-", 'If-Range': validator} if offset else {}
+
+    with requests.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 416:  # The .part file may already hold the whole file
+            total = range_total(response)
+            if total == offset:
+                return response, True
+            discard_part(path)
+            raise DownloadError(f"{url} is {total} bytes, not the {offset} already downloaded. Starting again")
+        if response.status_code not in (200, 206):
+            return response, False
+
+        if response.status_code == 206 and range_start(response) != offset:
+            discard_part(path)
+            raise DownloadError(f"{url} resumed at byte {range_start(response)}, not {offset}. Starting again")
+
+        if response.status_code == 200:  # No .part file, Range not supported, or the file changed: start again
+            offset = 0
+            with open(validator_path(path), 'w') as validator_file:
+                validator_file.write(response_validator(response) or '')
+        size = expected_size(response, offset)
+
+        # Saved as sent, without undoing any Content-Encoding, as that is what Content-Length and Content-Range count
+        with open(part, 'ab' if offset else 'wb') as part_file:
+            try:
+                for block in response.raw.stream(block_bytes, decode_content=False):
+                    part_file.write(block)
+                    offset += len(block)
+                    metrics.count('bytes_downloaded', len(block))
+                    if progress is not None:
+                        progress(url, offset)
+            except urllib3.exceptions.HTTPError as e:  # Dropped connections; what was written is resumed
+                raise DownloadError(f"{url} stopped at {offset} bytes: {e!r}") from e
+
+    if size is not None and offset != size:
+        raise DownloadError(f"{url} stopped at {offset} of {size} bytes")
+
+    return response, True
+
+
+def download_file(url, path, per_host=default_per_host, retries=default_retries, progress=None):
+    """
+    Downloads a file, resuming and retrying until it is complete.
+    :param url: URL to download.
+    :param path: Destination path. Nothing is written there until the download is complete.
+    :param per_host: Maximum concurrent transfers to the URL's host.
+    :param retries: Attempts to make before giving up.
+    :param progress: Optional callable taking the URL and the bytes downloaded so far.
+    :return: Destination path.
+    """
+
+    if os.path.exists(path):
+        return path
+
+    for attempt in range(1, retries + 1):
+        response = None
+        try:
+            with host_semaphore(url, per_host), metrics.timer('download'):
+                response, complete = fetch(url, path, progress)
+        except (requests.RequestException, DownloadError) as e:
+            error = e
+        else:
+            if complete:
+                os.replace(part_path(path), path)
+                discard_part(path)
+                metrics.count('files_downloaded')
+                return path
+
+            error = DownloadError(f"{url} returned HTTP {response.status_code}")
+            if response.status_code not in retry_statuses:
+                raise error
+
+        metrics.count('download_failed_attempts')
+        if attempt < retries:
+            delay = backoff_delay(attempt, response)
+            print(f"Download of {url} failed ({error}). Retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+    raise DownloadError(f"Gave up on {url} after {retries} attempts") from error
+
+
+def download_all(urls, directory, workers=default_workers, per_host=default_per_host, retries=default_retries,
+                 progress=None):
+    """
+    Downloads files concurrently into a directory, named after the last part of their URL.
+    :param urls: Iterable of URLs.
+    :param directory: Directory to download into. Created if missing.
+    :param workers: Maximum concurrent transfers.
+    :param per_host: Maximum concurrent transfers to any one host.
+    :param retries: Attempts to make per file before giving up.
+    :param progress: Optional callable taking a URL and the bytes downloaded so far. Called from the worker
+    threads.
+    :return: Tuple of a dict of URL to downloaded path, and a dict of URL to the exception for files that failed.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+
+    downloaded = {}
+    failed = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(download_file, url, os.path.join(directory, os.path.basename(urlsplit(url).path)),
+                                   per_host, retries, progress): url
+                   for url in urls}
+
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                downloaded[url] = future.result()
+            except Exception as e:
+                print(f"Failed to download {url}: {e!r}")
+                failed[url] = e
+                continue
+
+            print(f"Downloaded {url}")
+            metrics.emit('download', url=url, path=downloaded[url], bytes=os.path.getsize(downloaded[url]))
+
+    return downloaded, failed
@@ -1,16 +1,27 @@
+import argparse
 import gzip
+import json
 import os
 import re
 import shutil
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
 from bs4 import BeautifulSoup
 
+import download_engine
+import metrics
+import spot_filters
+
 """
 Downloads and extracts WSPR data from the internet.
 """
 
+manifest_filename = 'manifest.json'
+
+# Response headers that tell whether an archive has changed since it was downloaded
+validator_headers = {'etag': 'ETag', 'last_modified': 'Last-Modified', 'size': 'Content-Length'}
+
 
 def get_download_urls():
     """
@@ -73,16 +84,20 @@ def extract_gzip(input_file, output_path):
     """
 
     print(f"Extracting {input_file} to {output_path}")
-    with gzip.open(input_file, 'rb') as f_in:
-        with open(output_path, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
+    with metrics.timer('extract'):
+        with gzip.open(input_file, 'rb') as f_in:
+            with open(output_path, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+    metrics.count('bytes_decompressed', os.path.getsize(output_path))
     os.remove(input_file)
 
 
-def download_wspr_data(wanted_urls):
+def download_wspr_data(wanted_urls, workers=download_engine.default_workers, extract=True):
     """
-    Download selected URLs
+    Download selected URLs concurrently, then extract them. Partly downloaded files are resumed.
     :param wanted_urls: List containing selected URLs
+    :param workers: Maximum concurrent downloads
+    :param extract: Extract the downloaded files. csv_to_pg.py can load the .csv.gz files as they are
     :return:
     """
 
@@ -90,40 +105,247 @@ def download_wspr_data(wanted_urls):
     if not os.path.exists(download_directory):
         os.makedirs(download_directory)
 
+    to_download = []
     for download_file in wanted_urls:
-        print(f"Downloading {download_file}")
         filename = os.path.basename(download_file)
         extracted_filename = os.path.splitext(filename)[0]
         download_path = os.path.join(download_directory, filename)
         output_path = os.path.join(download_directory, extracted_filename)
 
-        if not os.path.exists(download_path) and not os.path.exists(output_path):  # Download & extract
-            urllib.request.urlretrieve(download_file, filename=download_path)
-            extract_gzip(download_path, output_path)
-
-        elif os.path.exists(download_path) and not os.path.exists(output_path):  # Already downloaded - extract
-            extract_gzip(download_path, output_path)
-
-        elif os.path.exists(output_path) and os.path.exists(download_path):  # Remove compressed file
+        if os.path.exists(output_path) and os.path.exists(download_path):  # Remove compressed file
             print("Both compressed file & CSV file exist. Removing compressed file")
             os.remove(download_path)
 
         # File has previously been processed. Continue, doing nothing in this iteration
-        elif os.path.exists(output_path) and not os.path.exists(download_path):
+        elif os.path.exists(output_path):
             print(f"{output_path} already exists. Skipping.")
 
+        else:  # Download (or resume) & extract. Complete downloads are not fetched again
+            to_download.append(download_file)
+
+    downloaded, failed = download_engine.download_all(to_download, download_directory, workers)
+
+    for download_file in to_download:
+        if extract and download_file in downloaded:
+            download_path = downloaded[download_file]
+            extract_gzip(download_path, os.path.splitext(download_path)[0])
+
+    if failed:
+        print(f"{len(failed)} file(s) failed to download and can be resumed by running again:")
+        for download_file in failed:
+            print(f"\t{download_file}")
+
     print("Downloading complete")
 
 
+def load_manifest(manifest_path):
+    """
+    Reads the sync manifest
+    :param manifest_path: Path to the manifest JSON file
+    :return: Dict of URL to archive state. Empty if there is no manifest yet
+    """
+
+    try:
+        with open(manifest_path) as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(manifest_path, manifest):
+    """
+    Writes the sync manifest, replacing the old one only once the new one is complete
+    :param manifest_path: Path to the manifest JSON file
+    :param manifest: Dict of URL to archive state
+    :return: None
+    """
+
+    with open(f"{manifest_path}.tmp", 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+
+def remote_state(url):
+    """
+    Asks the server for the ETag, Last-Modified and size of an archive without downloading it
+    :param url: Archive URL
+    :return: Dict with etag, last_modified and size. Values the server does not send are None
+    """
+
+    response = requests.head(url, allow_redirects=True, timeout=60)
+    response.raise_for_status()
+
+    return {key: response.headers.get(header) for key, header in validator_headers.items()}
+
+
+def remote_states(urls, workers=download_engine.default_workers, per_host=download_engine.default_per_host):
+    """
+    Asks for the state of many archives at once, within the download engine's limits per host. An archive whose
+    request fails is reported and left out, so one missing or broken archive does not stop a sync
+    :param urls: Archive URLs
+    :param workers: Maximum concurrent requests
+    :param per_host: Maximum concurrent requests to any one host
+    :return: Dict of URL to remote_state() dict, for the archives that answered
+    """
+
+    def check(url):
+        with download_engine.host_semaphore(url, per_host):
+            return remote_state(url)
+
+    states = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(check, url): url for url in urls}
+
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                states[url] = future.result()
+            except requests.RequestException as e:
+                print(f"Skipping {url}, could not check it for changes: {e!r}")
+                metrics.count('sync_checks_failed')
+
+    return states
+
+
+def archive_month(url):
+    """
+    Gets the month an archive covers from its file name, e.g. wsprspots-2020-01.csv.gz
+    :param url: Archive URL
+    :return: (year, month) tuple, or None if the name has no month
+    """
+
+    match = re.search(r"(\d{4})-(\d{2})\.csv", os.path.basename(url))
+
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+def load_archive(path, entry):
+    """
+    Loads an archive into the database, skipping spots up to the high-water mark recorded for it, so a
+    re-downloaded current month only loads its new spots. Records the new high-water mark in the entry
+    :param path: Path to the downloaded .csv.gz archive
+    :param entry: Manifest entry for the archive. Updated in place
+    :return: True if the archive was loaded completely
+    """
+
+    import csv_to_pg  # Only needed, with its dependencies, when loading
+
+    filters = spot_filters.build_filters(after_spot_id=entry.get('high_water'))
+    csv_to_pg.csv_processor(path, filters=filters)
+
+    if csv_to_pg.plan_ranges(path, 1, filters):
+        return False
+
+    month = archive_month(path)
+    if month is not None:
+        entry['high_water'] = csv_to_pg.high_water_mark(month)
+
+    return True
+
+
+def sync(download_directory, manifest_path=None, load=False, workers=download_engine.default_workers):
+    """
+    Downloads archives that are new or have changed since the last sync, without asking. The manifest records
+    each archive's ETag, Last-Modified and size, and with load=True the highest spot_id loaded from it
+    :param download_directory: Directory archives are kept in. They are not extracted
+    :param manifest_path: Path to the manifest JSON file. Defaults to manifest.json in the download directory
+    :param load: Load changed archives into the database with csv_to_pg.py
+    :param workers: Maximum concurrent downloads
+    :return: None
+    """
+
+    manifest_path = manifest_path or os.path.join(download_directory, manifest_filename)
+    manifest = load_manifest(manifest_path)
+    os.makedirs(download_directory, exist_ok=True)
+
+    urls = get_download_urls()
+    states = remote_states(urls, workers)
+    for url in urls:
+        if url not in states:  # Left as it is until it can be checked again
+            continue
+
+        entry = manifest.get(url, {})
+        path = os.path.join(download_directory, os.path.basename(url))
+
+        if os.path.exists(path) and all(entry.get(key) == value for key, value in states[url].items()):
+            continue
+
+        # The archive has changed, so neither the old file nor a partial download of it can be reused
+        if entry.get('downloaded') != states[url]:
+            if os.path.exists(path):
+                os.remove(path)
+            download_engine.discard_part(path)
+
+        entry['downloaded'] = states[url]
+        manifest[url] = entry
+
+    save_manifest(manifest_path, manifest)
+
+    to_download = [url for url, entry in manifest.items()
+                   if url in states and not os.path.exists(os.path.join(download_directory, os.path.basename(url)))]
+    print(f"{len(to_download)} new or changed archive(s) to download")
+    downloaded, _ = download_engine.download_all(to_download, download_directory, workers)
+
+    for url, path in downloaded.items():
+        manifest[url].update(states[url], path=path)
+        save_manifest(manifest_path, manifest)
+
+    if not load:
+        return
+
+    for url, entry in sorted(manifest.items()):
+        if 'path' not in entry or entry.get('loaded') == entry['downloaded'] or not os.path.exists(entry['path']):
+            continue
+
+        print(f"Loading {entry['path']} from spot_id {entry.get('high_water') or 0}")
+        if load_archive(entry['path'], entry):
+            entry['loaded'] = entry['downloaded']
+            save_manifest(manifest_path, manifest)
+
+
+def parse_args():
+    """
+    Parse command line arguments.
+    :return: argparse Namespace.
+    """
+
+    parser = argparse.ArgumentParser(description="Download WSPR archives.")
+    parser.add_argument('mode', nargs='?', choices=('menu', 'sync'), default='menu',
+                        help="menu asks which archives to download; sync downloads every new or changed archive "
+                             "without asking.")
+    parser.add_argument('--directory', help="Download directory for sync.")
+    parser.add_argument('--manifest', help="Sync manifest path. Defaults to manifest.json in the download "
+                                           "directory.")
+    parser.add_argument('--load', action='store_true',
+                        help="After syncing, load changed archives into the database, skipping spots that are "
+                             "already loaded.")
+    parser.add_argument('--workers', type=int, default=download_engine.default_workers,
+                        help="Maximum concurrent downloads.")
+    metrics.add_arguments(parser)
+
+    return parser.parse_args()
+
+
 def main():
     """
     Runs the thing
     :return:
     """
 
-    file_urls = get_download_urls()
-    wanted_urls = download_menu(file_urls)
-    download_wspr_data(wanted_urls)
+    args = parse_args()
+    metrics.configure(args.metrics_jsonl, args.metrics_prom)
+
+    with metrics.profile(args.profile):
+        if args.mode == 'sync':
+            sync(args.directory or input("Enter download directory: "), args.manifest, args.load, args.workers)
+        else:
+            file_urls = get_download_urls()
+            wanted_urls = download_menu(file_urls)
+            extract = input("Extract the downloaded files? csv_to_pg.py can load them compressed [Y/n]: ")
+            download_wspr_data(wanted_urls, args.workers, extract.strip().lower() not in ('n', 'no'))
+
+    metrics.write_prometheus()
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Encode geometries as hex EWKB in NumPy, a whole array of them at a time.
+
+Geometries of the same type and size are laid out as a structured array whose bytes are their little endian EWKB,
+so filling in its fields builds every geometry at once, and the bytes are then hex encoded together. PostGIS accepts
+hex EWKB as the text form of a geometry, e.g. in a COPY.
+"""
+
+import numpy as np
+
+srid = 4326
+
+# WKB geometry types
+line_string = 2
+polygon = 3
+multi_line_string = 5
+
+# Set on the geometry type of a geometry that is followed by its SRID
+srid_flag = 0x20000000
+
+# Hex digits of every byte value, to hex encode a whole array of geometries at once
+hex_digits = np.array([f'{byte:02x}'.encode() for byte in range(256)], dtype='S2')
+
+
+def geometries(n, geometry_type, fields):
+    """
+    Allocates geometries laid out as EWKB, with the byte order, type and SRID of each filled in.
+    :param n: Number of geometries.
+    :param geometry_type: WKB geometry type, e.g. polygon.
+    :param fields: List of the structured array fields that follow the SRID, in WKB order.
+    :return: Structured array of n geometries.
+    """
+
+    encoded = np.zeros(n, dtype=[('order', 'u1'), ('type', '<u4'), ('srid', '<u4')] + fields)
+    encoded['order'] = 1  # Little endian
+    encoded['type'] = geometry_type | srid_flag
+    encoded['srid'] = srid
+
+    return encoded
+
+
+def to_hex(encoded):
+    """
+    Hex encodes geometries laid out as EWKB.
+    :param encoded: Structured array from geometries().
+    :return: Array of hex strings.
+    """
+
+    raw = encoded.view(np.uint8).reshape(len(encoded), encoded.dtype.itemsize)
+
+    return hex_digits[raw].view(f'S{2 * raw.shape[1]}').ravel().astype(str)
@@ -0,0 +1,161 @@
+"""
+Build great-circle paths between points as PostGIS geometries without touching the database.
+
+Each path is densified into a fixed number of vertices spaced evenly along the great circle, so that it draws as a
+curve in lon/lat. A path that crosses the antimeridian is split there into two parts, each ending exactly on
++/-180 degrees, so it never wraps around the map. Paths are encoded as hex EWKB MultiLineStrings in EPSG:4326,
+see ewkb.py. Every function takes NumPy arrays (or any sequences) of coordinates and handles them in one pass.
+"""
+
+import numpy as np
+
+import ewkb
+import maidenhead
+
+default_vertices = 32
+
+
+def _unit_vectors(lon, lat):
+    """
+    Converts lon/lat in degrees into unit vectors.
+    :return: (n, 3) array.
+    """
+
+    lon, lat = np.radians(lon), np.radians(lat)
+
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+def interpolate(lon1, lat1, lon2, lat2, vertices=default_vertices):
+    """
+    Densifies great-circle paths.
+    :param lon1: Start longitudes in degrees.
+    :param lat1: Start latitudes in degrees.
+    :param lon2: End longitudes in degrees.
+    :param lat2: End latitudes in degrees.
+    :param vertices: Vertices per path, including both ends. At least 2.
+    :return: Tuple of (n, vertices) lon and lat arrays in degrees. Paths with missing or antipodal ends, which
+    have no single great circle, are NaN.
+    """
+
+    start = _unit_vectors(np.asarray(lon1, dtype=float), np.asarray(lat1, dtype=float))
+    end = _unit_vectors(np.asarray(lon2, dtype=float), np.asarray(lat2, dtype=float))
+
+    # Spherical linear interpolation, falling back to linear for points too close to tell apart
+    angle = np.arccos(np.clip((start * end).sum(axis=-1), -1.0, 1.0))[:, np.newaxis]
+    fraction = np.linspace(0.0, 1.0, vertices)[np.newaxis, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sin_angle = np.sin(angle)
+        close = sin_angle < 1e-12
+        start_weight = np.where(close, 1.0 - fraction, np.sin((1.0 - fraction) * angle) / sin_angle)
+        end_weight = np.where(close, fraction, np.sin(fraction * angle) / sin_angle)
+    points = (start_weight[..., np.newaxis] * start[:, np.newaxis, :]
+              + end_weight[..., np.newaxis] * end[:, np.newaxis, :])
+
+    lon = np.degrees(np.arctan2(points[..., 1], points[..., 0]))
+    lat = np.degrees(np.arctan2(points[..., 2], np.hypot(points[..., 0], points[..., 1])))
+
+    antipodal = (np.pi - angle[:, 0]) < 1e-9
+    lon[antipodal] = np.nan
+    lat[antipodal] = np.nan
+
+    return lon, lat
+
+
+def antimeridian_crossings(lon, lat):
+    """
+    Finds where densified paths cross the antimeridian.
+    :param lon: (n, vertices) longitudes from interpolate().
+    :param lat: (n, vertices) latitudes from interpolate().
+    :return: Tuple of the index of the vertex before the crossing, -1 for paths that do not cross, and the
+    latitude of the crossing. A great-circle path shorter than half the globe crosses at most once.
+    """
+
+    jumps = np.abs(np.diff(lon, axis=1)) > 180.0
+    crosses = jumps.any(axis=1)
+    index = np.where(crosses, jumps.argmax(axis=1), -1)
+
+    # The crossing is where the path's great circle meets the plane of the antimeridian, y = 0 with x < 0
+    rows = np.flatnonzero(crosses)
+    before = _unit_vectors(lon[rows, index[rows]], lat[rows, index[rows]])
+    after = _unit_vectors(lon[rows, index[rows] + 1], lat[rows, index[rows] + 1])
+    normal = np.cross(before, after)
+    x, z = normal[:, 2], -normal[:, 0]
+    x, z = np.where(x > 0, -x, x), np.where(x > 0, -z, z)
+
+    latitude = np.full(len(lon), np.nan)
+    latitude[rows] = np.degrees(np.arctan2(z, -x))
+
+    return index, latitude
+
+
+def _ewkb_hex(parts):
+    """
+    Encodes MultiLineStrings that all have the same number of parts and vertices per part as hex EWKB.
+    :param parts: List of (n, vertices, 2) coordinate arrays, one per part.
+    :return: Array of n hex strings.
+    """
+
+    fields = [('parts', '<u4')]
+    for i, part in enumerate(parts):
+        fields += [(f'order{i}', 'u1'), (f'type{i}', '<u4'), (f'vertices{i}', '<u4'),
+                   (f'coordinates{i}', '<f8', part.shape[1:])]
+
+    geometries = ewkb.geometries(len(parts[0]), ewkb.multi_line_string, fields)
+    geometries['parts'] = len(parts)
+    for i, part in enumerate(parts):
+        geometries[f'order{i}'] = 1  # Little endian
+        geometries[f'type{i}'] = ewkb.line_string
+        geometries[f'vertices{i}'] = part.shape[1]
+        geometries[f'coordinates{i}'] = part
+
+    return ewkb.to_hex(geometries)
+
+
+def paths(lon1, lat1, lon2, lat2, vertices=default_vertices):
+    """
+    Builds great-circle paths as hex EWKB MultiLineStrings, split at the antimeridian.
+    :param lon1: Start longitudes in degrees.
+    :param lat1: Start latitudes in degrees.
+    :param lon2: End longitudes in degrees.
+    :param lat2: End latitudes in degrees.
+    :param vertices: Vertices per path before splitting, including both ends. At least 2.
+    :return: Object array of hex EWKB strings, None where a path has a missing or antipodal end.
+    """
+
+    lon, lat = interpolate(lon1, lat1, lon2, lat2, vertices)
+    coordinates = np.stack([lon, lat], axis=-1)
+    index, crossing = antimeridian_crossings(lon, lat)
+    is_valid = ~np.isnan(lon).any(axis=1)
+
+    encoded = np.full(len(lon), None, dtype=object)
+
+    rows = np.flatnonzero(is_valid & (index < 0))
+    if len(rows):
+        encoded[rows] = _ewkb_hex([coordinates[rows]])
+
+    # Split paths are grouped by where they cross, so each group's parts have the same number of vertices
+    for split in np.unique(index[is_valid & (index >= 0)]):
+        rows = np.flatnonzero(is_valid & (index == split))
+        side = np.where(lon[rows, split] > 0, 180.0, -180.0)[:, np.newaxis]
+        edge = np.stack([side, crossing[rows, np.newaxis]], axis=-1)
+        other_edge = np.stack([-side, crossing[rows, np.newaxis]], axis=-1)
+        encoded[rows] = _ewkb_hex([np.concatenate([coordinates[rows, :split + 1], edge], axis=1),
+                                   np.concatenate([other_edge, coordinates[rows, split + 1:]], axis=1)])
+
+    return encoded
+
+
+def grid_paths(tx_grids, rx_grids, vertices=default_vertices):
+    """
+    Builds great-circle paths between Maidenhead grid centroids, see paths().
+    :param tx_grids: Sequence of TX locator strings, where paths start.
+    :param rx_grids: Sequence of RX locator strings, where paths end.
+    :param vertices: Vertices per path before splitting.
+    :return: Object array of hex EWKB strings, None where either locator is invalid.
+    """
+
+    tx_lon, tx_lat, _ = maidenhead.decode(tx_grids)
+    rx_lon, rx_lat, _ = maidenhead.decode(rx_grids)
+
+    return paths(tx_lon, tx_lat, rx_lon, rx_lat, vertices)
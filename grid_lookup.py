@@ -0,0 +1,142 @@
+"""
+Map points to Maidenhead grids and subgrids in batch.
+
+Regular cells are computed arithmetically by maidenhead.encode(), with no database. Points can instead be matched
+against the polygons in wspr.maidenhead_grid or wspr.maidenhead_subgrid, e.g. when those were loaded from
+shapefiles whose cells are not exactly regular. The polygons are read once per process into an STRtree, and
+each batch of points is matched with one bulk tree query rather than an ST_Contains per point.
+
+Run as a script to add a locator column to a CSV file of points.
+"""
+
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+import shapely
+
+import maidenhead
+from wspr_pg_database import database
+
+# Polygon tables by locator length: (table, locator column)
+polygon_tables = {4: ('wspr.maidenhead_grid', 'grid'),
+                  6: ('wspr.maidenhead_subgrid', 'subgrid')}
+
+# Process-local polygon indexes: locator length -> (STRtree, array of locators)
+polygon_indexes = {}
+
+default_chunksize = 100000
+
+
+def load_index(length):
+    """
+    Reads the grid or subgrid polygons into an STRtree, once per process.
+    :param length: Locator length, 4 for grids or 6 for subgrids.
+    :return: Tuple of the STRtree and the array of the polygons' locators.
+    """
+
+    if length not in polygon_tables:
+        raise ValueError(f"There are polygons for locator lengths {tuple(polygon_tables)}, not {length}")
+
+    if length not in polygon_indexes:
+        table, column = polygon_tables[length]
+        connection = database.get_engine().raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                # geometry's text output is hex EWKB
+                cursor.execute(f"SELECT {column}, geom FROM {table} WHERE geom IS NOT NULL ORDER BY id")
+                rows = cursor.fetchall()
+        finally:
+            connection.close()
+
+        locators = np.array([locator for locator, _ in rows], dtype=str)
+        polygons = shapely.from_wkb([geom for _, geom in rows])
+        polygon_indexes[length] = (shapely.STRtree(polygons), locators)
+
+    return polygon_indexes[length]
+
+
+def lookup(lon, lat, length=6, polygons=False):
+    """
+    Maps points to the locators of the cells they fall in.
+    :param lon: Sequence of longitudes in degrees.
+    :param lat: Sequence of latitudes in degrees.
+    :param length: Locator length, 4, 6 or 8. Only 4 and 6 with polygons.
+    :param polygons: Match against the polygon tables instead of computing regular cells. A point on the edge of
+    several polygons gets the first loaded.
+    :return: Tuple of an array of locator strings and a validity mask. Locators are empty where a point is
+    missing, out of range, or in no polygon.
+    """
+
+    if not polygons:
+        return maidenhead.encode(lon, lat, length)
+
+    tree, locators = load_index(length)
+    points = shapely.points(np.asarray(lon, dtype=float), np.asarray(lat, dtype=float))
+    point_index, polygon_index = tree.query(points, predicate='intersects')
+
+    # Keep the first polygon of each point
+    order = np.lexsort((polygon_index, point_index))
+    point_index, polygon_index = point_index[order], polygon_index[order]
+    first = np.unique(point_index, return_index=True)[1]
+
+    matched = np.full(len(points), '', dtype=locators.dtype if len(locators) else str)
+    matched[point_index[first]] = locators[polygon_index[first]]
+
+    return matched, matched != ''
+
+
+def lookup_csv(input_file, output_file, lon_column, lat_column, length=6, polygons=False,
+               chunksize=default_chunksize, column='locator'):
+    """
+    Adds a locator column to a CSV file of points, a chunk at a time.
+    :param input_file: Path or file object of the CSV file, with a header.
+    :param output_file: Path or file object to write the CSV file with the locator column to.
+    :param lon_column: Name of the longitude column.
+    :param lat_column: Name of the latitude column.
+    :param length: Locator length, see lookup().
+    :param polygons: Match against the polygon tables, see lookup().
+    :param chunksize: Rows per chunk.
+    :param column: Name of the locator column to add.
+    :return: Tuple of the rows written and the rows that got a locator.
+    """
+
+    n_rows = n_located = 0
+    for chunk in pd.read_csv(input_file, chunksize=chunksize):
+        locators, is_valid = lookup(pd.to_numeric(chunk[lon_column], errors='coerce'),
+                                    pd.to_numeric(chunk[lat_column], errors='coerce'), length, polygons)
+        chunk[column] = locators
+        chunk.to_csv(output_file, header=n_rows == 0, index=False, mode='w' if n_rows == 0 else 'a')
+
+        n_rows += len(chunk)
+        n_located += int(is_valid.sum())
+
+    return n_rows, n_located
+
+
+def main():
+    """
+    Add locators to a CSV file of points from the command line.
+    """
+
+    parser = argparse.ArgumentParser(description="Add the Maidenhead locator of each point to a CSV file.")
+    parser.add_argument('input', help="CSV file of points, with a header.")
+    parser.add_argument('output', nargs='?', help="CSV file to write. Defaults to standard output.")
+    parser.add_argument('--lon-column', default='lon', help="Longitude column.")
+    parser.add_argument('--lat-column', default='lat', help="Latitude column.")
+    parser.add_argument('--precision', type=int, choices=(4, 6, 8), default=6, help="Locator length.")
+    parser.add_argument('--polygons', action='store_true',
+                        help="Match points against the wspr.maidenhead_grid/maidenhead_subgrid polygons instead of "
+                             "computing regular cells. Precision 4 or 6 only.")
+    parser.add_argument('--column', default='locator', help="Name of the locator column to add.")
+    parser.add_argument('--chunksize', type=int, default=default_chunksize, help="Rows read per chunk.")
+    args = parser.parse_args()
+
+    n_rows, n_located = lookup_csv(args.input, args.output or sys.stdout, args.lon_column, args.lat_column,
+                                   args.precision, args.polygons, args.chunksize, args.column)
+    print(f"Located {n_located} of {n_rows} points", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""
+Decode Maidenhead locators into coordinates without touching the database.
+
+Locators are decoded arithmetically from their characters: a field (2 letters, 20x10 degrees), a square
+(2 digits, 2x1 degrees), a subsquare (2 letters, 5x2.5 minutes) and an extended square (2 digits, 30x15
+seconds). 4-, 6- and 8-character locators are supported. Every function takes a NumPy array (or any
+sequence) of locator strings and decodes it in one pass; invalid locators are masked out. encode() does the
+reverse for arrays of coordinates, and squares() and subsquares() list locators, arithmetically in the same way.
+"""
+
+import numpy as np
+
+# Width of a cell in degrees of longitude, by locator length. Cells are half as tall as they are wide.
+cell_widths = {4: 2.0, 6: 2.0 / 24, 8: 2.0 / 240}
+
+
+def _codes(locators):
+    """
+    Converts locators into a (n, 8) array of lower case character codes.
+    :param locators: Sequence of locator strings.
+    :return: Tuple of the code array and the locator lengths.
+    """
+
+    locators = np.char.lower(np.char.strip(np.atleast_1d(np.asarray(locators, dtype=str))))
+    lengths = np.char.str_len(locators)
+    codes = locators.astype('<U8').view(np.uint32).reshape(-1, 8).astype(np.int64)
+
+    return codes, lengths
+
+
+def _in_range(codes, low, high):
+    """
+    Checks that character codes fall between two characters, inclusive.
+    """
+
+    return (codes >= ord(low)) & (codes <= ord(high))
+
+
+def _valid(codes, lengths):
+    """
+    Checks which locators are well-formed, given their character codes and lengths.
+    """
+
+    is_valid = np.isin(lengths, tuple(cell_widths))
+    is_valid &= _in_range(codes[:, 0:2], 'a', 'r').all(axis=1)
+    is_valid &= _in_range(codes[:, 2:4], '0', '9').all(axis=1)
+    is_valid &= (lengths < 6) | _in_range(codes[:, 4:6], 'a', 'x').all(axis=1)
+    is_valid &= (lengths < 8) | _in_range(codes[:, 6:8], '0', '9').all(axis=1)
+
+    return is_valid
+
+
+def valid(locators):
+    """
+    Checks which locators are well-formed.
+    :param locators: Sequence of locator strings.
+    :return: Boolean array, True where the locator can be decoded.
+    """
+
+    return _valid(*_codes(locators))
+
+
+def bounds(locators):
+    """
+    Decodes locators into cell bounding boxes.
+    :param locators: Sequence of locator strings.
+    :return: Tuple of west, south, east, north arrays in degrees and a validity mask. Bounds are NaN where the
+    locator is invalid.
+    """
+
+    codes, lengths = _codes(locators)
+    is_valid = _valid(codes, lengths)
+
+    has_subsquare = lengths >= 6
+    has_extended = lengths >= 8
+
+    west = (codes[:, 0] - ord('a')) * 20.0 + (codes[:, 2] - ord('0')) * 2.0
+    south = (codes[:, 1] - ord('a')) * 10.0 + (codes[:, 3] - ord('0')) * 1.0
+    west += np.where(has_subsquare, (codes[:, 4] - ord('a')) * (2.0 / 24), 0.0)
+    south += np.where(has_subsquare, (codes[:, 5] - ord('a')) * (1.0 / 24), 0.0)
+    west += np.where(has_extended, (codes[:, 6] - ord('0')) * (2.0 / 240), 0.0)
+    south += np.where(has_extended, (codes[:, 7] - ord('0')) * (1.0 / 240), 0.0)
+    west -= 180.0
+    south -= 90.0
+
+    width = np.select([lengths == length for length in cell_widths], list(cell_widths.values()), np.nan)
+
+    west = np.where(is_valid, west, np.nan)
+    south = np.where(is_valid, south, np.nan)
+    east = west + width
+    north = south + width / 2
+
+    return west, south, east, north, is_valid
+
+
+def decode(locators):
+    """
+    Decodes locators into cell centroids.
+    :param locators: Sequence of locator strings.
+    :return: Tuple of lon and lat arrays in degrees and a validity mask. Coordinates are NaN where the locator
+    is invalid.
+    """
+
+    west, south, east, north, is_valid = bounds(locators)
+
+    return (west + east) / 2, (south + north) / 2, is_valid
+
+
+def encode(lon, lat, length=6):
+    """
+    Encodes coordinates as the locators of the cells they fall in. Fields are in upper case and subsquares in
+    lower case. Points on a cell edge belong to the cell to their north and east, except on the east and north
+    edges of the map.
+    :param lon: Sequence of longitudes in degrees.
+    :param lat: Sequence of latitudes in degrees.
+    :param length: Locator length, 4, 6 or 8.
+    :return: Tuple of an array of locator strings and a validity mask. Locators are empty where a coordinate is
+    missing or out of range.
+    """
+
+    if length not in cell_widths:
+        raise ValueError(f"Locator length must be one of {tuple(cell_widths)}, got {length}")
+
+    lon = np.atleast_1d(np.asarray(lon, dtype=float))
+    lat = np.atleast_1d(np.asarray(lat, dtype=float))
+    is_valid = (lon >= -180.0) & (lon <= 180.0) & (lat >= -90.0) & (lat <= 90.0)
+
+    # Cell column and row at the requested precision; coarser characters are integer divisions of them. Edges
+    # decoded by bounds() can fall a rounding error short, so points within a billionth of a cell snap to them.
+    width = cell_widths[length]
+    n_cells = int(round(360.0 / width))
+    column = np.floor(np.where(is_valid, lon + 180.0, 0.0) / width + 1e-9)
+    row = np.floor(np.where(is_valid, lat + 90.0, 0.0) / (width / 2) + 1e-9)
+    column = np.clip(column, 0, n_cells - 1).astype(np.int64)
+    row = np.clip(row, 0, n_cells - 1).astype(np.int64)
+
+    # Cells per character, from the field down: 18 fields, 10 squares, 24 subsquares and 10 extended squares
+    divisions = [18, 10, 24, 10][:length // 2]
+    bases = [ord('A'), ord('0'), ord('a'), ord('0')]
+
+    codes = np.zeros((len(lon), length), dtype=np.uint8)
+    for position in range(length // 2 - 1, -1, -1):
+        division = divisions[position]
+        codes[:, 2 * position] = bases[position] + column % division
+        codes[:, 2 * position + 1] = bases[position] + row % division
+        column, row = column // division, row // division
+
+    locators = codes.view(f'S{length}').ravel().astype(str)
+
+    return np.where(is_valid, locators, ''), is_valid
+
+
+def centroid(locator):
+    """
+    Decodes a single locator into its centroid.
+    :param locator: Locator string.
+    :return: Lon/Lat tuple, or None if the locator is invalid.
+    """
+
+    lon, lat, is_valid = decode([locator])
+
+    if not is_valid[0]:
+        return None
+
+    return float(lon[0]), float(lat[0])
+
+
+def squares(bbox=None):
+    """
+    Lists the 4-character squares, in upper case. There are 32,400 in all.
+    :param bbox: Optional (west, south, east, north) in degrees. Only squares that overlap it are listed.
+    :return: Sorted array of locator strings.
+    """
+
+    columns, rows = np.arange(180), np.arange(180)
+    if bbox is not None:
+        west, south, east, north = bbox
+        columns = columns[(columns * 2.0 - 180.0 < east) & (columns * 2.0 - 178.0 > west)]
+        rows = rows[(rows - 90.0 < north) & (rows - 89.0 > south)]
+
+    column, row = (grid.ravel() for grid in np.meshgrid(columns, rows, indexing='ij'))
+    codes = np.stack([ord('A') + column // 10, ord('A') + row // 10, ord('0') + column % 10, ord('0') + row % 10],
+                     axis=1).astype(np.uint8)
+
+    return np.sort(codes.view('S4').ravel().astype(str))
+
+
+def subsquares(squares):
+    """
+    Lists the 6-character subsquares of squares, with the subsquare letters in lower case. Each square has 576.
+    :param squares: Sequence of 4-character locator strings.
+    :return: Array of locator strings, square by square, each square's subsquares sorted.
+    """
+
+    letters = np.array([chr(code) for code in range(ord('a'), ord('x') + 1)])
+    suffixes = np.char.add(np.repeat(letters, len(letters)), np.tile(letters, len(letters)))
+    squares = np.asarray(squares, dtype='<U4')
+
+    return np.char.add(np.repeat(squares, len(suffixes)), np.tile(suffixes, len(squares)))
@@ -1,28 +1,33 @@
+import argparse
 import os
 import pathlib
+from concurrent.futures import ProcessPoolExecutor
 
 import fiona
+import numpy as np
+import pandas as pd
+import shapely
 import shapely.ops
-from geoalchemy2.shape import from_shape
 from shapely.geometry import shape
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 
-import conf_reader
-from wspr_pg_database import Base, maidenhead_grid, maidenhead_subgrid
-
-db_user, db_pass, db_host, db_name = conf_reader.read_config()
-
-engine = create_engine(f'postgresql://{db_user}:{db_pass}@{db_host}/{db_name}')
-Base.metadata.bind = engine
-
-DBSession = sessionmaker(bind=engine)
-session = DBSession()
+import ewkb
+import maidenhead
+import metrics
+import pg_copy
+import spot_filters
+from wspr_pg_database import database
 
 """
-Load Maidenhead grid square shapefiles into PostGIS database.
+Load Maidenhead grid square shapefiles into PostGIS database, or generate the grid squares from the Maidenhead
+definition.
 """
 
+# Squares whose subgrids are generated and copied per transaction, 576 subgrids each
+default_batch_squares = 100
+
+# Shapefiles whose grids are copied per transaction
+default_batch_files = 50
+
 
 def list_shapefiles(input_path):
     """
@@ -43,92 +48,304 @@ def list_shapefiles(input_path):
 
 def read_shapefile(shp_path):
     """
-    Reads a shapefile located at shp_path.
+    Reads the subgrid polygons of a grid from its shapefile, named after the grid.
     :param shp_path: Path to shapefile.
-    :return: A list of Shapely geometries for polygons in shapefile.
+    :return: Tuple of the grid, a list of subgrid names, and an array of Shapely polygons.
+    """
+
+    grid = pathlib.Path(shp_path).stem
+    with fiona.open(shp_path) as polygons:
+        records = [(polygon['properties']['GridSquare'], shape(polygon['geometry'])) for polygon in polygons]
+
+    subgrids = [subgrid for subgrid, _ in records]
+    geometries = np.empty(len(records), dtype=object)
+    geometries[:] = [geometry for _, geometry in records]
+
+    return grid, subgrids, geometries
+
+
+def tiles_envelope(polygons):
+    """
+    Checks whether polygons are equal rectangles on a regular lattice, each in a cell of its own, that cover
+    their envelope with no gaps, so that their union is the envelope.
+    :param polygons: Array of Shapely polygons.
+    :return: True if the polygons tile their envelope exactly.
     """
-    polygon_list = []
-    polygons = fiona.open(shp_path)
 
-    for polygon in polygons:
-        grid = pathlib.Path(shp_path).stem
-        subgrid = polygon['properties']['GridSquare']
+    bounds = shapely.bounds(polygons)
+    widths, heights = bounds[:, 2] - bounds[:, 0], bounds[:, 3] - bounds[:, 1]
+    if not len(polygons) or not np.allclose(shapely.area(polygons), widths * heights):
+        return False  # Not all rectangles
+    if not (np.allclose(widths, widths[0]) and np.allclose(heights, heights[0])):
+        return False
 
-        shapely_shp = shape(polygon['geometry'])
-        # Get attributes from file
-        shapely_shp.grid = grid
-        shapely_shp.subgrid = subgrid
+    west, south = bounds[:, 0].min(), bounds[:, 1].min()
+    east, north = bounds[:, 2].max(), bounds[:, 3].max()
+    columns = (bounds[:, 0] - west) / widths[0]
+    rows = (bounds[:, 1] - south) / heights[0]
+    if not (np.allclose(columns, np.round(columns), atol=1e-6) and np.allclose(rows, np.round(rows), atol=1e-6)):
+        return False
 
-        polygon_list.append(shapely_shp)
+    n_cells = len(set(zip(np.round(columns).astype(int), np.round(rows).astype(int))))
 
-    return polygon_list
+    return n_cells == len(polygons) and np.isclose(n_cells * widths[0] * heights[0], (east - west) * (north - south))
 
 
 def dissolve_subgrids(grid_polygons):
     """
-    Dissolves subgrids within a grid to get main grid.
-    :param grid_polygons: List of polygons within grid.
+    Dissolves subgrids within a grid to get main grid. Subgrids that tile the grid exactly dissolve to their
+    envelope without a union.
+    :param grid_polygons: Array of polygons within grid.
     :return: Shapely geometry for larger main grid.
     """
 
-    dissolved_grid = shapely.ops.unary_union(grid_polygons)
-    dissolved_grid.grid = grid_polygons[0].grid
+    if tiles_envelope(grid_polygons):
+        metrics.count('envelope_dissolves')
+        return shapely.box(*shapely.total_bounds(grid_polygons))
 
-    return dissolved_grid
+    return shapely.ops.unary_union(grid_polygons)
 
 
-def write_grid_to_db(grid):
+def load_shapefile(shp_path):
     """
-    Writes grid  to PostgreSQL database.
-    :param grid: Shapely geometry for grid.
+    Reads a grid's shapefile, dissolves its grid and encodes the polygons for COPY.
+    :param shp_path: Path to shapefile.
+    :return: Tuple of the path, the grid, its hex EWKB polygon, a list of subgrid names and an array of their hex
+    EWKB polygons.
     """
 
-    print(f"Writing {grid.grid}")
-    db_grid = maidenhead_grid(
-        grid=grid.grid,
-        geom=from_shape(grid, srid=4326)
-    )
+    with metrics.timer('read_shapefile'):
+        grid, subgrids, polygons = read_shapefile(shp_path)
+    with metrics.timer('dissolve'):
+        dissolved = dissolve_subgrids(polygons)
+    with metrics.timer('encode'):
+        encoded = shapely.to_wkb(shapely.set_srid(np.append(polygons, dissolved), ewkb.srid), hex=True,
+                                 include_srid=True)
 
-    session.add(db_grid)
-    session.commit()
+    return shp_path, grid, encoded[-1], subgrids, encoded[:-1]
 
 
-def write_subgrid_to_db(subgrid):
+def init_worker():
     """
-    Writes subgrid to PostgreSQL database.
-    :param subgrid: Shapely geometry for subgrid.
+    Starts a shapefile reading process with no metrics.
     """
 
-    for grid in subgrid:
-        print(f"Writing {grid.grid}{grid.subgrid}")
-        db_subgrid = maidenhead_subgrid(
-            grid=grid.grid,
-            subgrid=grid.subgrid,
-            geom=from_shape(grid, srid=4326)
-        )
+    metrics.take()  # Totals inherited from the parent are the parent's to report
 
-        session.add(db_subgrid)
-    session.commit()
 
+def run_task(shp_path):
+    """
+    Loads a shapefile in a worker process and hands its metrics back with the result.
+    :param shp_path: Path to shapefile.
+    :return: Tuple of the load_shapefile() result and the worker's metrics from metrics.take().
+    """
 
-def main():
+    return load_shapefile(shp_path), metrics.take()
+
+
+def write_grids(connection, loaded):
     """
-    Run the script.
+    Copies the grids and subgrids of a batch of shapefiles in one transaction.
+    :param connection: psycopg2 connection.
+    :param loaded: List of load_shapefile() results.
+    """
+
+    grids = pd.DataFrame([(grid, grid_geom) for _, grid, grid_geom, _, _ in loaded], columns=['grid', 'geom'])
+    subgrids = pd.DataFrame({'grid': np.repeat([grid for _, grid, _, _, _ in loaded],
+                                               [len(names) for _, _, _, names, _ in loaded]),
+                             'subgrid': [name for _, _, _, names, _ in loaded for name in names],
+                             'geom': np.concatenate([geoms for _, _, _, _, geoms in loaded])})
+
+    with connection.cursor() as cursor:
+        with metrics.timer('write_grid'):
+            pg_copy.copy_frame(cursor, 'wspr.maidenhead_grid', ('grid', 'geom'), grids)
+        with metrics.timer('write_subgrids'):
+            pg_copy.copy_frame(cursor, 'wspr.maidenhead_subgrid', ('grid', 'subgrid', 'geom'), subgrids)
+    connection.commit()
+    metrics.count('grids_written', len(grids))
+    metrics.count('subgrids_written', len(subgrids))
+
+    print(f"Wrote {', '.join(grids['grid'])}")
+
+
+def load_shapefiles(root_path, workers=None, batch_files=default_batch_files):
+    """
+    Loads every grid shapefile under a path whose grid is not in maidenhead_grid yet. Shapefiles are read and
+    dissolved by a pool of processes, and a batch's grids and subgrids are copied while the pool reads the
+    next batch.
+    :param root_path: Path to search for shapefiles.
+    :param workers: Number of processes reading shapefiles. Defaults to one per core.
+    :param batch_files: Shapefiles per batch.
+    """
+
+    workers = workers or os.cpu_count()
+
+    connection = database.get_engine().raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT upper(grid) FROM wspr.maidenhead_grid")
+            existing = {grid for grid, in cursor.fetchall()}
+
+        shape_paths = list_shapefiles(root_path)
+        pending = [shp for shp in shape_paths if pathlib.Path(shp).stem.upper() not in existing]
+        print(f"{len(shape_paths) - len(pending)} grids already exist in DB. Skipping them.")
+        metrics.count('grids_skipped', len(shape_paths) - len(pending))
+        batches = [pending[i:i + batch_files] for i in range(0, len(pending), batch_files)]
+
+        def emit(result, grid_metrics):
+            metrics.emit('grid', path=result[0], grid=result[1], **grid_metrics)
+
+        if workers == 1:
+            for batch in batches:
+                loaded = []
+                for shp in batch:
+                    before = metrics.snapshot()
+                    loaded.append(load_shapefile(shp))
+                    emit(loaded[-1], metrics.since(before))
+                write_grids(connection, loaded)
+            return
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+            futures = [executor.submit(run_task, shp) for shp in batches[0]] if batches else []
+            for i in range(len(batches)):
+                loaded = []
+                for future in futures:
+                    result, worker_metrics = future.result()
+                    before = metrics.snapshot()
+                    metrics.merge(worker_metrics)
+                    emit(result, metrics.since(before))
+                    loaded.append(result)
+
+                futures = [executor.submit(run_task, shp) for shp in batches[i + 1]] if i + 1 < len(batches) else []
+                write_grids(connection, loaded)
+    finally:
+        connection.close()
+
+
+def polygons_ewkb(locators):
+    """
+    Builds the polygons of Maidenhead cells as hex EWKB, without a round trip per polygon.
+    :param locators: Sequence of valid locator strings.
+    :return: Array of hex EWKB polygon strings in EPSG:4326.
     """
-    maidenhead_grid_root_path = input("Maidenhead grid root path: ")
-    shape_paths = list_shapefiles(maidenhead_grid_root_path)
 
-    for shp in shape_paths:
-        subgrid = read_shapefile(shp)
-        grid = dissolve_subgrids(subgrid)
+    west, south, east, north, _ = maidenhead.bounds(locators)
 
-        query_result = session.query(maidenhead_grid.id).filter_by(grid=grid.grid).first()
+    polygons = ewkb.geometries(len(west), ewkb.polygon,
+                               [('rings', '<u4'), ('vertices', '<u4'), ('coordinates', '<f8', (5, 2))])
+    polygons['rings'] = 1
+    polygons['vertices'] = 5
+    polygons['coordinates'] = np.stack([np.stack([west, east, east, west, west], axis=1),
+                                        np.stack([south, south, north, north, south], axis=1)], axis=2)
 
-        if not query_result:
-            write_grid_to_db(grid)
-            write_subgrid_to_db(subgrid)
-        else:
-            print(f"{grid.grid} already exists in DB. Skipping.")
+    return ewkb.to_hex(polygons)
+
+
+def generate_grids(connection):
+    """
+    Generates the polygons of the 4-character squares missing from maidenhead_grid and copies them in.
+    :param connection: psycopg2 connection.
+    :return: Number of squares written.
+    """
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT upper(grid) FROM wspr.maidenhead_grid")
+        existing = [grid for grid, in cursor.fetchall()]
+
+        with metrics.timer('generate'):
+            squares = maidenhead.squares()
+            squares = squares[~np.isin(squares, existing)]
+            frame = pd.DataFrame({'grid': squares, 'geom': polygons_ewkb(squares)})
+
+        with metrics.timer('write_grid'):
+            pg_copy.copy_frame(cursor, 'wspr.maidenhead_grid', ('grid', 'geom'), frame)
+            connection.commit()
+    metrics.count('grids_written', len(frame))
+
+    return len(frame)
+
+
+def generate_subgrids(connection, bbox, batch_squares=default_batch_squares):
+    """
+    Generates the polygons of the 6-character subsquares of every square overlapping a region and copies them
+    into maidenhead_subgrid. Squares are generated whole, a batch per transaction, and squares that already have
+    subgrids are skipped, so an interrupted run can be started again.
+    :param connection: psycopg2 connection.
+    :param bbox: (west, south, east, north) in degrees.
+    :param batch_squares: Squares per batch.
+    :return: Number of subgrids written.
+    """
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT DISTINCT upper(grid) FROM wspr.maidenhead_subgrid")
+        existing = [grid for grid, in cursor.fetchall()]
+
+    squares = maidenhead.squares(bbox)
+    squares = squares[~np.isin(squares, existing)]
+
+    n_written = 0
+    for start in range(0, len(squares), batch_squares):
+        batch = squares[start:start + batch_squares]
+        with metrics.timer('generate'):
+            subgrids = maidenhead.subsquares(batch)
+            frame = pd.DataFrame({'grid': np.repeat(batch, len(subgrids) // len(batch)),
+                                  'subgrid': subgrids,
+                                  'geom': polygons_ewkb(subgrids)})
+
+        with metrics.timer('write_subgrids'):
+            with connection.cursor() as cursor:
+                pg_copy.copy_frame(cursor, 'wspr.maidenhead_subgrid', ('grid', 'subgrid', 'geom'), frame)
+            connection.commit()
+        metrics.count('subgrids_written', len(frame))
+
+        n_written += len(frame)
+        print(f"Wrote the subgrids of {batch[0]} to {batch[-1]}. {n_written} subgrids, "
+              f"{start + len(batch)} of {len(squares)} squares")
+
+    return n_written
+
+
+def generate(bbox=None):
+    """
+    Builds the grid polygon tables from the Maidenhead definition, with no shapefiles.
+    :param bbox: Optional (west, south, east, north) in degrees to also generate the subgrids of.
+    """
+
+    connection = database.get_engine().raw_connection()
+    try:
+        print(f"Wrote {generate_grids(connection)} squares")
+        if bbox is not None:
+            generate_subgrids(connection, bbox)
+    finally:
+        connection.close()
+
+
+def main():
+    """
+    Run the script.
+    """
+    parser = argparse.ArgumentParser(description="Load Maidenhead grid square shapefiles into PostGIS.")
+    parser.add_argument('--generate', action='store_true',
+                        help="Generate the squares from the Maidenhead definition instead of loading shapefiles.")
+    parser.add_argument('--subsquares', type=spot_filters.parse_bbox,
+                        help="With --generate, also generate the subgrids of the squares overlapping "
+                             "west,south,east,north (degrees). There are 18.7M subgrids worldwide.")
+    parser.add_argument('--workers', type=int,
+                        help="Processes reading and dissolving shapefiles. Defaults to one per core.")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure(args.metrics_jsonl, args.metrics_prom)
+
+    if args.generate:
+        with metrics.profile(args.profile):
+            generate(args.subsquares)
+        metrics.write_prometheus()
+        return
+
+    maidenhead_grid_root_path = input("Maidenhead grid root path: ")
+    with metrics.profile(args.profile):
+        load_shapefiles(maidenhead_grid_root_path, args.workers)
+    metrics.write_prometheus()
 
 
 if __name__ == '__main__':
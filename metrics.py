@@ -0,0 +1,238 @@
+"""
+Ingest metrics: stage timers, row and byte counters, and database round trips.
+
+Counters and timers are process-wide and thread-safe. Every DBAPI connection an instrumented engine opens gets
+a cursor class that counts statements and round trips, including the raw psycopg2 cursors used for COPY, so
+each chunk can report how many it cost. Events such as a loaded chunk are written as JSON lines, and the totals
+can be written as a Prometheus textfile for the node exporter's textfile collector. A run can also be profiled
+with cProfile.
+"""
+
+import cProfile
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2.extensions
+from sqlalchemy import event
+
+metric_prefix = 'wspr_ingest'
+
+counters = {}
+timers = {}
+lock = threading.Lock()
+
+# Where events and totals are written. Set by configure().
+jsonl_path = None
+prometheus_path = None
+
+
+def configure(jsonl=None, prometheus=None):
+    """
+    Sets where metrics are written.
+    :param jsonl: Optional path of a JSON lines file that events are appended to.
+    :param prometheus: Optional path of a Prometheus textfile rewritten by write_prometheus().
+    """
+
+    global jsonl_path, prometheus_path
+
+    jsonl_path = jsonl
+    prometheus_path = prometheus
+
+
+def count(name, n=1):
+    """
+    Adds to a counter.
+    :param name: Counter name, e.g. rows_read.
+    :param n: Amount to add.
+    """
+
+    with lock:
+        counters[name] = counters.get(name, 0) + n
+
+
+@contextmanager
+def timer(name):
+    """
+    Times a block of code, adding its wall-clock time to a stage timer.
+    :param name: Stage name, e.g. parse.
+    """
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        with lock:
+            seconds, calls = timers.get(name, (0.0, 0))
+            timers[name] = (seconds + elapsed, calls + 1)
+
+
+def snapshot():
+    """
+    Gets the current totals.
+    :return: Dict with counters and timers. Timers are {name: {'seconds': total, 'calls': count}}.
+    """
+
+    with lock:
+        return {'counters': dict(counters),
+                'timers': {name: {'seconds': seconds, 'calls': calls} for name, (seconds, calls) in timers.items()}}
+
+
+def since(previous):
+    """
+    Gets what has been counted and timed since an earlier snapshot.
+    :param previous: Dict from snapshot().
+    :return: Dict of counter name to increase, and stage name + '_seconds' to time spent.
+    """
+
+    current = snapshot()
+    delta = {name: value - previous['counters'].get(name, 0) for name, value in current['counters'].items()}
+    for name, timed in current['timers'].items():
+        earlier = previous['timers'].get(name, {'seconds': 0.0})
+        delta[f"{name}_seconds"] = round(timed['seconds'] - earlier['seconds'], 6)
+
+    return {name: value for name, value in delta.items() if value}
+
+
+def take():
+    """
+    Gets the totals and resets them, e.g. to hand a worker process's metrics to its parent.
+    :return: Dict from snapshot().
+    """
+
+    with lock:
+        taken = {'counters': dict(counters),
+                 'timers': {name: {'seconds': seconds, 'calls': calls} for name, (seconds, calls) in timers.items()}}
+        counters.clear()
+        timers.clear()
+
+    return taken
+
+
+def merge(other):
+    """
+    Adds totals from another process.
+    :param other: Dict from take() or snapshot().
+    """
+
+    with lock:
+        for name, value in other['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+        for name, timed in other['timers'].items():
+            seconds, calls = timers.get(name, (0.0, 0))
+            timers[name] = (seconds + timed['seconds'], calls + timed['calls'])
+
+
+def emit(event_name, **fields):
+    """
+    Appends an event to the JSON lines file, if one is configured.
+    :param event_name: Event name, e.g. chunk.
+    :param fields: JSON-serialisable event fields.
+    """
+
+    if jsonl_path is None:
+        return
+
+    record = {'time': time.time(), 'pid': os.getpid(), 'event': event_name, **fields}
+    line = json.dumps(record, default=str) + '\n'
+
+    with lock, open(jsonl_path, 'a') as jsonl_file:
+        jsonl_file.write(line)
+
+
+def write_prometheus():
+    """
+    Writes the totals as a Prometheus textfile, if one is configured. The file is replaced in one step so the
+    collector never reads half of it.
+    """
+
+    if prometheus_path is None:
+        return
+
+    current = snapshot()
+    lines = []
+    for name, value in sorted(current['counters'].items()):
+        lines.append(f"# TYPE {metric_prefix}_{name}_total counter")
+        lines.append(f"{metric_prefix}_{name}_total {value}")
+
+    lines.append(f"# TYPE {metric_prefix}_stage_seconds_total counter")
+    for name, timed in sorted(current['timers'].items()):
+        lines.append(f'{metric_prefix}_stage_seconds_total{{stage="{name}"}} {timed["seconds"]:.6f}')
+    lines.append(f"# TYPE {metric_prefix}_stage_calls_total counter")
+    for name, timed in sorted(current['timers'].items()):
+        lines.append(f'{metric_prefix}_stage_calls_total{{stage="{name}"}} {timed["calls"]}')
+
+    with open(f"{prometheus_path}.tmp", 'w') as prometheus_file:
+        prometheus_file.write('\n'.join(lines) + '\n')
+    os.replace(f"{prometheus_path}.tmp", prometheus_path)
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """
+    psycopg2 cursor that counts SQL statements and round trips to the server, and times them.
+    """
+
+    def execute(self, query, vars=None):
+        count('sql_statements')
+        count('db_round_trips')
+        with timer('db'):
+            return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        count('sql_statements')
+        count('db_round_trips', len(vars_list))  # psycopg2 runs the statement once per parameter set
+        with timer('db'):
+            return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        count('sql_statements')
+        count('db_round_trips')
+        with timer('db'):
+            return super().copy_expert(sql, file, size)
+
+
+def instrument_engine(engine):
+    """
+    Counts the statements and round trips of every connection an engine opens, whether it is used through
+    SQLAlchemy or as a raw psycopg2 connection.
+    :param engine: SQLAlchemy engine using psycopg2.
+    """
+
+    @event.listens_for(engine, 'connect')
+    def use_counting_cursor(dbapi_connection, connection_record):
+        dbapi_connection.cursor_factory = CountingCursor
+
+
+@contextmanager
+def profile(path=None):
+    """
+    Profiles a block of code with cProfile and dumps the stats, if a path is given.
+    :param path: Optional path to write pstats data to. Read it with python -m pstats.
+    """
+
+    if path is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+
+
+def add_arguments(parser):
+    """
+    Adds the metrics command line options to an argument parser.
+    :param parser: argparse.ArgumentParser.
+    """
+
+    parser.add_argument('--metrics-jsonl', help="Append per-chunk metrics to this JSON lines file.")
+    parser.add_argument('--metrics-prom', help="Write metric totals to this Prometheus textfile.")
+    parser.add_argument('--profile', help="Profile the run with cProfile and write the stats to this file.")
@@ -0,0 +1,323 @@
+"""
+Columnar Parquet cache of the WSPR CSV archives.
+
+Each downloaded month is parsed once and written to a Parquet dataset under the cache root, hive-partitioned by
+month and band (month=2020-01/band=14/...) and compressed with zstd. A fingerprint of the source file is kept
+under _sources/ so a month is only converted again if its CSV changes. Loaders and exporters push band and time
+filters down to partition and row group pruning, and read_cache() can read only some of the columns.
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import spot_filters
+import wspr_csv
+
+# Columns as stored. month and band are partition keys and live in the directory names.
+arrow_schema = pa.schema([('spot_id', pa.int64()),
+                          ('timestamp', pa.int32()),
+                          ('reporter', pa.string()),
+                          ('reporters_grid', pa.string()),
+                          ('snr', pa.int16()),
+                          ('frequency', pa.float64()),
+                          ('call_sign', pa.string()),
+                          ('grid', pa.string()),
+                          ('power', pa.float32()),
+                          ('drift', pa.int16()),
+                          ('distance', pa.int32()),
+                          ('azimuth', pa.int16()),
+                          ('band', pa.int16()),
+                          ('version', pa.string()),
+                          ('code', pa.string()),
+                          ('month', pa.string())])
+
+partitioning = ds.partitioning(pa.schema([('month', pa.string()), ('band', pa.int16())]), flavor='hive')
+
+sources_directory = '_sources'
+
+default_chunksize = 1000000
+
+
+def fingerprint(csv_path):
+    """
+    Identifies a source CSV by path, size and modification time.
+    :param csv_path: Path to the CSV file.
+    :return: Dict fingerprint.
+    """
+
+    stat = os.stat(csv_path)
+
+    return {'path': os.path.abspath(csv_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def fingerprint_path(cache_root, csv_path):
+    """
+    Gets where the fingerprint of a source CSV is stored.
+    :param cache_root: Cache root directory.
+    :param csv_path: Path to the CSV file.
+    :return: Path to the fingerprint JSON file.
+    """
+
+    stem = os.path.basename(csv_path).split('.')[0]
+
+    return os.path.join(cache_root, sources_directory, f"{stem}.json")
+
+
+def is_cached(cache_root, csv_path):
+    """
+    Checks whether a CSV file has already been converted, unchanged.
+    :param cache_root: Cache root directory.
+    :param csv_path: Path to the CSV file.
+    :return: True if the cache holds the current version of the file.
+    """
+
+    try:
+        with open(fingerprint_path(cache_root, csv_path)) as fingerprint_file:
+            return json.load(fingerprint_file) == fingerprint(csv_path)
+    except FileNotFoundError:
+        return False
+
+
+def is_cache(path):
+    """
+    Checks whether a directory is a Parquet cache.
+    :param path: Directory path.
+    :return: True if the directory holds a cache.
+    """
+
+    return os.path.isdir(os.path.join(path, sources_directory))
+
+
+def remove_cached_files(cache_root, stem):
+    """
+    Removes the Parquet files written from one source CSV.
+    :param cache_root: Cache root directory.
+    :param stem: Source CSV file name without extension.
+    """
+
+    for root, _, filenames in os.walk(cache_root):
+        for file in filenames:
+            if file.startswith(f"{stem}-") and file.endswith('.parquet'):
+                os.remove(os.path.join(root, file))
+
+
+def to_record_batch(csv_chunk):
+    """
+    Converts a parsed CSV chunk to an Arrow record batch in the cache schema.
+    :param csv_chunk: DataFrame from wspr_csv.
+    :return: pyarrow RecordBatch.
+    """
+
+    months = csv_chunk['timestamp'].to_numpy().astype('datetime64[s]').astype('datetime64[M]')
+    frame = csv_chunk.assign(band=csv_chunk['band'].astype('int16'),
+                             version=csv_chunk['version'].astype(object),
+                             code=csv_chunk['code'].astype(object),
+                             month=np.datetime_as_string(months, unit='M'))
+
+    return pa.RecordBatch.from_pandas(frame, schema=arrow_schema, preserve_index=False)
+
+
+def convert_csv(csv_path, cache_root, chunksize=default_chunksize, csv_engine='c'):
+    """
+    Converts one CSV or .csv.gz file into the cache, replacing anything previously converted from it.
+    :param csv_path: Path to the CSV or .csv.gz file.
+    :param cache_root: Cache root directory.
+    :param chunksize: Approximate rows parsed at a time.
+    :param csv_engine: pandas CSV engine, 'c' or 'pyarrow'.
+    :return: Number of rows written.
+    """
+
+    stem = os.path.basename(csv_path).split('.')[0]
+    remove_cached_files(cache_root, stem)
+
+    if wspr_csv.is_gzip(csv_path):
+        chunks = wspr_csv.read_gzip(csv_path, 0, chunksize, csv_engine)
+    else:
+        chunks = wspr_csv.read_range(csv_path, 0, os.path.getsize(csv_path), chunksize, csv_engine)
+
+    n_rows = 0
+
+    def batches():
+        nonlocal n_rows
+        for chunk, _ in chunks:
+            n_rows += len(chunk)
+            yield to_record_batch(chunk)
+
+    file_format = ds.ParquetFileFormat()
+    ds.write_dataset(batches(), cache_root, schema=arrow_schema, format=file_format,
+                     file_options=file_format.make_write_options(compression='zstd'),
+                     partitioning=partitioning, basename_template=f"{stem}-{{i}}.parquet",
+                     existing_data_behavior='overwrite_or_ignore')
+
+    os.makedirs(os.path.join(cache_root, sources_directory), exist_ok=True)
+    with open(fingerprint_path(cache_root, csv_path), 'w') as fingerprint_file:
+        json.dump(fingerprint(csv_path), fingerprint_file)
+
+    return n_rows
+
+
+def convert_directory(csv_root, cache_root, chunksize=default_chunksize, csv_engine='c'):
+    """
+    Converts every CSV or .csv.gz file under a directory that is not already in the cache.
+    :param csv_root: Directory to search for CSV files.
+    :param cache_root: Cache root directory.
+    :param chunksize: Approximate rows parsed at a time.
+    :param csv_engine: pandas CSV engine.
+    """
+
+    for root, _, filenames in os.walk(csv_root):
+        for file in sorted(filenames):
+            if not file.endswith(('.csv', '.csv.gz')):
+                continue
+
+            csv_path = os.path.join(root, file)
+            if is_cached(cache_root, csv_path):
+                print(f"{csv_path} is already cached. Skipping.")
+                continue
+
+            print(f"Converting {csv_path}")
+            n_rows = convert_csv(csv_path, cache_root, chunksize, csv_engine)
+            print(f"Wrote {n_rows} rows from {csv_path}")
+
+
+def filter_expression(filters):
+    """
+    Translates the band, time and spot_id filters into an Arrow expression, so that partitions and row groups
+    that cannot match are never read. Callsign and region filters still need spot_filters.apply_filters().
+    :param filters: Filter dict from spot_filters.build_filters(), or None.
+    :return: pyarrow dataset expression, or None.
+    """
+
+    if not filters:
+        return None
+
+    expressions = []
+    if 'after_spot_id' in filters:
+        expressions.append(ds.field('spot_id') > filters['after_spot_id'])
+    if 'bands' in filters:
+        expressions.append(ds.field('band').isin([int(band) for band in filters['bands']]))
+    if 'start' in filters:
+        expressions.append(ds.field('timestamp') >= filters['start'])
+        expressions.append(ds.field('month') >= str(np.datetime64(filters['start'], 's').astype('datetime64[M]')))
+    if 'end' in filters:
+        expressions.append(ds.field('timestamp') < filters['end'])
+        expressions.append(ds.field('month') <= str(np.datetime64(filters['end'], 's').astype('datetime64[M]')))
+
+    expression = None
+    for part in expressions:
+        expression = part if expression is None else expression & part
+
+    return expression
+
+
+def open_dataset(source):
+    """
+    Opens the cache, or a list of files in it, as a dataset.
+    :param source: Cache root directory, or a (cache root, list of Parquet file paths) tuple.
+    :return: pyarrow Dataset.
+    """
+
+    if isinstance(source, tuple):
+        cache_root, paths = source
+        return ds.dataset(paths, format='parquet', partitioning=partitioning, partition_base_dir=cache_root)
+
+    return ds.dataset(source, format='parquet', partitioning=partitioning,
+                      exclude_invalid_files=True, ignore_prefixes=['.', '_'])
+
+
+def read_cache(source, columns=None, filters=None, chunksize=default_chunksize):
+    """
+    Reads spots from the cache in chunks.
+    :param source: Cache root directory, or a (cache root, list of Parquet file paths) tuple.
+    :param columns: Columns to read. Defaults to the CSV header columns.
+    :param filters: Optional filter dict from spot_filters.build_filters(). Band and time filters are pushed
+    down to the scan; the rest are applied to each chunk.
+    :param chunksize: Maximum rows per chunk.
+    :return: Generator of (DataFrame, number of spots filtered out) tuples.
+    """
+
+    columns = list(columns or wspr_csv.header)
+
+    # Filters are applied to each chunk, so they need their columns even if the caller does not
+    scan_columns = columns + [column for column in spot_filters.columns_used(filters) if column not in columns]
+
+    dataset = open_dataset(source)
+    for batch in dataset.to_batches(columns=scan_columns, filter=filter_expression(filters), batch_size=chunksize):
+        chunk = batch.to_pandas()
+        chunk, n_filtered = spot_filters.apply_filters(chunk, filters)
+        yield chunk[columns], n_filtered
+
+
+def cached_files(cache_root, filters=None):
+    """
+    Lists the Parquet files in the cache, skipping month and band partitions the filters rule out.
+    :param cache_root: Cache root directory.
+    :param filters: Optional filter dict from spot_filters.build_filters().
+    :return: Sorted list of (file path, number of rows) tuples.
+    """
+
+    fragments = open_dataset(cache_root).get_fragments(filter=filter_expression(filters))
+
+    return sorted((fragment.path, fragment.metadata.num_rows) for fragment in fragments)
+
+
+def read_file(cache_root, path, start_row=0, chunksize=default_chunksize):
+    """
+    Reads one file of the cache in chunks from a row offset, so a partly loaded file can be resumed. Row groups
+    before the offset are not read.
+    :param cache_root: Cache root directory.
+    :param path: Path to a Parquet file in the cache.
+    :param start_row: Row to start from.
+    :param chunksize: Maximum rows per chunk.
+    :return: Generator of (DataFrame with the CSV header columns, row offset at the end of the chunk) tuples.
+    """
+
+    keys = ds.get_partition_keys(partitioning.parse(os.path.relpath(path, cache_root)))
+    parquet_file = pq.ParquetFile(path)
+
+    # Skip the leading row groups that end at or before the offset, and read every group from the one holding it
+    first_group = 0
+    position = 0
+    while first_group < parquet_file.num_row_groups:
+        group_rows = parquet_file.metadata.row_group(first_group).num_rows
+        if position + group_rows > start_row:
+            break
+        position += group_rows
+        first_group += 1
+    row_groups = list(range(first_group, parquet_file.num_row_groups))
+    if not row_groups:
+        return
+
+    columns = [column for column in wspr_csv.header if column not in keys]
+    for batch in parquet_file.iter_batches(batch_size=chunksize, row_groups=row_groups, columns=columns):
+        chunk = batch.to_pandas().iloc[max(start_row - position, 0):]
+        position += batch.num_rows
+        if not chunk.empty:
+            yield chunk.assign(**{key: value for key, value in keys.items() if key in wspr_csv.header})[
+                list(wspr_csv.header)], position
+
+
+def main():
+    """
+    Convert downloaded CSV files into the Parquet cache.
+    """
+
+    parser = argparse.ArgumentParser(description="Convert WSPR CSV files into a Parquet cache.")
+    parser.add_argument('csv_root', help="Directory of downloaded WSPR CSV files.")
+    parser.add_argument('cache_root', help="Parquet cache directory.")
+    parser.add_argument('--chunksize', type=int, default=default_chunksize,
+                        help="Approximate rows parsed at a time.")
+    parser.add_argument('--engine', choices=('c', 'pyarrow'), default='c', help="CSV parser.")
+    args = parser.parse_args()
+
+    convert_directory(args.csv_root, args.cache_root, args.chunksize, args.engine)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+"""
+Manage the monthly range partitions of wspr.wspr_data, or of wspr.spots in a database converted to the compact
+layout, see compact_schema.py.
+
+wspr_data is partitioned by month on its epoch timestamp, and spots on its timestamptz time. Partitions are named
+wspr_data_YYYY_MM (spots_YYYY_MM) and are created as new months turn up during ingest. A month can also be filled
+as a standalone table with no indexes and attached once it is loaded, which builds its indexes in one pass.
+Attaching or detaching a month is a metadata operation.
+"""
+
+import argparse
+import re
+from datetime import datetime, timezone
+
+import pandas as pd
+
+from wspr_pg_database import database
+
+partition_pattern = re.compile(r"^(?:wspr_data|spots)_(\d{4})_(\d{2})$")
+
+# The table partitioned by month and its time column. Switched by use_table().
+spots_table = 'wspr_data'
+time_column = 'timestamp'
+
+# Partitions known to be attached and standalone tables being bulk loaded, so each month is only checked once
+# per process. Only committed tables are recorded, see register_partitions().
+known_partitions = set()
+fresh_tables = {}
+
+# Whether wspr_data is partitioned, looked up on first use
+partitioned = None
+
+
+def use_table(table, column):
+    """
+    Sets the table whose partitions are managed.
+    :param table: wspr_data, or spots for the compact layout.
+    :param column: Its time column, timestamp (epoch seconds) or time (timestamptz).
+    """
+
+    global spots_table, time_column, partitioned
+
+    if (table, column) != (spots_table, time_column):
+        spots_table, time_column = table, column
+        partitioned = None
+        known_partitions.clear()
+        fresh_tables.clear()
+
+
+def partition_name(month):
+    """
+    Gets the table name of a month's partition.
+    :param month: (year, month) tuple.
+    :return: Table name, without schema.
+    """
+
+    return f"{spots_table}_{month[0]:04d}_{month[1]:02d}"
+
+
+def month_bounds(month):
+    """
+    Gets the epoch bounds of a month.
+    :param month: (year, month) tuple.
+    :return: Tuple of the first second of the month and the first second of the next month.
+    """
+
+    year, month_number = month
+    next_month = (year + 1, 1) if month_number == 12 else (year, month_number + 1)
+
+    start = datetime(year, month_number, 1, tzinfo=timezone.utc)
+    end = datetime(*next_month, 1, tzinfo=timezone.utc)
+
+    return int(start.timestamp()), int(end.timestamp())
+
+
+def partition_bounds(month):
+    """
+    Gets the bounds of a month as SQL literals of the time column's type.
+    :param month: (year, month) tuple.
+    :return: Tuple of the start literal and the end literal.
+    """
+
+    start, end = month_bounds(month)
+    if time_column == 'timestamp':
+        return str(start), str(end)
+
+    return tuple(f"'{datetime.fromtimestamp(bound, timezone.utc):%Y-%m-%d %H:%M:%S}+00'" for bound in (start, end))
+
+
+def chunk_months(timestamps):
+    """
+    Gets the months covered by a set of epoch timestamps.
+    :param timestamps: Series of epoch timestamps.
+    :return: Sorted list of (year, month) tuples.
+    """
+
+    dates = pd.to_datetime(pd.Series(timestamps).dropna().unique(), unit='s', utc=True)
+
+    return sorted(set(zip(dates.year, dates.month)))
+
+
+def is_partitioned(cursor):
+    """
+    Checks whether the table is partitioned. Databases created before partitioning was introduced keep a plain
+    wspr_data table.
+    :param cursor: psycopg2 cursor.
+    :return: True if the table is partitioned.
+    """
+
+    global partitioned
+
+    if partitioned is None:
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table "
+                       "WHERE partrelid = %s::regclass)", (f"wspr.{spots_table}",))
+        partitioned = cursor.fetchone()[0]
+
+    return partitioned
+
+
+def partition_state(cursor, month):
+    """
+    Finds out whether a month's table exists and whether it is attached to wspr_data.
+    :param cursor: psycopg2 cursor.
+    :param month: (year, month) tuple.
+    :return: 'attached', 'detached' or None if the table does not exist.
+    """
+
+    cursor.execute("SELECT c.relispartition FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+                   "WHERE n.nspname = 'wspr' AND c.relname = %s", (partition_name(month),))
+    row = cursor.fetchone()
+
+    if row is None:
+        return None
+
+    return 'attached' if row[0] else 'detached'
+
+
+def lock_partitions(cursor):
+    """
+    Serialises partition DDL between concurrent loaders until the end of the transaction.
+    :param cursor: psycopg2 cursor.
+    """
+
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext('wspr.wspr_data partitions'))")
+
+
+def ensure_partitions(cursor, months):
+    """
+    Creates any missing attached partitions. Does nothing if the table is not partitioned. The months are not
+    recorded as known until the caller commits, see register_partitions().
+    :param cursor: psycopg2 cursor.
+    :param months: Iterable of (year, month) tuples.
+    :return: List of the months checked, to register once committed.
+    """
+
+    checked = []
+    if not is_partitioned(cursor):
+        return checked
+
+    for month in months:
+        if month in known_partitions:
+            continue
+
+        lock_partitions(cursor)
+        if partition_state(cursor, month) is None:
+            start, end = partition_bounds(month)
+            print(f"Creating partition {partition_name(month)}")
+            cursor.execute(f"CREATE TABLE wspr.{partition_name(month)} PARTITION OF wspr.{spots_table} "
+                           f"FOR VALUES FROM ({start}) TO ({end})")
+
+        checked.append(month)
+
+    return checked
+
+
+def fresh_partitions(cursor, months):
+    """
+    Gets the standalone tables to bulk load months into. A month that has no table yet gets a new one with
+    no indexes. A month that is already attached keeps loading through the partitioned table, and is left to
+    ensure_partitions(). The tables are not recorded until the caller commits, see register_partitions().
+    :param cursor: psycopg2 cursor.
+    :param months: Iterable of (year, month) tuples.
+    :return: Dict of (year, month) to table name for months to load into a standalone table. Empty if the
+    table is not partitioned.
+    """
+
+    tables = {}
+    if not is_partitioned(cursor):
+        return tables
+
+    for month in months:
+        if month in fresh_tables:
+            tables[month] = fresh_tables[month]
+            continue
+        if month in known_partitions:
+            continue
+
+        lock_partitions(cursor)
+        state = partition_state(cursor, month)
+
+        if state is None:
+            print(f"Creating unindexed table {partition_name(month)}")
+            cursor.execute(f"CREATE TABLE wspr.{partition_name(month)} "
+                           f"(LIKE wspr.{spots_table} INCLUDING DEFAULTS)")
+            state = 'detached'
+
+        if state == 'detached':
+            tables[month] = f"wspr.{partition_name(month)}"
+
+    return tables
+
+
+def register_partitions(attached=(), fresh=None):
+    """
+    Records committed partitions and standalone tables, so later chunks do not check them again. A table
+    created in a transaction that is rolled back must not be recorded, or later chunks would skip creating it.
+    :param attached: Months from ensure_partitions().
+    :param fresh: Dict of month to table name from fresh_partitions().
+    """
+
+    known_partitions.update(attached)
+    fresh_tables.update(fresh or {})
+
+
+def detached_months(cursor):
+    """
+    Finds month tables that exist but are not attached to the partitioned table.
+    :param cursor: psycopg2 cursor.
+    :return: Sorted list of (year, month) tuples.
+    """
+
+    cursor.execute("SELECT c.relname FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+                   "WHERE n.nspname = 'wspr' AND c.relkind = 'r' AND NOT c.relispartition "
+                   "AND c.relname ~ %s", (f"^{spots_table}_[0-9]{{4}}_[0-9]{{2}}$",))
+
+    months = []
+    for (name,) in cursor.fetchall():
+        year, month_number = partition_pattern.match(name).groups()
+        months.append((int(year), int(month_number)))
+
+    return sorted(months)
+
+
+def attach_partition(cursor, month):
+    """
+    Attaches a standalone month table to the partitioned table. Rows repeated across chunks are removed first,
+    then a CHECK constraint matching the partition bounds is validated on the table alone so that ATTACH can
+    skip its own scan. ATTACH builds the partition's indexes from the ones defined on the partitioned table.
+    :param cursor: psycopg2 cursor.
+    :param month: (year, month) tuple.
+    """
+
+    table = f"wspr.{partition_name(month)}"
+    constraint = f"{partition_name(month)}_bounds"
+    start, end = partition_bounds(month)
+
+    print(f"Attaching {table}")
+    cursor.execute(f"DELETE FROM {table} a USING {table} b "
+                   f"WHERE a.spot_id = b.spot_id AND a.{time_column} = b.{time_column} AND a.ctid > b.ctid")
+    cursor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {constraint} "
+                   f"CHECK ({time_column} >= {start} AND {time_column} < {end})")
+    cursor.execute(f"ALTER TABLE wspr.{spots_table} ATTACH PARTITION {table} "
+                   f"FOR VALUES FROM ({start}) TO ({end})")
+    cursor.execute(f"ALTER TABLE {table} DROP CONSTRAINT {constraint}")
+
+    fresh_tables.pop(month, None)
+
+
+def detach_partition(cursor, month):
+    """
+    Detaches a month from the partitioned table, leaving it as a standalone table.
+    :param cursor: psycopg2 cursor.
+    :param month: (year, month) tuple.
+    """
+
+    print(f"Detaching wspr.{partition_name(month)}")
+    cursor.execute(f"ALTER TABLE wspr.{spots_table} DETACH PARTITION wspr.{partition_name(month)}")
+
+    known_partitions.discard(month)
+
+
+def attach_detached(connection):
+    """
+    Attaches every standalone month table and rebuilds its rollups, committing after each one.
+    :param connection: psycopg2 connection.
+    """
+
+    import rollups  # Imports this module
+
+    with connection.cursor() as cursor:
+        for month in detached_months(cursor):
+            attach_partition(cursor, month)
+            rollups.backfill(cursor, month)
+            connection.commit()
+
+
+def parse_month(value):
+    """
+    Parses a YYYY-MM month argument.
+    :param value: Month string.
+    :return: (year, month) tuple.
+    """
+
+    year, month_number = value.split('-')
+
+    return int(year), int(month_number)
+
+
+def main():
+    """
+    Attach or detach month partitions from the command line.
+    """
+
+    import compact_schema  # Imports this module
+    import rollups  # Imports this module
+
+    parser = argparse.ArgumentParser(description="Attach or detach monthly wspr_data (or spots) partitions.")
+    parser.add_argument('action', choices=('attach', 'detach'))
+    parser.add_argument('months', nargs='*', type=parse_month,
+                        help="Months as YYYY-MM. attach with no months attaches every standalone month table.")
+    args = parser.parse_args()
+
+    connection = database.get_engine().raw_connection()
+
+    try:
+        with connection.cursor() as cursor:
+            compact_schema.detect(cursor)
+
+        if args.action == 'attach' and not args.months:
+            attach_detached(connection)
+            return
+
+        with connection.cursor() as cursor:
+            for month in args.months:
+                if args.action == 'attach':
+                    # Standalone tables may have been loaded by --fresh-partitions without the rollups
+                    attach_partition(cursor, month)
+                    rollups.backfill(cursor, month)
+                else:
+                    detach_partition(cursor, month)
+                connection.commit()
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
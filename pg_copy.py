@@ -0,0 +1,38 @@
+"""
+Stream pandas DataFrames into PostgreSQL with COPY FROM STDIN.
+"""
+
+import io
+
+
+def frame_to_buffer(frame):
+    """
+    Serialises a DataFrame into an in-memory CSV buffer suitable for COPY.
+    :param frame: pandas DataFrame. Column order must match the COPY column list.
+    :return: io.StringIO positioned at the start of the data.
+    """
+
+    buffer = io.StringIO()
+    frame.to_csv(buffer, header=False, index=False)
+    buffer.seek(0)
+
+    return buffer
+
+
+def copy_frame(cursor, table, columns, frame):
+    """
+    Copies a DataFrame into a table using COPY FROM STDIN. Empty fields are loaded as NULL.
+    :param cursor: psycopg2 cursor.
+    :param table: Schema-qualified table name.
+    :param columns: Sequence of column names, in the same order as the DataFrame columns.
+    :param frame: pandas DataFrame to copy.
+    :return: Number of rows copied.
+    """
+
+    if frame.empty:
+        return 0
+
+    buffer = frame_to_buffer(frame)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+    return len(frame)
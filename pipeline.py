@@ -0,0 +1,284 @@
+"""
+Download and load WSPR archives in one non-interactive run, with every stage working at once.
+
+Archives pass through three stages of threads connected by bounded queues: fetch downloads each .csv.gz with
+download_engine, parse decompresses and parses it in chunks with wspr_csv, and load writes each chunk to the
+database through csv_to_pg's COPY path. A full queue blocks the stage feeding it, so memory stays bounded and
+the run goes at the pace of the slowest stage. Network transfers, zlib, pyarrow parsing and socket writes to
+PostgreSQL all release the GIL, so the stages overlap even though they share a process.
+
+Chunks of one file always go to the same loader, in order, so the ingest journal is committed in order and an
+interrupted run resumes like csv_to_pg.py does. Files are handed to the loaders in turn, so files parsed at the
+same time load on different connections. Once a chunk fails to load, the rest of its file is not parsed.
+"""
+
+import argparse
+import itertools
+import os
+import queue
+import threading
+import time
+
+import csv_to_pg
+import download_engine
+import downloader
+import great_circle
+import metrics
+import partitions
+import spot_filters
+import wspr_csv
+from wspr_pg_database import database
+
+default_fetch_workers = 4
+default_parse_workers = 2
+default_load_workers = 2
+default_queue_chunks = 4
+
+# Put on a stage's queue once per worker to tell it there is nothing more to come
+done = object()
+
+# Journal planning is done one thread at a time, so a file's ranges are only recorded once
+plan_lock = threading.Lock()
+
+
+def item_label(item):
+    """
+    Describes a stage item in messages.
+    :param item: URL or path, or a tuple starting with the path it came from.
+    :return: String.
+    """
+
+    return item if isinstance(item, str) else item[0]
+
+
+def start_stage(name, handle, inbox, workers, close, failures):
+    """
+    Starts a pool of threads that pass each item on a queue to a handler until the queue is closed. An item
+    that fails is reported and the stage carries on.
+    :param name: Stage name, used for thread names and messages.
+    :param handle: Callable taking one item.
+    :param inbox: queue.Queue the stage reads from. Closed by putting done on it once per worker.
+    :param workers: Number of threads.
+    :param close: Callable run once every thread has finished, to close the next stage's queues.
+    :param failures: List that (stage name, item label, exception) tuples are appended to.
+    :return: List of started threads.
+    """
+
+    remaining = [workers]
+    remaining_lock = threading.Lock()
+
+    def run():
+        while True:
+            item = inbox.get()
+            if item is done:
+                break
+
+            try:
+                handle(item)
+            except Exception as e:
+                print(f"{name} failed on {item_label(item)}: {e!r}")
+                failures.append((name, item_label(item), e))
+
+        with remaining_lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            close()
+
+    threads = [threading.Thread(target=run, name=f"{name}-{i}", daemon=True) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    return threads
+
+
+def run_pipeline(urls, download_directory, fetch_workers=default_fetch_workers,
+                 parse_workers=default_parse_workers, load_workers=default_load_workers,
+                 queue_chunks=default_queue_chunks, chunksize=csv_to_pg.default_chunksize, csv_engine='c',
+                 filters=None):
+    """
+    Downloads and loads archives with the fetch, parse and load stages running concurrently.
+    :param urls: Archive URLs. Archives already in the download directory are not fetched again.
+    :param download_directory: Directory archives are downloaded to. They are kept compressed.
+    :param fetch_workers: Concurrent downloads.
+    :param parse_workers: Files decompressed and parsed at once.
+    :param load_workers: Database connections loading at once.
+    :param queue_chunks: Parsed chunks each loader may have waiting. Bounds the memory in flight to about
+    load_workers * queue_chunks * chunksize rows.
+    :param chunksize: Approximate rows per chunk.
+    :param csv_engine: pandas CSV engine. pyarrow parses with the GIL released.
+    :param filters: Optional filter dict from spot_filters.build_filters().
+    :return: Tuple of the number of rows read and a list of (stage name, URL or path, exception) failures.
+    """
+
+    os.makedirs(download_directory, exist_ok=True)
+
+    fetch_queue = queue.Queue()
+    parse_queue = queue.Queue(maxsize=parse_workers * 2)
+    load_queues = [queue.Queue(maxsize=queue_chunks) for _ in range(load_workers)]
+
+    failures = []
+    totals = {'rows': 0, 'inserted': 0}
+    totals_lock = threading.Lock()
+    connections = []
+    local = threading.local()
+
+    # Loaders are given files in turn. Journal ranges that failed to load are not parsed or journalled further.
+    next_loader = itertools.cycle(range(load_workers))
+    failed_journals = set()
+
+    def fetch(url):
+        path = os.path.join(download_directory, os.path.basename(url))
+        parse_queue.put(download_engine.download_file(url, path))
+
+    def parse(path):
+        with plan_lock:
+            tasks = csv_to_pg.plan_ranges(path, 1, filters)
+            load_queue = load_queues[next(next_loader)]
+
+        for _, journal_id, start, end in tasks:
+            if wspr_csv.is_gzip(path):
+                chunks = wspr_csv.read_gzip(path, start, chunksize, csv_engine)
+            else:
+                chunks = wspr_csv.read_range(path, start, end, chunksize, csv_engine)
+
+            offset = start
+            for chunk, offset in chunks:
+                if journal_id in failed_journals:
+                    break
+
+                n_rows = len(chunk)
+                metrics.count('rows_read', n_rows)
+                metrics.count('rows_malformed', chunk.attrs['malformed'])
+                chunk, n_filtered = spot_filters.apply_filters(chunk, filters)
+                metrics.count('rows_filtered', n_filtered)
+                load_queue.put((path, journal_id, chunk, n_rows, offset,
+                                not wspr_csv.is_gzip(path) and offset >= end))
+
+            if journal_id in failed_journals:
+                chunks.close()  # Stops decompressing
+                print(f"Stopped parsing {path}, a chunk of it failed to load")
+                continue
+            if wspr_csv.is_gzip(path):  # The end of a compressed file is only known once it runs out
+                load_queue.put((path, journal_id, None, 0, offset, True))
+
+    def load(item):
+        path, journal_id, chunk, n_rows, offset, completed = item
+        if not hasattr(local, 'connection'):  # One connection per loader thread
+            local.connection = database.get_engine().raw_connection()
+            connections.append(local.connection)
+        if journal_id in failed_journals:  # Never journal past a chunk that failed
+            return
+
+        try:
+            if chunk is None:
+                with local.connection.cursor() as cursor:
+                    csv_to_pg.record_progress(cursor, journal_id, offset, completed)
+                local.connection.commit()
+                n_inserted = 0
+            else:
+                n_inserted = csv_to_pg.copy_chunk(local.connection, chunk, (journal_id, offset, completed))[0]
+        except Exception:
+            local.connection.rollback()
+            failed_journals.add(journal_id)
+            raise
+
+        with totals_lock:
+            totals['rows'] += n_rows
+            totals['inserted'] += n_inserted
+            print(f"Loaded {offset / 1e6:.1f} MB of {path}. {totals['rows']} rows read, "
+                  f"{totals['inserted']} inserted in total")
+        metrics.emit('chunk', path=path, offset=offset, rows=n_rows, inserted=n_inserted,
+                     queued=[load_queue.qsize() for load_queue in load_queues])
+
+    def close_all(queues, n_consumers):
+        def close():
+            for stage_queue in queues:
+                for _ in range(n_consumers):
+                    stage_queue.put(done)
+
+        return close
+
+    csv_to_pg.ensure_indexes()
+    csv_to_pg.warm_operator_registry()
+
+    threads = start_stage('fetch', fetch, fetch_queue, fetch_workers, close_all([parse_queue], parse_workers),
+                          failures)
+    threads += start_stage('parse', parse, parse_queue, parse_workers, close_all(load_queues, 1), failures)
+    for i, load_queue in enumerate(load_queues):
+        threads += start_stage(f"load{i}", load, load_queue, 1, lambda: None, failures)
+
+    started = time.perf_counter()
+    for url in urls:
+        fetch_queue.put(url)
+    for _ in range(fetch_workers):
+        fetch_queue.put(done)
+
+    for thread in threads:
+        thread.join()
+    for connection in connections:
+        connection.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"Loaded {totals['rows']} rows ({totals['inserted']} new) in {elapsed:.1f}s, "
+          f"{totals['rows'] / max(elapsed, 1e-9):.0f} rows/s")
+
+    if failures:
+        print(f"{len(failures)} item(s) failed. Run again to resume them:")
+        for name, label, e in failures:
+            print(f"\t{name}: {label}: {e!r}")
+
+    return totals['rows'], failures
+
+
+def parse_args():
+    """
+    Parse command line arguments.
+    :return: argparse Namespace.
+    """
+
+    parser = argparse.ArgumentParser(description="Download and load WSPR archives with the stages running "
+                                                 "concurrently.")
+    parser.add_argument('directory', help="Directory archives are downloaded to.")
+    parser.add_argument('--month', dest='months', type=partitions.parse_month, action='append',
+                        help="Only fetch this month, as YYYY-MM. May be repeated. Defaults to every archive.")
+    parser.add_argument('--url', dest='urls', action='append',
+                        help="Fetch this archive URL instead of listing the downloads page. May be repeated.")
+    parser.add_argument('--fetch-workers', type=int, default=default_fetch_workers, help="Concurrent downloads.")
+    parser.add_argument('--parse-workers', type=int, default=default_parse_workers,
+                        help="Files decompressed and parsed at once.")
+    parser.add_argument('--load-workers', type=int, default=default_load_workers,
+                        help="Database connections loading at once.")
+    parser.add_argument('--queue-chunks', type=int, default=default_queue_chunks,
+                        help="Parsed chunks each loader may have waiting.")
+    parser.add_argument('--chunksize', type=int, default=csv_to_pg.default_chunksize,
+                        help="Approximate rows per chunk.")
+    parser.add_argument('--engine', choices=('c', 'pyarrow'), default='c', help="CSV parser.")
+    parser.add_argument('--band', dest='bands', type=int, action='append',
+                        help="Only load this band, e.g. 14. May be repeated.")
+    parser.add_argument('--paths', action='store_true',
+                        help="Store each spot's great-circle path, see csv_to_pg.py --paths.")
+    parser.add_argument('--path-vertices', type=int, default=great_circle.default_vertices,
+                        help="Vertices per path, before splitting at the antimeridian.")
+    metrics.add_arguments(parser)
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    urls = args.urls or downloader.get_download_urls()
+    if args.months:
+        urls = [url for url in urls if downloader.archive_month(url) in args.months]
+
+    csv_to_pg.use_paths(args.path_vertices if args.paths else None)
+    metrics.configure(args.metrics_jsonl, args.metrics_prom)
+    with metrics.profile(args.profile):
+        run_pipeline(urls, args.directory, args.fetch_workers, args.parse_workers, args.load_workers,
+                     args.queue_chunks, args.chunksize, args.engine, spot_filters.build_filters(bands=args.bands))
+    metrics.write_prometheus()
+
+
+if __name__ == '__main__':
+    main()
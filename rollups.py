@@ -0,0 +1,184 @@
+"""
+Keep the hourly and daily rollups of the spots up to date.
+
+wspr.grid_band_hour counts the spots of each 4-char TX grid, band and hour per SNR, with the longest distance
+heard, so the SNR distribution, and from it the median, is kept without the spots. wspr.grid_band_hour_stats sums
+it up per grid, band and hour. wspr.path_pair_day summarises each RX grid to TX grid path per band and UTC day.
+Propagation queries read these instead of scanning the spots.
+
+The COPY loader adds each batch to the rollups in the same statement that merges it into the spots, from the rows
+that statement actually inserted, so spots that were already loaded are never counted twice. The ORM loader adds
+the spots it inserted once they are flushed, in the same transaction. Months loaded into fresh partitions are
+rebuilt once they are attached. Spots loaded before the rollups existed are added with rollups.py backfill.
+"""
+
+import argparse
+
+import compact_schema
+import partitions
+from wspr_pg_database import database
+
+grid_band_hour_sql = """
+    INSERT INTO wspr.grid_band_hour (tx_grid, band, hour, snr, spots, max_distance)
+    SELECT tx_grid, band, to_timestamp(timestamp / 3600 * 3600), snr, count(*), max(distance)
+    FROM rollup_spots
+    GROUP BY 1, 2, 3, 4
+    ORDER BY 1, 2, 3, 4
+    ON CONFLICT (tx_grid, band, hour, snr) DO UPDATE
+    SET spots = grid_band_hour.spots + EXCLUDED.spots,
+        max_distance = greatest(grid_band_hour.max_distance, EXCLUDED.max_distance)
+"""
+
+path_pair_day_sql = """
+    INSERT INTO wspr.path_pair_day (rx_grid, tx_grid, band, day, spots, snr_sum, max_snr, max_distance)
+    SELECT rx_grid, tx_grid, band, date '1970-01-01' + timestamp / 86400, count(*), sum(snr), max(snr),
+           max(distance)
+    FROM rollup_spots
+    GROUP BY 1, 2, 3, 4
+    ORDER BY 1, 2, 3, 4
+    ON CONFLICT (rx_grid, tx_grid, band, day) DO UPDATE
+    SET spots = path_pair_day.spots + EXCLUDED.spots,
+        snr_sum = path_pair_day.snr_sum + EXCLUDED.snr_sum,
+        max_snr = greatest(path_pair_day.max_snr, EXCLUDED.max_snr),
+        max_distance = greatest(path_pair_day.max_distance, EXCLUDED.max_distance)
+"""
+
+
+def returning_columns():
+    """
+    Gets the columns of the spots table the rollups are made from.
+    :return: SQL column list for a RETURNING clause.
+    """
+
+    if compact_schema.enabled:
+        return "time, rx_id, tx_id, band, snr, distance"
+
+    return "timestamp, rx_grid, tx_grid, band, snr, distance"
+
+
+def spot_rows(relation, where=''):
+    """
+    Gets the rows the rollups are made from.
+    :param relation: Relation with the columns from returning_columns(), aliased s in the where clause.
+    :param where: Optional WHERE clause.
+    :return: SQL query for the epoch timestamp, the 4-char RX and TX grids, band, SNR and distance of each spot.
+    """
+
+    if compact_schema.enabled:
+        return (f"SELECT extract(epoch FROM s.time)::integer AS timestamp, upper(left(rx.grid, 4)) AS rx_grid, "
+                f"upper(left(tx.grid, 4)) AS tx_grid, s.band, s.snr, s.distance FROM {relation} s "
+                f"JOIN wspr.operators rx ON rx.id = s.rx_id JOIN wspr.operators tx ON tx.id = s.tx_id {where}")
+
+    return (f"SELECT s.timestamp, upper(left(s.rx_grid, 4)) AS rx_grid, upper(left(s.tx_grid, 4)) AS tx_grid, "
+            f"s.band, s.snr, s.distance FROM {relation} s {where}")
+
+
+def merge_sql(insert_sql):
+    """
+    Wraps the statement that merges a batch into the spots so that the rows it inserts are also added to the
+    rollups, in the same statement.
+    :param insert_sql: INSERT ... ON CONFLICT DO NOTHING statement, without RETURNING.
+    :return: SQL statement returning one row with the number of spots inserted.
+    """
+
+    return (f"WITH inserted AS ({insert_sql} RETURNING {returning_columns()}), "
+            f"rollup_spots AS ({spot_rows('inserted')}), "
+            f"hours AS ({grid_band_hour_sql}), "
+            f"paths AS ({path_pair_day_sql}) "
+            f"SELECT count(*) FROM inserted")
+
+
+def add_spots_sql(relation, where=''):
+    """
+    Adds spots that are already stored to the rollups.
+    :param relation: Spots relation, see spot_rows().
+    :param where: Optional WHERE clause selecting the spots to add.
+    :return: SQL statement returning one row with the number of spots added.
+    """
+
+    return (f"WITH rollup_spots AS ({spot_rows(relation, where)}), "
+            f"hours AS ({grid_band_hour_sql}), "
+            f"paths AS ({path_pair_day_sql}) "
+            f"SELECT count(*) FROM rollup_spots")
+
+
+def lock_rollups(cursor):
+    """
+    Locks the rollups against loaders until the end of the transaction. Loaders update the rollups in the
+    statement that inserts their spots, so once the lock is granted every loaded spot is committed and visible.
+    :param cursor: psycopg2 cursor.
+    """
+
+    cursor.execute("LOCK TABLE wspr.grid_band_hour, wspr.path_pair_day IN SHARE ROW EXCLUSIVE MODE")
+
+
+def backfill(cursor, month):
+    """
+    Rebuilds the rollups of a month from its spots. The caller commits.
+    :param cursor: psycopg2 cursor.
+    :param month: (year, month) tuple.
+    :return: Number of spots in the month.
+    """
+
+    start, end = partitions.month_bounds(month)
+    start_bound, end_bound = partitions.partition_bounds(month)
+    where = (f"WHERE s.{partitions.time_column} >= {start_bound} "
+             f"AND s.{partitions.time_column} < {end_bound}")
+
+    lock_rollups(cursor)
+    cursor.execute("DELETE FROM wspr.grid_band_hour WHERE hour >= to_timestamp(%s) AND hour < to_timestamp(%s)",
+                   (start, end))
+    cursor.execute("DELETE FROM wspr.path_pair_day "
+                   "WHERE day >= date '1970-01-01' + %s / 86400 AND day < date '1970-01-01' + %s / 86400",
+                   (start, end))
+    cursor.execute(add_spots_sql(f"wspr.{partitions.spots_table}", where))
+
+    return cursor.fetchone()[0]
+
+
+def spot_months(cursor):
+    """
+    Gets the months spanned by the spots.
+    :param cursor: psycopg2 cursor.
+    :return: List of (year, month) tuples from the first month to the last.
+    """
+
+    if partitions.time_column == 'timestamp':
+        cursor.execute(f"SELECT min(timestamp), max(timestamp) FROM wspr.{partitions.spots_table}")
+    else:
+        cursor.execute(f"SELECT extract(epoch FROM min(time))::bigint, extract(epoch FROM max(time))::bigint "
+                       f"FROM wspr.{partitions.spots_table}")
+    first, last = cursor.fetchone()
+    if first is None:
+        return []
+
+    return partitions.chunk_months(list(range(first, last, 86400 * 28)) + [last])
+
+
+def main():
+    """
+    Rebuild the rollups from the command line.
+    """
+
+    parser = argparse.ArgumentParser(description="Rebuild the spot rollups from the loaded spots.")
+    parser.add_argument('action', choices=('backfill',))
+    parser.add_argument('--month', dest='months', type=partitions.parse_month, action='append',
+                        help="Month to rebuild, as YYYY-MM. May be repeated. Defaults to every month with spots.")
+    args = parser.parse_args()
+
+    connection = database.get_engine().raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            compact_schema.detect(cursor)
+            months = args.months or spot_months(cursor)
+
+            for month in months:
+                n_spots = backfill(cursor, month)
+                connection.commit()
+                print(f"Rebuilt the rollups of {month[0]:04d}-{month[1]:02d} from {n_spots} spots")
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""
+Filter WSPR spots at ingest time, before any database work.
+
+Filters are a plain dict, so they can be handed to worker processes, and are applied to each chunk with
+vectorised pandas operations. Every filter that is set must match for a spot to be kept.
+"""
+
+import re
+
+import pandas as pd
+
+import maidenhead
+
+wildcard_characters = set('*?[')
+
+# CSV columns each filter reads, so readers that project columns can include them
+filter_columns = {'after_spot_id': ('spot_id',),
+                  'bands': ('band',),
+                  'start': ('timestamp',),
+                  'end': ('timestamp',),
+                  'rx_calls': ('reporter',),
+                  'tx_calls': ('call_sign',),
+                  'bbox': ('reporters_grid', 'grid'),
+                  'grid_prefixes': ('reporters_grid', 'grid')}
+
+
+def build_filters(bands=None, start=None, end=None, rx_calls=None, tx_calls=None, bbox=None, grid_prefixes=None,
+                  after_spot_id=None):
+    """
+    Builds a filter dict. Every argument is optional.
+    :param bands: Iterable of band numbers as they appear in the CSV, e.g. 7 or 14.
+    :param start: First epoch timestamp to keep, inclusive.
+    :param end: Epoch timestamp to stop at, exclusive.
+    :param rx_calls: Iterable of receiver callsigns. Shell-style wildcards (*, ? and [...]) are allowed.
+    :param tx_calls: Iterable of transmitter callsigns. Shell-style wildcards are allowed.
+    :param bbox: (west, south, east, north) in degrees. Spots are kept if either end's grid centroid is inside.
+    :param grid_prefixes: Iterable of locator prefixes, e.g. FN or JO6. Spots are kept if either end's grid
+    starts with one of them.
+    :param after_spot_id: Only keep spots with a higher spot_id, e.g. the last one already loaded.
+    :return: Filter dict, or None if no filter is set.
+    """
+
+    filters = {}
+
+    if bands:
+        filters['bands'] = sorted({str(band) for band in bands})
+    if start is not None:
+        filters['start'] = int(start)
+    if end is not None:
+        filters['end'] = int(end)
+    if rx_calls:
+        filters['rx_calls'] = sorted({call.upper() for call in rx_calls})
+    if tx_calls:
+        filters['tx_calls'] = sorted({call.upper() for call in tx_calls})
+    if bbox is not None:
+        filters['bbox'] = tuple(float(value) for value in bbox)
+    if grid_prefixes:
+        filters['grid_prefixes'] = sorted({prefix.lower() for prefix in grid_prefixes})
+    if after_spot_id is not None:
+        filters['after_spot_id'] = int(after_spot_id)
+
+    return filters or None
+
+
+def parse_time(value):
+    """
+    Parses a time argument as an epoch timestamp.
+    :param value: Epoch seconds, or a date/time string such as 2020-01-15 or 2020-01-15T12:00. Times are UTC.
+    :return: Epoch timestamp.
+    """
+
+    if value.isdigit():
+        return int(value)
+
+    return int(pd.Timestamp(value, tz='UTC').timestamp())
+
+
+def parse_bbox(value):
+    """
+    Parses a west,south,east,north bounding box argument.
+    :param value: Comma separated bounds in degrees.
+    :return: (west, south, east, north) tuple.
+    """
+
+    bounds = tuple(float(bound) for bound in value.split(','))
+    if len(bounds) != 4:
+        raise ValueError(f"Bounding box needs 4 values, got {value}")
+
+    return bounds
+
+
+def glob_to_regex(pattern):
+    """
+    Converts a shell-style wildcard pattern to a regular expression that both Python and pyarrow-backed string
+    columns accept.
+    :param pattern: Pattern using *, ? and [...] or [!...].
+    :return: Regular expression string.
+    """
+
+    regex = re.escape(pattern).replace(r'\*', '.*').replace(r'\?', '.')
+    regex = regex.replace(r'\[', '[').replace(r'\]', ']').replace('[!', '[^')
+
+    return regex
+
+
+def match_calls(calls, patterns):
+    """
+    Matches callsigns against literal callsigns and wildcard patterns.
+    :param calls: Series of callsigns.
+    :param patterns: List of upper case callsigns or patterns.
+    :return: Boolean Series.
+    """
+
+    calls = calls.astype(str).str.upper()
+    literals = [pattern for pattern in patterns if not wildcard_characters & set(pattern)]
+    wildcards = [pattern for pattern in patterns if wildcard_characters & set(pattern)]
+
+    matched = calls.isin(literals)
+    if wildcards:
+        regex = '|'.join(f"(?:{glob_to_regex(pattern)})" for pattern in wildcards)
+        matched |= calls.str.fullmatch(regex)
+
+    return matched
+
+
+def in_bbox(grids, bbox):
+    """
+    Checks which grid centroids fall inside a bounding box.
+    :param grids: Series of locators.
+    :param bbox: (west, south, east, north) in degrees.
+    :return: Boolean array. False for invalid locators.
+    """
+
+    west, south, east, north = bbox
+    lon, lat, is_valid = maidenhead.decode(grids.to_numpy())
+
+    return is_valid & (lon >= west) & (lon <= east) & (lat >= south) & (lat <= north)
+
+
+def columns_used(filters):
+    """
+    Gets the CSV columns the filters read.
+    :param filters: Filter dict from build_filters(), or None.
+    :return: List of column names.
+    """
+
+    columns = []
+    for name in filters or {}:
+        columns += [column for column in filter_columns[name] if column not in columns]
+
+    return columns
+
+
+def apply_filters(csv_chunk, filters):
+    """
+    Drops the spots in a chunk that do not match the filters.
+    :param csv_chunk: DataFrame with the WSPR CSV columns.
+    :param filters: Filter dict from build_filters(), or None.
+    :return: Tuple of the filtered DataFrame and the number of spots dropped.
+    """
+
+    if not filters or csv_chunk.empty:
+        return csv_chunk, 0
+
+    keep = pd.Series(True, index=csv_chunk.index)
+
+    if 'after_spot_id' in filters:
+        keep &= csv_chunk['spot_id'] > filters['after_spot_id']
+    if 'bands' in filters:
+        keep &= csv_chunk['band'].astype(str).isin(filters['bands'])
+    if 'start' in filters:
+        keep &= csv_chunk['timestamp'] >= filters['start']
+    if 'end' in filters:
+        keep &= csv_chunk['timestamp'] < filters['end']
+    if 'rx_calls' in filters:
+        keep &= match_calls(csv_chunk['reporter'], filters['rx_calls'])
+    if 'tx_calls' in filters:
+        keep &= match_calls(csv_chunk['call_sign'], filters['tx_calls'])
+    if 'bbox' in filters:
+        keep &= in_bbox(csv_chunk['reporters_grid'], filters['bbox']) | in_bbox(csv_chunk['grid'], filters['bbox'])
+    if 'grid_prefixes' in filters:
+        prefixes = tuple(filters['grid_prefixes'])
+        keep &= (csv_chunk['reporters_grid'].astype(str).str.lower().str.startswith(prefixes) |
+                 csv_chunk['grid'].astype(str).str.lower().str.startswith(prefixes))
+
+    return csv_chunk[keep], int((~keep).sum())
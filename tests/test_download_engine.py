@@ -0,0 +1,190 @@
+import gzip
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import download_engine
+
+content = bytes(range(256)) * 1200
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    Serves the server's body with Range and If-Range support, failing or dropping connections as it is told to.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.headers.get('Range'), self.headers.get('If-Range')))
+
+        if server.failures:
+            status = server.failures.pop(0)
+            self.send_response(status)
+            if status == 429:
+                self.send_header('Retry-After', '2')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = server.body
+        start = 0
+        byte_range = self.headers.get('Range')
+        if byte_range and self.headers.get('If-Range') in (None, server.etag):
+            start = int(byte_range.removeprefix('bytes=').split('-')[0])
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Range', f"bytes */{len(body)}")
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{len(body) - 1}/{len(body)}")
+        else:
+            self.send_response(200)
+        self.send_header('ETag', server.etag)
+        self.send_header('Content-Length', str(len(body) - start))
+        if server.encoding:
+            self.send_header('Content-Encoding', server.encoding)
+        self.end_headers()
+
+        if server.drop_after is not None:  # Send part of the body, then close the connection
+            self.wfile.write(body[start:start + server.drop_after])
+            server.drop_after = None
+            self.close_connection = True
+            return
+        self.wfile.write(body[start:])
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(download_engine, 'base_backoff', 0.01)
+
+    http_server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    http_server.body = content
+    http_server.etag = '"v1"'
+    http_server.encoding = None
+    http_server.drop_after = None
+    http_server.failures = []
+    http_server.requests = []
+    http_server.url = f"http://127.0.0.1:{http_server.server_address[1]}/wsprspots-2020-01.csv.gz"
+
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    yield http_server
+    http_server.shutdown()
+    http_server.server_close()
+
+
+def read(path):
+    with open(path, 'rb') as downloaded:
+        return downloaded.read()
+
+
+def write_part(path, data, validator):
+    with open(download_engine.part_path(path), 'wb') as part_file:
+        part_file.write(data)
+    with open(download_engine.validator_path(path), 'w') as validator_file:
+        validator_file.write(validator)
+
+
+def test_dropped_connection_is_resumed(server, tmp_path):
+    path = str(tmp_path / 'spots.csv.gz')
+    server.drop_after = 100000
+
+    download_engine.download_file(server.url, path, retries=3)
+
+    assert read(path) == content
+    assert server.requests == [(None, None), ('bytes=100000-', '"v1"')]
+    assert not os.path.exists(download_engine.part_path(path))
+    assert not os.path.exists(download_engine.validator_path(path))
+
+
+def test_changed_file_is_downloaded_again(server, tmp_path):
+    path = str(tmp_path / 'spots.csv.gz')
+    write_part(path, b'x' * 5000, '"v0"')
+
+    download_engine.download_file(server.url, path, retries=1)
+
+    assert read(path) == content
+    assert server.requests == [('bytes=5000-', '"v0"')]
+
+
+def test_part_without_validator_is_discarded(server, tmp_path):
+    path = str(tmp_path / 'spots.csv.gz')
+    with open(download_engine.part_path(path), 'wb') as part_file:
+        part_file.write(b'x' * 5000)
+
+    download_engine.download_file(server.url, path, retries=1)
+
+    assert read(path) == content
+    assert server.requests == [(None, None)]
+
+
+def test_complete_part_is_accepted_on_416(server, tmp_path):
+    path = str(tmp_path / 'spots.csv.gz')
+    write_part(path, content, '"v1"')
+
+    download_engine.download_file(server.url, path, retries=1)
+
+    assert read(path) == content
+    assert server.requests == [(f"bytes={len(content)}-", '"v1"')]
+
+
+def test_oversized_part_is_discarded_on_416(server, tmp_path):
+    path = str(tmp_path / 'spots.csv.gz')
+    write_part(path, content + b'x' * 10, '"v1"')
+
+    download_engine.download_file(server.url, path, retries=2)
+
+    assert read(path) == content
+    assert server.requests == [(f"bytes={len(content) + 10}-", '"v1"'), (None, None)]
+
+
+def test_429_and_5xx_are_retried_with_backoff(server, tmp_path, monkeypatch):
+    path = str(tmp_path / 'spots.csv.gz')
+    server.failures = [429, 503]
+    delays = []
+    monkeypatch.setattr(download_engine.time, 'sleep', delays.append)
+
+    download_engine.download_file(server.url, path, retries=3)
+
+    assert read(path) == content
+    assert len(server.requests) == 3
+    assert delays[0] == 2.0  # Retry-After
+    assert download_engine.base_backoff <= delays[1] <= 2 * download_engine.base_backoff
+
+
+def test_gives_up_after_retries(server, tmp_path, monkeypatch):
+    path = str(tmp_path / 'spots.csv.gz')
+    server.failures = [503, 503]
+    monkeypatch.setattr(download_engine.time, 'sleep', lambda delay: None)
+
+    with pytest.raises(download_engine.DownloadError):
+        download_engine.download_file(server.url, path, retries=2)
+
+    assert not os.path.exists(path)
+
+
+def test_other_errors_are_not_retried(server, tmp_path):
+    path = str(tmp_path / 'spots.csv.gz')
+    server.failures = [404]
+
+    with pytest.raises(download_engine.DownloadError):
+        download_engine.download_file(server.url, path, retries=3)
+
+    assert len(server.requests) == 1
+
+
+def test_content_encoding_is_kept(server, tmp_path):
+    path = str(tmp_path / 'spots.csv.gz')
+    server.body = gzip.compress(content)
+    server.encoding = 'gzip'
+
+    download_engine.download_file(server.url, path, retries=1)
+
+    assert read(path) == server.body
@@ -0,0 +1,60 @@
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import parquet_cache
+import wspr_csv
+
+
+def write_cache_file(cache_root, csv_path, group_sizes):
+    """
+    Writes a CSV of sum(group_sizes) spots and puts it in the cache as one file with the given row groups.
+    :return: Path of the Parquet file.
+    """
+
+    with open(csv_path, 'w') as csv_file:
+        for i in range(sum(group_sizes)):
+            csv_file.write(f"{i},{1577836800 + i},K{i}ABC,FN42,-10,14.097062,W{i}X,EM10ab,37,0,1000,45,14,2.1,0\n")
+
+    chunk, _ = next(wspr_csv.read_range(csv_path, 0, os.path.getsize(csv_path), 10 ** 6))
+    table = parquet_cache.to_record_batch(chunk).to_pandas().drop(columns=['month', 'band'])
+
+    directory = os.path.join(cache_root, 'month=2020-01', 'band=14')
+    os.makedirs(directory)
+    path = os.path.join(directory, 'test-0.parquet')
+
+    arrow_table = pa.Table.from_pandas(table, preserve_index=False)
+    with pq.ParquetWriter(path, arrow_table.schema) as writer:
+        start = 0
+        for size in group_sizes:
+            writer.write_table(arrow_table.slice(start, size), row_group_size=size)
+            start += size
+
+    assert [pq.ParquetFile(path).metadata.row_group(i).num_rows for i in range(len(group_sizes))] == group_sizes
+
+    return path
+
+
+@pytest.mark.parametrize('group_sizes', [[100, 50, 10], [59, 61, 61, 38, 55, 65]])
+def test_read_file_resumes_across_uneven_row_groups(tmp_path, group_sizes):
+    cache_root = str(tmp_path / 'cache')
+    path = write_cache_file(cache_root, str(tmp_path / 'test.csv'), group_sizes)
+    n_rows = sum(group_sizes)
+
+    full = [spot_id for chunk, _ in parquet_cache.read_file(cache_root, path, 0, 7)
+            for spot_id in chunk['spot_id'].tolist()]
+    assert full == list(range(n_rows))
+
+    for start_row in range(n_rows + 1):
+        offsets = []
+        spot_ids = []
+        for chunk, offset in parquet_cache.read_file(cache_root, path, start_row, 7):
+            spot_ids += chunk['spot_id'].tolist()
+            offsets.append(offset)
+
+        assert spot_ids == full[start_row:], start_row
+        assert offsets == sorted(offsets)
+        if offsets:
+            assert offsets[-1] == n_rows
@@ -0,0 +1,49 @@
+import gzip
+
+import pytest
+
+import wspr_csv
+
+
+def write_gzip(path, n_rows):
+    """
+    Writes a .csv.gz of n_rows spots, compressed as two concatenated members.
+    :return: The compressed bytes.
+    """
+
+    lines = [f"{i},{1577836800 + i},K{i}ABC,FN42,-10,14.097062,W{i}X,EM10ab,37,0,1000,45,14,2.1,0\n"
+             for i in range(n_rows)]
+    half = n_rows // 2
+    data = (gzip.compress(''.join(lines[:half]).encode(), compresslevel=1)
+            + gzip.compress(''.join(lines[half:]).encode(), compresslevel=1))
+    with open(path, 'wb') as gzip_file:
+        gzip_file.write(data)
+
+    return data
+
+
+def test_read_gzip_reads_every_member(tmp_path):
+    path = str(tmp_path / 'spots.csv.gz')
+    write_gzip(path, 20000)
+
+    spot_ids = [spot_id for chunk, _ in wspr_csv.read_gzip(path, 0, 3000) for spot_id in chunk['spot_id'].tolist()]
+
+    assert spot_ids == list(range(20000))
+
+
+def test_read_gzip_raises_on_truncated_file(tmp_path):
+    path = str(tmp_path / 'spots.csv.gz')
+    data = write_gzip(path, 20000)
+    with open(path, 'wb') as gzip_file:
+        gzip_file.write(data[:len(data) // 4])
+
+    with pytest.raises(EOFError):
+        for _ in wspr_csv.read_gzip(path, 0, 3000):
+            pass
+
+
+def test_read_gzip_of_empty_file(tmp_path):
+    path = str(tmp_path / 'spots.csv.gz')
+    open(path, 'wb').close()
+
+    assert list(wspr_csv.read_gzip(path, 0, 3000)) == []
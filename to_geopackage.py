@@ -1,232 +1,176 @@
-import csv
+import argparse
 import os
 
 import fiona
-import psycopg2
-import configparser
+import numpy as np
 from fiona.crs import from_string
 
+import maidenhead
+import parquet_cache
+import wspr_csv
+
 """
-Creates a geopackage file out of the CSV files downloaded using the download.py script
+Creates a geopackage file out of the CSV files downloaded using the download.py script. Spots are read, located
+and written a chunk at a time, so memory use does not grow with the input.
 """
 
-# TODO: Migrate to geoalchemy
-
-config = configparser.ConfigParser()
-config.read("config")
-
-db_user = config['DB']['db_user']
-db_pass = config['DB']['db_pass']
-db_host = config['DB']['db_host']
-db_name = config['DB']['db_name']
-
-print("DB Configuration:")
-print(f"DB User: {db_user}")
-print(f"DB Password: {db_pass}")
-print(f"DB Host: {db_host}")
-print(f"DB Name: {db_name}")
-
 # WGS84 Projection￿
 crs = from_string('+proj=longlat +ellps=WGS84 +datum=WGS84 +n_defs')
 
-# PG Stuff
-pg_connection = psycopg2.connect(database=db_name, user=db_user, password=db_pass, host=db_host)
-cursor = pg_connection.cursor()
-
-# Create the schema
+# Create the schema. The timestamp comes last, as fiona 1.10 mis-assigns text fields that follow a datetime field.
 schema = {'geometry': 'Point',
           'properties': [('spot_id', 'int'),
-                         ('timestamp', 'datetime'),
                          ('reporter', 'str'),
                          ('reporter_grid', 'str'),
                          ('snr', 'int'),
-                         ('frequency', 'int'),
+                         ('frequency', 'float'),
                          ('call_sign', 'str'),
                          ('grid', 'str'),
-                         ('power', 'str'),
+                         ('power', 'int'),
                          ('drift', 'int'),
                          ('distance', 'int'),
                          ('azimuth', 'int'),
                          ('band', 'str'),
                          ('version', 'str'),
-                         ('code', 'str')]}
-
+                         ('code', 'str'),
+                         ('timestamp', 'datetime')]}
 
-def get_grid_centroids(grid):
-    """
-    Gets Maidenhead grid square centroid coordinates from PostGIS database
-    :param grid: string denoting Maidenhead grid square
-    :return: Lat/Lon tuple
-    """
-    accuracy = None
-
-    # Query polygon centroid
-    if len(grid) == 6:
-        accuracy = 6
-        cursor.execute(f"SELECT ST_Centroid(geom) as geom FROM vectors.maidenhead_grid WHERE "
-                       "subgrid = '{grid}'")
-
-    elif len(grid) == 4:
-        accuracy = 4
-        cursor.execute(f"SELECT ST_Centroid(geom) as geom FROM vectors.maidenhead_grid WHERE "
-                       "grid = '{grid}'")
+# CSV columns of the properties that are named differently
+property_columns = {'reporter_grid': 'reporters_grid'}
 
-    # Get the data out of the cursor
-    data = {'geom': None,
-            'accuracy': None}
+default_chunksize = 100000
 
-    for geom in cursor:
-        data = {'geom': geom,
-                'accuracy': accuracy}
 
-    return data
-
-
-def join_qso_to_grid(wspr_record):
+def chunk_features(chunk):
     """
-    Takes a row from the WSPR data as input and finds its grid. Then, the centroid for that grid is added to the
-    WSPR record.
-    :param qso_record: Line from WSPR data
-    :return: WSPR data as a shapely object
+    Converts a chunk of spots into GeoPackage features, located at the centroid of the TX grid.
+    :param chunk: DataFrame with the WSPR CSV columns.
+    :return: List of feature dicts. Spots with an invalid TX grid have no geometry.
     """
 
-    wspr_tx_grid = wspr_record["grid"].lower()
-    wspr_rx_grid = wspr_record["reporter_grid"].lower()
-
-    tx_grid = get_grid_centroids(wspr_tx_grid)
-    tx_grid_point = tx_grid["geom"]
-    tx_grid_accuracy = tx_grid["accuracy"]
+    lons, lats, is_valid = maidenhead.decode(chunk['grid'].to_numpy())
+    geometries = [{'type': 'Point', 'coordinates': (lon, lat)} if grid_valid else None
+                  for lon, lat, grid_valid in zip(lons.tolist(), lats.tolist(), is_valid.tolist())]
 
-    rx_grid = get_grid_centroids(wspr_rx_grid)
-    rx_grid_point = rx_grid["geom"]
-    rx_grid_accuracy = rx_grid["accuracy"]
+    names = [name for name, _ in schema['properties']]
+    columns = []
+    for name, field_type in schema['properties']:
+        values = chunk[property_columns.get(name, name)]
+        if field_type == 'datetime':
+            columns.append(np.datetime_as_string(values.to_numpy().astype('datetime64[s]')).tolist())
+        elif field_type == 'str':
+            columns.append(values.astype(object).where(values.notna(), None).tolist())
+        elif field_type == 'int':
+            columns.append(values.astype('int64').tolist())
+        else:
+            columns.append(values.tolist())
 
-    wspr_record["tx_point"] = tx_grid_point
-    wspr_record["tx_point_accuracy"] = tx_grid_accuracy
-    wspr_record["rx_point"] = rx_grid_point
-    wspr_record["rx_point_accuracy"] = rx_grid_accuracy
+    return [{'geometry': geometry, 'properties': dict(zip(names, row))}
+            for geometry, row in zip(geometries, zip(*columns))]
 
-    return wspr_record
 
+def create_geopackage(chunks, out_dir):
+    """
+    Writes spots to wspr_contacts.gpkg, replacing it, one chunk at a time. Each chunk is written with one
+    writerecords call, which fiona runs as a single transaction. GDAL defers building the spatial index of a new
+    layer until the file is closed, and then builds it in one pass instead of updating it with every insert.
+    :param chunks: Iterable of DataFrames with the WSPR CSV columns.
+    :param out_dir: Output directory.
+    :return: Number of features written.
+    """
 
-def create_geopackage(coords, out_dir):
-    # Open connection with gpkg file in a context manager and write features to it
     output_path = os.path.join(out_dir, "wspr_contacts.gpkg")
+    if os.path.exists(output_path):
+        os.remove(output_path)
 
+    n_features = 0
     with fiona.open(output_path, 'w',
                     layer='points',
                     driver='GPKG',
                     schema=schema,
                     crs=crs) as dst:
-        for qso in coords:  # TODO: Finish this
-            continue
-            # Create feature
-            # Write feature
+        for chunk in chunks:
+            features = chunk_features(chunk)
+            dst.writerecords(features)
+            n_features += len(features)
+            print(f"{n_features} records written")
+
+    return n_features
 
 
 def csvs_in_path(path):
     """
-    Finds CSVs in given path and returns the paths as a list
-    :param path: String denoting path to CSV files
+    Finds CSV and compressed .csv.gz files in given path and returns the paths as a list
+    :param path: String denoting path to CSV files, or a single file
     :return: List of CSV files in path
     """
 
+    if os.path.isfile(path):
+        return [path]
+
     csv_files = []
 
     for root, _, filenames in os.walk(path):
         for file in filenames:
-            if os.path.splitext(file)[1] == '.csv':
+            if file.endswith(('.csv', '.csv.gz')):
                 csv_path = os.path.join(root, file)
                 csv_files.append(csv_path)
 
-    return csv_files
+    return sorted(csv_files)
 
 
-def csv_to_dicts(csv_paths):
+def csv_chunks(csv_paths, chunksize=default_chunksize):
     """
-    Converts CSV file to list of dicts
-    :param csv_path: Path to WSPR CSV data
-    :return: List of dicts
+    Reads CSV files lazily, a chunk at a time. Malformed rows are skipped, and .csv.gz files are decompressed as
+    they are read.
+    :param csv_paths: Paths to WSPR CSV data
+    :param chunksize: Approximate rows per chunk
+    :return: Generator of DataFrames with the WSPR CSV columns
     """
-    n_records = 0
-    file_records = []
+
     for file in csv_paths:
         print(f"Processing {file}")
 
-        with open(file, 'r') as csv_file:
-            reader = csv.reader(csv_file)
-
-            for row in reader:
-                wspr_record = {}
-
-                wspr_record["spot_id"] = row[0]
-                wspr_record["timestamp"] = row[1]
-                wspr_record["reporter_call"] = row[2]
-                wspr_record["reporter_grid"] = row[3]
-                wspr_record["snr"] = row[4]
-                wspr_record["frequency"] = row[5]
-                wspr_record["call_sign"] = row[6]
-                wspr_record["grid"] = row[7]
-                wspr_record["power"] = row[8]
-                wspr_record["drift"] = row[9]
-                wspr_record["distance"] = row[10]
-                wspr_record["azimuth"] = row[11]
-                wspr_record["band"] = row[12]
-                wspr_record["version"] = row[13]
-                wspr_record["code"] = row[14]
-
-                file_records.append(wspr_record)
-
-    n_records += len(file_records)
-    print(f"{n_records} records processed\n")
+        if wspr_csv.is_gzip(file):
+            chunks = wspr_csv.read_gzip(file, 0, chunksize)
+        else:
+            chunks = wspr_csv.read_range(file, 0, os.path.getsize(file), chunksize)
 
-    return file_records
+        for chunk, _ in chunks:
+            yield chunk
 
 
-def station_list(records):
+def cache_chunks(cache_root, chunksize=default_chunksize, filters=None):
     """
-    Generate a dictionary containing unqique stations and their coordinates
-    :param records: list of WSPR QSO dictionaries
-    :return: List of dictionaries containing Call, Lat/Lon
+    Reads spots from a Parquet cache made by parquet_cache.py, a chunk at a time
+    :param cache_root: Path to the Parquet cache
+    :param chunksize: Maximum rows per chunk
+    :param filters: Optional filter dict from spot_filters.build_filters()
+    :return: Generator of DataFrames with the WSPR CSV columns
     """
 
-    stations = []
-
-    for record in records:
-        new_station = True
-        station = {}
-        rx_station = record["reporter_call"]
-        rx_point = record["rx_point"]
-        rx_point_accuracy = record["rx_point_accuracy"]
-        tx_station = record["call_sign"]
-        tx_point = record["tx_point"]
-        tx_point_accuracy = record["tx_point_accuracy"]
-
-        for station in stations:
-            if station == rx_station or station == tx_station:
-                new_station = False
-
-        if not new_station:
-            for call_sign in (rx_station, tx_station):
-                continue
-
-
-    return stations
+    for chunk, _ in parquet_cache.read_cache(cache_root, filters=filters, chunksize=chunksize):
+        yield chunk
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Export WSPR spots to a GeoPackage of points.")
+    parser.add_argument('input', nargs='?',
+                        help="CSV directory, single CSV file, or Parquet cache. Prompted for if omitted.")
+    parser.add_argument('--output-dir', default='.', help="Directory to write wspr_contacts.gpkg to.")
+    parser.add_argument('--chunksize', type=int, default=default_chunksize, help="Spots read and written at a time.")
+    args = parser.parse_args()
+
+    csv_path = args.input or input("CSV input directory or Parquet cache: ")
 
-    n_records = 0
-    file_records = 0
-    # geo_output_dir = input("geopackage output directory: ")
-    csv_path = input("CSV input directory: ")
+    if parquet_cache.is_cache(csv_path):
+        chunks = cache_chunks(csv_path, args.chunksize)
+    else:
+        chunks = csv_chunks(csvs_in_path(csv_path), args.chunksize)
 
-    csv_files = csvs_in_path(csv_path)
-    records = csv_to_dicts(csv_files)
+    n_records = create_geopackage(chunks, args.output_dir)
+    print(f"{n_records} records processed\n")
 
-    # Get points
-    for i, record in enumerate(records):
-        records[i] = join_qso_to_grid(record)
-        print(records[i])
 
-main()
+if __name__ == '__main__':
+    main()
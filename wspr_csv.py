@@ -0,0 +1,447 @@
+"""
+Read WSPR CSV archives in newline-aligned byte ranges.
+
+Files are memory-mapped and cut at line boundaries, so separate processes can each parse their own range of the
+same file, and progress can be reported from byte offsets without a separate pass to count lines. Blocks are
+parsed with fixed, compact dtypes for the 15-column WSPR layout, so pandas does no type inference, and the
+block size can be derived from a memory budget.
+
+Compressed .csv.gz archives, or an HTTP response body, can be read as a stream instead. A separate thread
+decompresses and cuts the stream into blocks, handing them to the parser through a bounded queue, so no
+extracted CSV is written to disk.
+"""
+
+import gzip
+import io
+import mmap
+import os
+import queue
+import re
+import threading
+import zlib
+
+import pandas as pd
+
+import metrics
+
+header = ('spot_id', 'timestamp', 'reporter', 'reporters_grid',
+          'snr', 'frequency', 'call_sign', 'grid', 'power', 'drift',
+          'distance', 'azimuth', 'band', 'version', 'code')
+
+# Compact dtypes for the WSPR columns. spot_id needs 64 bits, and frequency stays float64 because float32 keeps
+# about 7 significant digits, which would round off the Hz in a MHz frequency.
+dtypes = {'spot_id': 'int64',
+          'timestamp': 'int32',
+          'reporter': str,
+          'reporters_grid': str,
+          'snr': 'int16',
+          'frequency': 'float64',
+          'call_sign': str,
+          'grid': str,
+          'power': 'float32',
+          'drift': 'int16',
+          'distance': 'int32',
+          'azimuth': 'int16',
+          'band': str,
+          'version': str,
+          'code': str}
+
+# Parsed as strings, so version 1.10 is not read as the number 1.1, then converted to categoricals
+categorical_columns = ('band', 'version', 'code')
+
+# Columns that must be present for a row to be loaded
+required_columns = tuple(column for column in header if column not in ('version', 'code'))
+
+memory_units = {'': 1, 'B': 1, 'K': 1024, 'KB': 1024, 'M': 1024 ** 2, 'MB': 1024 ** 2,
+                'G': 1024 ** 3, 'GB': 1024 ** 3}
+
+# A chunk is held as raw bytes, as a DataFrame and again as text in the COPY buffer. Raw bytes are counted this
+# many times on top of the DataFrame when sizing chunks.
+raw_copies = 2
+
+# Ranges smaller than this are not worth a separate worker
+min_range_bytes = 64 * 1024 * 1024
+
+# Bytes sampled from the start of a file to estimate the average row length
+row_sample_bytes = 64 * 1024
+
+# Average row length assumed for streams that cannot be sampled in advance
+stream_row_bytes = 110
+
+# Compressed bytes read at a time, and decompressed blocks buffered ahead of the parser, when streaming
+stream_read_bytes = 1024 * 1024
+stream_queue_blocks = 4
+
+
+def is_gzip(csv_path):
+    """
+    Checks whether a path is a gzip-compressed CSV.
+    :param csv_path: Path to the file.
+    :return: True for .gz files.
+    """
+
+    return csv_path.endswith('.gz')
+
+
+def read_sample(csv_path):
+    """
+    Reads the start of a CSV file, decompressing it if needed.
+    :param csv_path: Path to the file.
+    :return: Up to row_sample_bytes bytes.
+    """
+
+    with (gzip.open if is_gzip(csv_path) else open)(csv_path, 'rb') as csv_file:
+        return csv_file.read(row_sample_bytes)
+
+
+def open_mmap(csv_path):
+    """
+    Memory-maps a file read-only.
+    :param csv_path: Path to the file.
+    :return: mmap object, or None for an empty file.
+    """
+
+    if os.path.getsize(csv_path) == 0:
+        return None
+
+    with open(csv_path, 'rb') as csv_file:
+        return mmap.mmap(csv_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def line_end(mm, offset):
+    """
+    Finds the start of the line following an offset.
+    :param mm: mmap of the file.
+    :param offset: Byte offset.
+    :return: Offset just past the next newline at or after offset, or the file size if there is none.
+    """
+
+    if offset <= 0:
+        return 0
+
+    newline = mm.find(b'\n', offset - 1)
+
+    return len(mm) if newline == -1 else newline + 1
+
+
+def split_ranges(csv_path, n_ranges, min_bytes=min_range_bytes):
+    """
+    Cuts a file into newline-aligned byte ranges of roughly equal size.
+    :param csv_path: Path to the CSV file.
+    :param n_ranges: Maximum number of ranges.
+    :param min_bytes: Smallest range worth splitting off. Small files get fewer ranges.
+    :return: List of (start, end) byte offsets. Empty for an empty file.
+    """
+
+    size = os.path.getsize(csv_path)
+    if size == 0:
+        return []
+
+    n_ranges = max(1, min(n_ranges, -(-size // min_bytes)))
+
+    mm = open_mmap(csv_path)
+    try:
+        cuts = [line_end(mm, size * i // n_ranges) for i in range(n_ranges)] + [size]
+    finally:
+        mm.close()
+
+    return [(start, end) for start, end in zip(cuts, cuts[1:]) if end > start]
+
+
+def estimate_row_bytes(csv_path):
+    """
+    Estimates the average length of a row from the start of a file.
+    :param csv_path: Path to the CSV file.
+    :return: Average bytes per row.
+    """
+
+    sample = read_sample(csv_path)
+
+    n_lines = sample.count(b'\n')
+    if n_lines == 0:
+        return max(len(sample), 1)
+
+    return max(sample.rindex(b'\n') + 1, 1) / n_lines
+
+
+def iter_blocks(mm, start, end, block_bytes):
+    """
+    Cuts a byte range into newline-aligned blocks.
+    :param mm: mmap of the file.
+    :param start: Start offset. Must be at the start of a line.
+    :param end: End offset. Must be at the start of a line or the end of the file.
+    :param block_bytes: Target block size. A block is longer if a single line is.
+    :return: Generator of (block_start, block_end) offsets.
+    """
+
+    position = start
+    while position < end:
+        block_end = end
+        if position + block_bytes < end:
+            newline = mm.rfind(b'\n', position, position + block_bytes)
+            if newline == -1:
+                newline = mm.find(b'\n', position + block_bytes, end)
+            if newline != -1:
+                block_end = newline + 1
+
+        yield position, block_end
+        position = block_end
+
+
+def coerce_frame(frame):
+    """
+    Converts a frame parsed as strings to the WSPR dtypes, dropping rows whose required fields are missing or
+    not numeric.
+    :param frame: DataFrame with the header columns as strings.
+    :return: DataFrame with the WSPR dtypes.
+    """
+
+    for column, dtype in dtypes.items():
+        if dtype is not str:
+            frame[column] = pd.to_numeric(frame[column], errors='coerce')
+
+    return frame.dropna(subset=list(required_columns)).astype(dtypes)
+
+
+def read_pyarrow(data):
+    """
+    Parses CSV lines with pyarrow's multithreaded reader. pyarrow is only imported when this engine is used.
+    Lines with the wrong number of fields are skipped, and rows with missing required fields are dropped.
+    :param data: Bytes containing whole lines.
+    :return: DataFrame with the WSPR dtypes.
+    """
+
+    import pyarrow as pa
+    import pyarrow.csv
+
+    arrow_types = {column: pa.string() if dtype is str else pa.from_numpy_dtype(dtype)
+                   for column, dtype in dtypes.items()}
+
+    table = pyarrow.csv.read_csv(
+        io.BytesIO(data),
+        read_options=pyarrow.csv.ReadOptions(column_names=list(header)),
+        parse_options=pyarrow.csv.ParseOptions(invalid_row_handler=lambda row: 'skip'),
+        convert_options=pyarrow.csv.ConvertOptions(column_types=arrow_types, strings_can_be_null=True))
+    frame = table.to_pandas()
+
+    # Empty numeric fields come through as nulls rather than errors
+    if frame[list(required_columns)].isna().any(axis=None):
+        return coerce_frame(frame)
+
+    return frame.astype(dtypes)
+
+
+def parse_block(data, engine='c'):
+    """
+    Parses a block of WSPR CSV lines. Lines with the wrong number of fields are skipped, and if any line has
+    a missing or non-numeric value the block is re-parsed as strings and those rows dropped. The number of
+    lines that did not make it into the frame is stored in frame.attrs['malformed'].
+    :param data: Bytes containing whole lines.
+    :param engine: pandas CSV engine, 'c' or 'pyarrow'.
+    :return: DataFrame with the header columns and WSPR dtypes.
+    """
+
+    read_options = {'header': None, 'names': header, 'on_bad_lines': 'skip'}
+
+    with metrics.timer('parse'):
+        try:
+            if engine == 'pyarrow':
+                frame = read_pyarrow(data)
+            else:
+                frame = pd.read_csv(io.BytesIO(data), dtype=dtypes, engine=engine, **read_options)
+        except ValueError:
+            frame = coerce_frame(pd.read_csv(io.BytesIO(data), dtype=str, **read_options))
+
+        frame = frame.astype({column: 'category' for column in categorical_columns})
+
+    n_lines = data.count(b'\n') + (0 if data.endswith(b'\n') else 1)
+    frame.attrs['malformed'] = n_lines - len(frame)
+
+    return frame
+
+
+def parse_memory(value):
+    """
+    Parses a memory size such as 512MB or 2G.
+    :param value: Size string. Units are B, K/KB, M/MB or G/GB, in powers of 1024.
+    :return: Size in bytes.
+    """
+
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMG]?B?)\s*", value.upper())
+    if match is None:
+        raise ValueError(f"Invalid memory size: {value}")
+
+    return int(float(match.group(1)) * memory_units[match.group(2)])
+
+
+def chunksize_for_memory(csv_path, max_memory, engine='c'):
+    """
+    Picks the number of rows per chunk that keeps one chunk within a memory budget, by parsing a sample from
+    the start of the file.
+    :param csv_path: Path to the CSV file.
+    :param max_memory: Memory budget in bytes for one chunk.
+    :param engine: pandas CSV engine.
+    :return: Rows per chunk.
+    """
+
+    sample = read_sample(csv_path)
+    sample = sample[:sample.rfind(b'\n') + 1] or sample
+
+    frame = parse_block(sample, engine)
+    if frame.empty:
+        return 1
+
+    row_bytes = raw_copies * len(sample) / len(frame) + frame.memory_usage(deep=True).sum() / len(frame)
+
+    return max(int(max_memory / row_bytes), 1)
+
+
+def read_range(csv_path, start, end, chunksize, engine='c'):
+    """
+    Reads a byte range of a WSPR CSV file in chunks.
+    :param csv_path: Path to the CSV file.
+    :param start: Start offset, from split_ranges().
+    :param end: End offset, from split_ranges().
+    :param chunksize: Approximate rows per chunk.
+    :param engine: pandas CSV engine, 'c' or 'pyarrow'.
+    :return: Generator of (DataFrame, end offset of the chunk) tuples.
+    """
+
+    block_bytes = max(int(chunksize * estimate_row_bytes(csv_path)), 1)
+
+    mm = open_mmap(csv_path)
+    if mm is None:
+        return
+
+    try:
+        for block_start, block_end in iter_blocks(mm, start, end, block_bytes):
+            yield parse_block(mm[block_start:block_end], engine), block_end
+    finally:
+        mm.close()
+
+
+def decompress_blocks(raw, blocks, block_bytes, skip_bytes=0, compressed=True, stop=None):
+    """
+    Reads a stream, decompressing it if needed, and puts newline-aligned blocks on a queue. Runs on its own
+    thread. Ends with None on the queue, or with the exception that stopped it.
+    :param raw: Binary file object, e.g. an open .csv.gz file or an HTTP response body.
+    :param blocks: queue.Queue receiving (block bytes, decompressed offset at the end of the block) tuples.
+    :param block_bytes: Target block size. A block is longer if a single line is.
+    :param skip_bytes: Decompressed bytes to drop from the start of the stream, to resume after them. Must be at
+    the start of a line.
+    :param compressed: Whether the stream is gzip-compressed. Concatenated gzip members are read in turn, and a
+    stream that ends inside a member raises EOFError.
+    :param stop: Optional threading.Event. When set, the thread stops putting blocks on the queue.
+    """
+
+    def put(item):
+        while stop is None or not stop.is_set():
+            try:
+                blocks.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    try:
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        pending = bytearray()
+        offset = 0
+        received = False
+
+        while True:
+            data = raw.read(stream_read_bytes)
+
+            if compressed:
+                with metrics.timer('decompress'):
+                    output = decompressor.decompress(data) if data else decompressor.flush()
+                    while decompressor.eof and decompressor.unused_data:
+                        unused = decompressor.unused_data
+                        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                        output += decompressor.decompress(unused)
+                received = received or bool(data)
+                if not data and received and not decompressor.eof:  # Truncated, not finished
+                    raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+                metrics.count('bytes_decompressed', len(output))
+            else:
+                output = data
+
+            if skip_bytes > offset:
+                dropped = min(skip_bytes - offset, len(output))
+                offset += dropped
+                output = output[dropped:]
+            pending += output
+
+            while len(pending) > block_bytes or (not data and pending):
+                cut = pending.rfind(b'\n', 0, block_bytes)
+                if cut == -1:
+                    cut = pending.find(b'\n', block_bytes)
+                if cut == -1:
+                    if data:  # Wait for the rest of the line
+                        break
+                    cut = len(pending) - 1
+
+                block = bytes(pending[:cut + 1])
+                del pending[:cut + 1]
+                offset += len(block)
+                if not put((block, offset)):
+                    return
+
+            if not data:
+                break
+
+        put(None)
+
+    except Exception as e:
+        put(e)
+
+
+def read_stream(raw, chunksize, engine='c', start=0, compressed=True, row_bytes=stream_row_bytes):
+    """
+    Reads WSPR CSV lines from a stream in chunks, decompressing on a separate thread.
+    :param raw: Binary file object, e.g. an open .csv.gz file or an HTTP response body.
+    :param chunksize: Approximate rows per chunk.
+    :param engine: pandas CSV engine, 'c' or 'pyarrow'.
+    :param start: Decompressed offset to resume from, from an earlier chunk.
+    :param compressed: Whether the stream is gzip-compressed.
+    :param row_bytes: Average row length used to turn chunksize into a block size.
+    :return: Generator of (DataFrame, decompressed offset at the end of the chunk) tuples.
+    """
+
+    blocks = queue.Queue(maxsize=stream_queue_blocks)
+    stop = threading.Event()
+    decompressor = threading.Thread(target=decompress_blocks,
+                                    args=(raw, blocks, max(int(chunksize * row_bytes), 1), start, compressed, stop),
+                                    daemon=True)
+    decompressor.start()
+
+    try:
+        while True:
+            item = blocks.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+
+            block, offset = item
+            yield parse_block(block, engine), offset
+    finally:
+        stop.set()
+        decompressor.join()
+
+
+def read_gzip(csv_path, start, chunksize, engine='c'):
+    """
+    Reads a .csv.gz file in chunks without extracting it.
+    :param csv_path: Path to the .csv.gz file.
+    :param start: Decompressed offset to resume from, from an earlier chunk.
+    :param chunksize: Approximate rows per chunk.
+    :param engine: pandas CSV engine, 'c' or 'pyarrow'.
+    :return: Generator of (DataFrame, decompressed offset at the end of the chunk) tuples.
+    """
+
+    row_bytes = estimate_row_bytes(csv_path)
+
+    with open(csv_path, 'rb') as raw:
+        yield from read_stream(raw, chunksize, engine, start, row_bytes=row_bytes)
@@ -1,18 +1,10 @@
 from geoalchemy2 import *
 from sqlalchemy import *
 from sqlalchemy.ext.declarative import declarative_base
-import configparser
-
-config = configparser.ConfigParser()
-config.read("config")
-
-db_user = config['DB']['db_user']
-db_pass = config['DB']['db_pass']
-db_host = config['DB']['db_host']
-db_name = config['DB']['db_name']
 
 """
-Define PG database & tables
+Define PG database & tables. Importing the models connects to nothing; see database.py for the engine and
+create_schema() to create the tables.
 """
 
 Base = declarative_base()
@@ -37,10 +29,13 @@ class maidenhead_subgrid(Base):
 
 class wsprContact(Base):
     __tablename__ = 'wspr_data'
-    __table_args__ = {"schema": "wspr"}
+    # Range partitioned by month on timestamp, see partitions.py. Unique keys on a partitioned table must
+    # include the partition key, so spots are de-duplicated on (spot_id, timestamp).
+    __table_args__ = (Index('wspr_data_spot_id_timestamp_key', 'spot_id', 'timestamp', unique=True),
+                      {"schema": "wspr", "postgresql_partition_by": "RANGE (timestamp)"})
     id = Column(Integer, primary_key=True, autoincrement=True)
     spot_id = Column(Integer, primary_key=True)
-    timestamp = Column('timestamp', Integer, nullable=False)
+    timestamp = Column('timestamp', Integer, primary_key=True, nullable=False)
     rx_call = Column('rx_call', String(15), nullable=False)
     tx_call = Column('tx_call', String(15), nullable=False)
     rx_grid = Column('rx_grid', String(6), nullable=False)
@@ -54,6 +49,12 @@ class wsprContact(Base):
     band = Column('band', Integer, nullable=False)
     version = Column('version', String, nullable=True)
     code = Column('code', String, nullable=True)
+    # Great-circle path from TX to RX, loaded with csv_to_pg.py --paths, which also creates its GiST index
+    path = Column('path', Geometry(geometry_type='MULTILINESTRING', srid=4326, spatial_index=False), nullable=True)
+
+    # Only the COPY loader writes paths, so ORM inserts leave out the column, which databases created before it
+    # was added do not have
+    __mapper_args__ = {'exclude_properties': ['path']}
 
 
 class operator(Base):
@@ -65,8 +66,126 @@ class operator(Base):
     geog = Column('geom', Geometry(geometry_type='POINT', srid=4326), nullable=True)
 
 
-engine = create_engine(f'postgresql://{db_user}:{db_pass}@{db_host}/{db_name}')
+# One row per callsign and 4-char grid. Used as the ON CONFLICT target when upserting operators.
+Index('operators_callsign_base_grid_key', operator.callsign, func.left(operator.grid, 4), unique=True)
+
+
+class ingest_journal(Base):
+    __tablename__ = "ingest_journal"
+    __table_args__ = (UniqueConstraint('path', 'size', 'mtime_ns', 'filters', 'range_start'),
+                      {"schema": "wspr"})
+    id = Column(Integer, primary_key=True)
+    path = Column('path', String, nullable=False)
+    size = Column('size', BigInteger, nullable=False)
+    mtime_ns = Column('mtime_ns', BigInteger, nullable=False)
+    filters = Column('filters', String, nullable=False, server_default='')
+    range_start = Column('range_start', BigInteger, nullable=False)
+    range_end = Column('range_end', BigInteger, nullable=False)
+    committed_offset = Column('committed_offset', BigInteger, nullable=False)
+    completed = Column('completed', Boolean, nullable=False, default=False)
+    updated = Column('updated', DateTime(timezone=True), server_default=func.now())
+
+
+# Rollups of the spots, kept up to date by the loaders, see rollups.py. Grids are the 4-char grid in upper case.
+class grid_band_hour(Base):
+    __tablename__ = "grid_band_hour"
+    # One row per SNR, so the SNR distribution of each grid, band and hour is kept
+    __table_args__ = {"schema": "wspr"}
+    tx_grid = Column('tx_grid', String(4), primary_key=True)
+    band = Column('band', SmallInteger, primary_key=True)
+    hour = Column('hour', DateTime(timezone=True), primary_key=True)
+    snr = Column('snr', SmallInteger, primary_key=True)
+    spots = Column('spots', Integer, nullable=False)
+    max_distance = Column('max_distance', Integer, nullable=False)
+
+
+class path_pair_day(Base):
+    __tablename__ = "path_pair_day"
+    __table_args__ = {"schema": "wspr"}
+    rx_grid = Column('rx_grid', String(4), primary_key=True)
+    tx_grid = Column('tx_grid', String(4), primary_key=True)
+    band = Column('band', SmallInteger, primary_key=True)
+    day = Column('day', Date, primary_key=True)
+    spots = Column('spots', Integer, nullable=False)
+    snr_sum = Column('snr_sum', BigInteger, nullable=False)
+    max_snr = Column('max_snr', SmallInteger, nullable=False)
+    max_distance = Column('max_distance', Integer, nullable=False)
+
+
+# Spots, lower median and mean SNR and longest distance per TX grid, band and hour. Filters on the grid, band and
+# hour are applied before the SNR rows are summed.
+grid_band_hour_stats_sql = """
+    CREATE OR REPLACE VIEW wspr.grid_band_hour_stats AS
+    SELECT tx_grid, band, hour,
+           sum(spots) AS spots,
+           min(snr) FILTER (WHERE 2 * running >= total) AS median_snr,
+           sum(snr * spots)::double precision / sum(spots) AS mean_snr,
+           min(snr) AS min_snr,
+           max(snr) AS max_snr,
+           max(max_distance) AS max_distance
+    FROM (SELECT *,
+                 sum(spots) OVER (PARTITION BY tx_grid, band, hour ORDER BY snr) AS running,
+                 sum(spots) OVER (PARTITION BY tx_grid, band, hour) AS total
+          FROM wspr.grid_band_hour) AS histogram
+    GROUP BY tx_grid, band, hour
+"""
+
+
+# Compact layout, see compact_schema.py. Kept on its own metadata so its tables are only created when a database
+# is converted to it, after which wspr_data is a view over them.
+compact_metadata = MetaData()
+CompactBase = declarative_base(metadata=compact_metadata)
+
+
+class spot_version(CompactBase):
+    __tablename__ = "versions"
+    __table_args__ = {"schema": "wspr"}
+    id = Column(SmallInteger, Identity(), primary_key=True)
+    version = Column('version', String, nullable=False, unique=True)
+
+
+class spot_code(CompactBase):
+    __tablename__ = "codes"
+    __table_args__ = {"schema": "wspr"}
+    id = Column(SmallInteger, Identity(), primary_key=True)
+    code = Column('code', String, nullable=False, unique=True)
+
+
+class spot(CompactBase):
+    __tablename__ = "spots"
+    # Range partitioned by month on time, see partitions.py. rx_id and tx_id are operators.id and version_id and
+    # code_id ids in the lookup tables, but are not declared as foreign keys so bulk loads do no per-row checks.
+    __table_args__ = {"schema": "wspr", "postgresql_partition_by": "RANGE (time)"}
+    spot_id = Column('spot_id', BigInteger, primary_key=True)
+    time = Column('time', DateTime(timezone=True), primary_key=True)
+    rx_id = Column('rx_id', Integer, nullable=False)
+    tx_id = Column('tx_id', Integer, nullable=False)
+    snr = Column('snr', SmallInteger, nullable=False)
+    frequency = Column('frequency', Float, nullable=False)
+    power = Column('power', REAL, nullable=False)
+    drift = Column('drift', SmallInteger, nullable=False)
+    distance = Column('distance', Integer, nullable=False)
+    azimuth = Column('azimuth', SmallInteger, nullable=False)
+    band = Column('band', SmallInteger, nullable=False)
+    version_id = Column('version_id', SmallInteger, nullable=True)
+    code_id = Column('code_id', SmallInteger, nullable=True)
+    path = Column('path', Geometry(geometry_type='MULTILINESTRING', srid=4326, spatial_index=False), nullable=True)
+
+
 metadata = MetaData(schema="wspr")
 
-# Create the tables
-Base.metadata.create_all(engine)
+
+def create_schema(engine):
+    """
+    Creates the wspr schema and any of its tables and views that are missing. The compact layout's tables are
+    created by compact_schema.py instead.
+    :param engine: SQLAlchemy engine.
+    """
+
+    with engine.begin() as connection:
+        connection.execute(text("CREATE SCHEMA IF NOT EXISTS wspr"))
+
+    Base.metadata.create_all(engine)
+
+    with engine.begin() as connection:
+        connection.execute(text(grid_band_hour_stats_sql))
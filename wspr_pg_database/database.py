@@ -0,0 +1,90 @@
+"""
+The database engine and connection pool shared by all scripts.
+
+Nothing is read or connected until get_engine() is first called, so importing the models or a script costs no
+round trips. Connections are pinged when taken from the pool, so ones the server has dropped are replaced, and can
+carry a statement timeout. A forked process, such as a csv_to_pg.py worker, drops its inherited copy of the pool
+without closing the parent's sockets and opens its own connections.
+"""
+
+import os
+import threading
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import URL
+from sqlalchemy.orm import sessionmaker
+
+import conf_reader
+import metrics
+
+engine = None
+engine_lock = threading.Lock()
+
+# Section of the config file the engine connects with. Switched by use_config_section().
+config_section = 'DB'
+
+Session = sessionmaker()
+
+
+def get_engine():
+    """
+    Gets the shared engine, creating it on first use from the config file.
+    :return: SQLAlchemy engine.
+    """
+
+    global engine
+
+    with engine_lock:
+        if engine is None:
+            db_user, db_pass, db_host, db_name = conf_reader.read_config(config_section)
+            pool_size, max_overflow, pre_ping, statement_timeout = conf_reader.read_pool_config()
+
+            connect_args = {}
+            if statement_timeout:
+                connect_args['options'] = f"-c statement_timeout={statement_timeout}"
+
+            engine = create_engine(URL.create('postgresql+psycopg2', username=db_user, password=db_pass,
+                                              host=db_host, database=db_name),
+                                   pool_size=pool_size, max_overflow=max_overflow, pool_pre_ping=pre_ping,
+                                   connect_args=connect_args)
+            metrics.instrument_engine(engine)
+
+        return engine
+
+
+def use_config_section(section):
+    """
+    Connects with the settings in another section of the config file, e.g. a scratch database. Must be called
+    before the engine is first used.
+    :param section: Config file section with db_user, db_pass, db_host and db_name.
+    """
+
+    global config_section
+
+    if engine is not None:
+        raise RuntimeError("The engine has already connected with the config file's database")
+    config_section = section
+
+
+def new_session():
+    """
+    Creates a session bound to the shared engine. Sessions only take a connection from the pool when first used.
+    :return: SQLAlchemy Session.
+    """
+
+    return Session(bind=get_engine())
+
+
+def dispose_after_fork():
+    """
+    Drops the pool a forked child inherited. The parent's connections are left open for the parent to use.
+    """
+
+    global engine_lock
+
+    engine_lock = threading.Lock()  # Another thread of the parent may have held it when the process forked
+    if engine is not None:
+        engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=dispose_after_fork)